@@ -0,0 +1,207 @@
+'''
+Offline batch runner drafting answers to many grant application questions without the HTTP server.
+
+Ingests the files of a directory like an upload (served by the fake Storage bucket of serve.py, sessions kept in memory
+rather than in Firestore), then answers each question of a JSONL file ({"question": ..., "word_limit": ...}, the word
+limit defaulting to --word-limit) with the generation functions of message_generation/msg_gen.py, --workers at a time.
+Writes one JSON line per question, as soon as it is answered, with its answer, the latency of each stage and the token
+usage and cost of its LLM requests, and prints a summary.
+
+The OpenAI API is used as configured by OPENAI_API_KEY and OPENAI_BASE_URL, or the local OpenAI stand-in
+(mock_openai.py) is started with --mock, eg. to compare the latency of retrieval and prompt changes at scale.
+
+Usage:
+    python benchmarks/batch_run.py --output answers.jsonl [--documents-dir DIR] [--questions FILE] [--workers 4]
+    python benchmarks/batch_run.py --output results.jsonl --mock --check-comprehensiveness
+'''
+
+import argparse
+import copy
+import json
+import os
+import queue
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import copy_context
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+os.environ.setdefault('SESSION_STORE', 'memory')
+os.environ.setdefault('LLM_CACHE_ENABLED', 'true')
+
+from benchmarks.load_test import percentile, wait_until_up
+from benchmarks.serve import DOCUMENTS_DIR, install_fakes
+
+QUESTIONS_PATH = REPO_ROOT / 'benchmarks' / 'data' / 'retrieval_questions.jsonl'
+
+
+def load_questions(path: Path, default_word_limit: int) -> list[tuple[str, int]]:
+    '''Read the question and word limit of each line of a JSONL file.'''
+    questions = []
+    for line in path.read_text().splitlines():
+        if line.strip():
+            question = json.loads(line)
+            questions.append((question['question'], int(question.get('word_limit', default_word_limit))))
+    return questions
+
+
+def ingest_documents(documents_dir: Path):
+    '''Ingest the files of a directory in a new session, returning its state once they are in the vector store.'''
+    from persistence.session_store import get_session_store
+    from utilities.ingestion import start_ingestion, wait_for_ingestion
+    from workflow.session_state import SessionState
+
+    state = SessionState(session_id=str(uuid.uuid4()), user_id='batch_run')
+    state.set_uploaded_files(sorted(path.name for path in documents_dir.iterdir() if path.is_file()))
+
+    # stored like a session of the app before its files are ingested, for the job to persist its status
+    get_session_store().put(state)
+    start_ingestion(state)
+    if not wait_for_ingestion(state) or state.ingestion.error is not None:
+        raise RuntimeError(f'Failed to ingest the documents of {documents_dir}: {state.ingestion.error or "timed out"}')
+    return state
+
+
+def run_question(ingested_state, index: int, question: str, word_limit: int, check_comprehensiveness: bool) -> dict:
+    '''
+    Answer a question in a copy of the ingested session, like the chat does once the question and its word limit are
+    entered, recording the latency of each stage and the token usage of the LLM requests
+
+        Parameters:
+            ingested_state (SessionState): state of the session whose documents are ingested
+            index (int): index of the question in the questions file
+            question (str): grant application question
+            word_limit (int): word limit of the answer
+            check_comprehensiveness (bool): whether to also check the answer for comprehensiveness
+
+        Returns:
+            dict: result of the question, written as a line of the output
+    '''
+    from message_generation.msg_gen import check_for_comprehensiveness, generate_answer_to_question_stream
+    from utilities.instrumentation import UsageRecorder, current_step_id, current_usage_recorder
+    from utilities.usage_ledger import check_budget, get_cost_usd
+
+    state = copy.deepcopy(ingested_state)
+    state.usage.entries.clear()  # the usage of the ingestion, not of the question
+    state.add_new_question()
+    state.set_grant_application_question(question)
+    state.set_word_limit(str(word_limit))
+
+    recorder = UsageRecorder()
+    current_usage_recorder.set(recorder)
+    current_step_id.set('batch_run')
+    check_budget(state)
+
+    messages = queue.Queue()  # the chat messages streamed by the generation functions, which are not kept
+    error = None
+    start = time.perf_counter()
+    try:
+        generate_answer_to_question_stream(state, messages)
+        if check_comprehensiveness:
+            check_for_comprehensiveness(state, messages)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    total_seconds = time.perf_counter() - start
+
+    question_context = state.get_last_question_context()
+    result = {
+        'index': index,
+        'question': question,
+        'word_limit': word_limit,
+        'answer': question_context.answer,
+        'num_words': len(question_context.answer.split()) if question_context.answer else 0,
+        'total_seconds': total_seconds,
+        'time_to_first_token_seconds': recorder.time_to_first_token_seconds,
+        'stage_seconds': recorder.stage_seconds,
+        'tokens': recorder.tokens,
+        'cost_usd': sum(get_cost_usd(entry) for entry in state.usage.entries),
+        'error': error,
+    }
+    if check_comprehensiveness:
+        result['missing_information'] = question_context.comprehensiveness.missing_information
+        result['implicit_questions'] = [q.question for q in question_context.comprehensiveness.implicit_questions]
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', type=Path, required=True, help='JSONL file the results are written to')
+    parser.add_argument('--documents-dir', type=Path, default=DOCUMENTS_DIR, help='directory of the files to ingest')
+    parser.add_argument('--questions', type=Path, default=QUESTIONS_PATH, help='JSONL file of the questions to answer')
+    parser.add_argument('--word-limit', type=int, default=150, help='word limit of the questions without one')
+    parser.add_argument('--workers', type=int, default=4, help='number of questions answered at a time')
+    parser.add_argument('--check-comprehensiveness', action='store_true', help='also check each answer for comprehensiveness')
+    parser.add_argument('--mock', action='store_true', help='start the local OpenAI stand-in and use it')
+    parser.add_argument('--mock-port', type=int, default=8100)
+    parser.add_argument('--ttft-ms', type=float, default=400, help='time to first token of the OpenAI stand-in')
+    parser.add_argument('--tokens-per-second', type=float, default=60, help='token rate of the OpenAI stand-in')
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions, args.word_limit)
+    mock = None
+
+    try:
+        if args.mock:
+            mock_url = f'http://127.0.0.1:{args.mock_port}'
+            mock = subprocess.Popen([
+                sys.executable, str(REPO_ROOT / 'benchmarks' / 'mock_openai.py'),
+                '--port', str(args.mock_port),
+                '--ttft-ms', str(args.ttft_ms),
+                '--tokens-per-second', str(args.tokens_per_second)])
+            wait_until_up(f'{mock_url}/health')
+            os.environ.update({'OPENAI_BASE_URL': f'{mock_url}/v1', 'OPENAI_API_KEY': 'mock'})
+
+        install_fakes(args.documents_dir)
+
+        from utilities.instrumentation import UsageRecorder, current_usage_recorder
+
+        ingestion = UsageRecorder()
+        current_usage_recorder.set(ingestion)  # copied into the context of the ingestion job
+        start = time.perf_counter()
+        state = ingest_documents(args.documents_dir)
+        current_usage_recorder.set(None)
+        print(f'Ingested {state.ingestion.num_files} files ({state.ingestion.num_chunks} chunks) in {time.perf_counter() - start:.1f}s: '
+              + ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in sorted(ingestion.stage_seconds.items())))
+
+        print(f'Answering {len(questions)} questions, {args.workers} at a time')
+        results = []
+        start = time.perf_counter()
+        with args.output.open('w') as output, ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='batch_run') as executor:
+            futures = [
+                executor.submit(copy_context().run, run_question, state, index, question, word_limit, args.check_comprehensiveness)
+                for index, (question, word_limit) in enumerate(questions)]
+            for future in as_completed(futures):
+                results.append(result := future.result())
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+        wall_time = time.perf_counter() - start
+    finally:
+        if mock is not None:
+            mock.terminate()
+            mock.wait(timeout=10)
+
+    failed = [result for result in results if result['error'] is not None]
+    total_seconds = [result['total_seconds'] for result in results if result['error'] is None]
+    tokens = {}
+    for result in results:
+        for kind, num_tokens in result['tokens'].items():
+            tokens[kind] = tokens.get(kind, 0) + num_tokens
+
+    if total_seconds:
+        print(f'Answered {len(total_seconds)} questions in {wall_time:.1f}s: p50 {percentile(total_seconds, 50):.2f}s, '
+              f'p95 {percentile(total_seconds, 95):.2f}s per question')
+    print('Tokens: ' + (', '.join(f'{kind} {num_tokens}' for kind, num_tokens in sorted(tokens.items())) or 'none recorded')
+          + f' (${sum(result["cost_usd"] for result in results):.4f})')
+    for result in failed:
+        print(f'Failed question {result["index"]} ("{result["question"]}"): {result["error"]}')
+    print(f'Results written to {args.output}')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
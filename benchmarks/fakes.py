@@ -0,0 +1,157 @@
+'''
+In-memory stand-ins for Firestore, Cloud Storage and Firebase Auth, used to run the app without credentials.
+'''
+
+import base64
+import copy
+import datetime
+import hashlib
+from pathlib import Path
+from threading import Lock
+
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, data: dict | None, update_time: datetime.datetime | None = None):
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> dict | None:
+        return copy.deepcopy(self._data)
+
+
+class FakeDocumentReference:
+    def __init__(self, collection: 'FakeCollectionReference', document_id: str):
+        self._collection = collection
+        self.id = document_id
+
+    def get(self, field_paths=None, **kwargs) -> FakeDocumentSnapshot:
+        with self._collection.lock:
+            data = self._collection.documents.get(self.id)
+            if data is not None and field_paths is not None:
+                data = {field: data[field] for field in field_paths if field in data}
+            return FakeDocumentSnapshot(copy.deepcopy(data), self._collection.update_times.get(self.id))
+
+    def set(self, document_data: dict, merge: bool = False, **kwargs) -> None:
+        with self._collection.lock:
+            data = copy.deepcopy(document_data)
+            if merge and self.id in self._collection.documents:
+                data = self._collection.documents[self.id] | data
+            self._write(data)
+
+    def create(self, document_data: dict, **kwargs) -> None:
+        with self._collection.lock:
+            if self.id in self._collection.documents:
+                raise AlreadyExists(f'Document already exists: {self.id}')
+            self._write(copy.deepcopy(document_data))
+
+    def update(self, field_updates: dict, option: 'FakeLastUpdateOption | None' = None, **kwargs) -> None:
+        with self._collection.lock:
+            if self.id not in self._collection.documents:
+                raise NotFound(f'No document to update: {self.id}')
+            if option is not None and option.last_update_time != self._collection.update_times[self.id]:
+                raise FailedPrecondition(f'Document was updated since {option.last_update_time}: {self.id}')
+            self._write(self._collection.documents[self.id] | copy.deepcopy(field_updates))
+
+    def _write(self, data: dict) -> None:
+        self._collection.documents[self.id] = data
+        self._collection.update_times[self.id] = datetime.datetime.now(datetime.timezone.utc)
+
+    def delete(self, **kwargs) -> None:
+        with self._collection.lock:
+            self._collection.documents.pop(self.id, None)
+            self._collection.update_times.pop(self.id, None)
+
+    def collection(self, collection_id: str) -> 'FakeCollectionReference':
+        return self._collection.client.collection(f'{self._collection.id}/{self.id}/{collection_id}')
+
+
+class FakeCollectionReference:
+    def __init__(self, client: 'FakeFirestoreClient', collection_id: str):
+        self.client = client
+        self.id = collection_id
+        self.documents: dict[str, dict] = {}
+        self.update_times: dict[str, datetime.datetime] = {}
+        self.lock = client.lock
+
+    def document(self, document_id: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self, document_id)
+
+
+class FakeLastUpdateOption:
+    def __init__(self, last_update_time: datetime.datetime):
+        self.last_update_time = last_update_time
+
+
+class FakeFirestoreClient:
+    '''Thread-safe in-memory Firestore client supporting the subset of the API used by the app.'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self._collections: dict[str, FakeCollectionReference] = {}
+
+    def collection(self, collection_id: str) -> FakeCollectionReference:
+        with self.lock:
+            if collection_id not in self._collections:
+                self._collections[collection_id] = FakeCollectionReference(self, collection_id)
+            return self._collections[collection_id]
+
+    def write_option(self, last_update_time: datetime.datetime) -> FakeLastUpdateOption:
+        return FakeLastUpdateOption(last_update_time)
+
+
+class FakeBlob:
+    def __init__(self, name: str, path: Path):
+        self.name = name
+        self._path = path
+
+    @property
+    def generation(self) -> int | None:
+        return self._path.stat().st_mtime_ns if self._path.is_file() else None
+
+    @property
+    def md5_hash(self) -> str | None:
+        # base64 encoded like the MD5 hashes of Storage
+        return base64.b64encode(hashlib.md5(self._path.read_bytes()).digest()).decode() if self._path.is_file() else None
+
+    def exists(self) -> bool:
+        return self._path.is_file()
+
+    def download_as_text(self, **kwargs) -> str:
+        return self._path.read_text()
+
+    def download_as_bytes(self, **kwargs) -> bytes:
+        return self._path.read_bytes()
+
+
+class FakeBucket:
+    '''
+    Storage bucket serving every user the files of a local directory,
+    ie. blob `chat_documents/{user_id}/{file_name}` is read from `{directory}/{file_name}`.
+    '''
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+
+    def blob(self, blob_name: str) -> FakeBlob:
+        return FakeBlob(blob_name, self.directory / blob_name.rsplit('/', 1)[-1])
+
+    def get_blob(self, blob_name: str) -> FakeBlob | None:
+        blob = self.blob(blob_name)
+        return blob if blob.exists() else None
+
+
+class FakeTokenCache:
+    '''Token "verifier" accepting any token, and using the token itself as the user ID.'''
+
+    hits = 0
+    misses = 0
+    hit_rate = 1.0
+
+    def get_user_id(self, token: str) -> str:
+        return token
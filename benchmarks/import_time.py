@@ -0,0 +1,117 @@
+'''
+Cold-start import time regression benchmark.
+
+Imports the FastAPI app module in fresh interpreters with `python -X importtime` and fails (exit code 1)
+if the cumulative import time exceeds the budget, or if any module that must be imported lazily
+(Unstructured, Chroma, firebase_admin, ...) is pulled in at import time.
+
+Usage:
+    python benchmarks/import_time.py [--module main] [--budget-ms 1000] [--runs 5] [--top 15]
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+DEFAULT_BUDGET_MS = int(os.getenv('IMPORT_TIME_BUDGET_MS', 1000))
+
+# Modules that are only needed once a request is served, and must therefore never be imported at startup
+LAZY_MODULES = (
+    'unstructured',
+    'chromadb',
+    'firebase_admin',
+    'langchain_community.vectorstores',
+    'langchain_community.document_loaders',
+    'langchain_openai',
+    'tiktoken',
+    'devtools',
+)
+
+
+def parse_importtime_output(stderr: str) -> dict[str, tuple[int, int]]:
+    '''
+    Parse the output of `python -X importtime`
+
+        Parameters:
+            stderr (str): stderr of the interpreter run with `-X importtime`
+
+        Returns:
+            dict[str, tuple[int, int]]: mapping of module name to (cumulative import time in microseconds, nesting depth)
+    '''
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        _, cumulative_us, name = line.removeprefix('import time:').split('|')
+        name = name.removeprefix(' ')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules[name.strip()] = (int(cumulative_us), depth)
+
+    return modules
+
+
+def measure_import(module: str) -> dict[str, tuple[int, int]]:
+    '''Import module in a fresh interpreter and return its parsed import times.'''
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True)
+
+    if result.returncode != 0:
+        raise RuntimeError(f'Importing {module} failed:\n{result.stderr[-2000:]}')
+
+    return parse_importtime_output(result.stderr)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='main', help='module to import (default: main)')
+    parser.add_argument('--budget-ms', type=int, default=DEFAULT_BUDGET_MS, help='max cumulative import time in ms')
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh interpreters to measure (median is used)')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest modules to report')
+    args = parser.parse_args()
+
+    # the first run warms up the bytecode cache, so it is not included in the measurements
+    measure_import(args.module)
+    runs = [measure_import(args.module) for _ in range(args.runs)]
+
+    median_ms = statistics.median(run[args.module][0] / 1000 for run in runs)
+
+    last_run = runs[-1]
+    print(f'Cold-start import of `{args.module}`: median {median_ms:.0f} ms over {args.runs} runs (budget {args.budget_ms} ms)\n')
+    print(f'Slowest direct imports of `{args.module}`:')
+    slowest = sorted(
+        ((name, cumulative) for name, (cumulative, depth) in last_run.items() if depth == 1),
+        key=lambda item: item[1],
+        reverse=True)
+    for name, cumulative in slowest[:args.top]:
+        print(f'• {cumulative / 1000:8.1f} ms  {name}')
+
+    failed = False
+
+    eagerly_imported = sorted(
+        name for name in last_run
+        if any(name == lazy or name.startswith(f'{lazy}.') for lazy in LAZY_MODULES))
+    if eagerly_imported:
+        failed = True
+        print(f'\nFAIL: modules that must be imported lazily were imported at startup: {", ".join(eagerly_imported)}')
+
+    if median_ms > args.budget_ms:
+        failed = True
+        print(f'\nFAIL: cold-start import time {median_ms:.0f} ms exceeds the budget of {args.budget_ms} ms')
+
+    if not failed:
+        print('\nOK: cold-start import time is within budget')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,289 @@
+'''
+Load-test harness driving scripted conversations through every step of the workflow.
+
+Starts the local OpenAI stand-in (mock_openai.py) and the app with in-memory Firestore and Storage fakes
+(serve.py), then runs concurrent virtual users, each going through scripted conversations. Reports p50/p95/p99
+latency per endpoint (and per step for /chat/), time to first streamed chunk, throughput and app memory.
+
+Usage:
+    python benchmarks/load_test.py [--users 10] [--conversations 3] [--ttft-ms 400] [--tokens-per-second 60]
+    python benchmarks/load_test.py --app-url http://127.0.0.1:8000   # against an already running app
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import httpx
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from configurations.constants import Component, StepID
+
+# Values of main.InputType
+CHATBOT, BUTTON, NUMBER_INPUT, FILES = 1, 2, 3, 4
+
+DOCUMENTS = ['annual_report.txt', 'strategic_plan.txt']
+
+
+@dataclass
+class Chat:
+    '''User input sent to /chat/ at a step, followed by a call to /after_chat to move to the next step.'''
+    step: StepID
+    input_type: int
+    value: str | int | list[str]
+
+
+@dataclass
+class Edit:
+    '''Answer edited by the user in the editor, sent to /edit.'''
+    question_index: int
+    answer: str
+
+
+# Scripted conversations, following the deterministic outputs of mock_openai.py: the comprehensiveness check
+# returns 3 implicit questions, and the 2nd one (budget) cannot be answered from the documents
+SCENARIOS: dict[str, list[Chat | Edit]] = {
+    'upload_and_answer_implicit_questions': [
+        Chat(StepID.START, BUTTON, Component.START),
+        Chat(StepID.HAVE_MATERIALS_TO_SHARE, BUTTON, Component.YES),
+        Chat(StepID.UPLOAD_FILES, FILES, DOCUMENTS),
+        Chat(StepID.ENTER_QUESTION, CHATBOT, 'What is your mission?'),
+        Chat(StepID.ENTER_WORD_LIMIT, NUMBER_INPUT, 150),
+        Edit(0, 'Our mission is to help low-income families achieve housing stability and economic mobility.'),
+        Chat(StepID.GO_OVER_IMPLICIT_QUESTIONS, BUTTON, Component.YES),
+        Chat(StepID.DO_PROCEED_WITH_IMPLICIT_QUESTION, BUTTON, Component.YES),
+        Chat(StepID.SELECT_WHAT_TO_DO_WITH_ANSWER_GENERATED_FROM_CONTEXT, BUTTON, Component.GOOD_AS_IS),
+        Chat(StepID.DO_PROCEED_WITH_IMPLICIT_QUESTION, BUTTON, Component.YES),
+        Chat(StepID.SELECT_WHAT_TO_DO_WITH_ANSWER_GENERATED_FROM_CONTEXT, BUTTON, Component.YES),
+        Chat(StepID.PROMPT_USER_TO_SUBMIT_ANSWER, CHATBOT, 'The program budget is $1.2 million per year.'),
+        Chat(StepID.DO_PROCEED_WITH_IMPLICIT_QUESTION, BUTTON, Component.YES),
+        Chat(StepID.SELECT_WHAT_TO_DO_WITH_ANSWER_GENERATED_FROM_CONTEXT, BUTTON, Component.EDIT_IT),
+        Chat(StepID.PROMPT_USER_TO_SUBMIT_ANSWER, CHATBOT, 'We partner with the school district and 25 local employers.'),
+        Chat(StepID.READY_TO_GENERATE_FINAL_ANSWER, BUTTON, Component.OF_COURSE),
+        Chat(StepID.ASK_USER_IF_GUIDANCE_NEEDED, BUTTON, Component.ADD_GUIDANCE),
+        Chat(StepID.USER_GUIDANCE_PROMPT, CHATBOT, 'Make it more formal'),
+        Chat(StepID.ASK_USER_IF_GUIDANCE_NEEDED, BUTTON, Component.GOOD_AS_IS),
+        Chat(StepID.DO_ANOTHER_QUESTION, BUTTON, Component.NO),
+    ],
+    'no_materials_skip_implicit_questions': [
+        Chat(StepID.START, BUTTON, Component.START),
+        Chat(StepID.HAVE_MATERIALS_TO_SHARE, BUTTON, Component.NO),
+        Chat(StepID.ENTER_QUESTION, CHATBOT, 'What are your organization\'s goals for the next 3-5 years?'),
+        Chat(StepID.ENTER_WORD_LIMIT, NUMBER_INPUT, 100),
+        Chat(StepID.GO_OVER_IMPLICIT_QUESTIONS, BUTTON, Component.NO),
+        Chat(StepID.ASK_USER_IF_GUIDANCE_NEEDED, BUTTON, Component.GOOD_AS_IS),
+        Chat(StepID.DO_ANOTHER_QUESTION, BUTTON, Component.YES),
+        Chat(StepID.ENTER_QUESTION, CHATBOT, 'How is your organization building an inclusive workplace culture?'),
+        Chat(StepID.ENTER_WORD_LIMIT, NUMBER_INPUT, 200),
+        Chat(StepID.GO_OVER_IMPLICIT_QUESTIONS, BUTTON, Component.YES),
+        Chat(StepID.DO_PROCEED_WITH_IMPLICIT_QUESTION, BUTTON, Component.NO),
+        Chat(StepID.DO_PROCEED_WITH_IMPLICIT_QUESTION, BUTTON, Component.YES),
+        Chat(StepID.SELECT_WHAT_TO_DO_WITH_ANSWER_GENERATED_FROM_CONTEXT, BUTTON, Component.NO),
+        Chat(StepID.DO_PROCEED_WITH_IMPLICIT_QUESTION, BUTTON, Component.NO),
+        Chat(StepID.DO_ANOTHER_QUESTION, BUTTON, Component.NO),
+    ],
+}
+
+
+@dataclass
+class Results:
+    latencies: dict[str, list[float]] = field(default_factory=lambda: defaultdict(list))
+    time_to_first_chunk: dict[str, list[float]] = field(default_factory=lambda: defaultdict(list))
+    errors: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    num_requests: int = 0
+    num_conversations: int = 0
+
+    def record(self, name: str, latency: float) -> None:
+        self.latencies[name].append(latency)
+        self.num_requests += 1
+
+
+def percentile(values: list[float], p: float) -> float:
+    '''Nearest-rank percentile of values.'''
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))]
+
+
+async def post(client: httpx.AsyncClient, results: Results, name: str, url: str, **kwargs) -> httpx.Response:
+    start = time.perf_counter()
+    response = await client.post(url, **kwargs)
+    results.record(name, time.perf_counter() - start)
+    if response.status_code >= 400:
+        results.errors[name] += 1
+    return response
+
+
+async def run_conversation(client: httpx.AsyncClient, results: Results, user_id: str, turns: list[Chat | Edit]) -> None:
+    headers = {'Authorization': f'Bearer {user_id}'}
+
+    response = await post(client, results, '/new_session', '/new_session', headers=headers)
+    response.raise_for_status()
+    session_id = response.json()['session_id']
+
+    for turn in turns:
+        if isinstance(turn, Edit):
+            await post(client, results, '/edit', '/edit', json={
+                'session_id': session_id, 'question_index': turn.question_index, 'answer': turn.answer})
+            continue
+
+        name = f'/chat/ [{turn.step}]'
+        body = {'session_id': session_id, 'user_input': {'input_type': turn.input_type, 'input_value': turn.value}}
+        start = time.perf_counter()
+        first_chunk_at = None
+        async with client.stream('POST', '/chat/', json=body, headers=headers) as stream:
+            async for chunk in stream.aiter_text():
+                if chunk and first_chunk_at is None:
+                    first_chunk_at = time.perf_counter()
+            if stream.status_code >= 400:
+                results.errors[name] += 1
+        results.record('/chat/', time.perf_counter() - start)
+        results.latencies[name].append(time.perf_counter() - start)
+        if first_chunk_at is not None:
+            results.time_to_first_chunk[name].append(first_chunk_at - start)
+
+        await post(client, results, '/after_chat', '/after_chat', json={'session_id': session_id})
+
+    results.num_conversations += 1
+
+
+async def run_user(app_url: str, results: Results, user_index: int, num_conversations: int, scenarios: list[str]) -> None:
+    async with httpx.AsyncClient(base_url=app_url, timeout=httpx.Timeout(300)) as client:
+        for i in range(num_conversations):
+            scenario = scenarios[(user_index + i) % len(scenarios)]
+            try:
+                await run_conversation(client, results, f'load-test-user-{user_index}', SCENARIOS[scenario])
+            except Exception as e:
+                results.errors[f'conversation [{scenario}]'] += 1
+                print(f'User {user_index} failed conversation {scenario}: {e!r}', file=sys.stderr)
+
+
+def read_memory_kb(pid: int) -> dict[str, int]:
+    '''Current (VmRSS) and peak (VmHWM) resident memory of a process, in kB (Linux only).'''
+    try:
+        status = Path(f'/proc/{pid}/status').read_text()
+    except OSError:
+        return {}
+    return {line.split(':')[0]: int(line.split()[1]) for line in status.splitlines() if line.startswith(('VmRSS', 'VmHWM'))}
+
+
+def wait_until_up(url: str, timeout: float = 60) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f'{url} did not come up within {timeout}s')
+
+
+def print_report(results: Results, wall_time: float, memory: dict[str, int]) -> dict:
+    report = {'endpoints': {}, 'time_to_first_chunk': {}}
+
+    print(f'\n{"endpoint":<75} {"count":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"errors":>7}')
+    for name in sorted(results.latencies):
+        values = results.latencies[name]
+        stats = {'count': len(values), **{f'p{p}': percentile(values, p) * 1000 for p in (50, 95, 99)}, 'errors': results.errors.get(name, 0)}
+        report['endpoints'][name] = stats
+        print(f'{name:<75} {stats["count"]:>6} {stats["p50"]:>9.0f} {stats["p95"]:>9.0f} {stats["p99"]:>9.0f} {stats["errors"]:>7}')
+
+    print(f'\n{"time to first streamed chunk":<75} {"count":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}')
+    for name in sorted(results.time_to_first_chunk):
+        values = results.time_to_first_chunk[name]
+        stats = {'count': len(values), **{f'p{p}': percentile(values, p) * 1000 for p in (50, 95, 99)}}
+        report['time_to_first_chunk'][name] = stats
+        print(f'{name:<75} {stats["count"]:>6} {stats["p50"]:>9.0f} {stats["p95"]:>9.0f} {stats["p99"]:>9.0f}')
+
+    report['throughput'] = {
+        'wall_time_s': wall_time,
+        'requests_per_s': results.num_requests / wall_time,
+        'conversations_per_min': results.num_conversations * 60 / wall_time,
+    }
+    report['memory_kb'] = memory
+    report['failed_conversations'] = {k: v for k, v in results.errors.items() if k.startswith('conversation')}
+
+    print(f'\nThroughput: {report["throughput"]["requests_per_s"]:.1f} requests/s, '
+          f'{report["throughput"]["conversations_per_min"]:.1f} conversations/min over {wall_time:.1f}s')
+    if memory:
+        print(f'App memory: {memory.get("VmRSS", 0) / 1024:.0f} MB resident, {memory.get("VmHWM", 0) / 1024:.0f} MB peak')
+    if report['failed_conversations']:
+        print(f'Failed conversations: {report["failed_conversations"]}')
+
+    return report
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10, help='number of concurrent virtual users')
+    parser.add_argument('--conversations', type=int, default=2, help='number of conversations per user')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='scenario(s) to run (default: all)')
+    parser.add_argument('--app-url', help='URL of an already running app (default: start one with in-memory fakes)')
+    parser.add_argument('--app-port', type=int, default=8000)
+    parser.add_argument('--mock-port', type=int, default=8100)
+    parser.add_argument('--ttft-ms', type=float, default=400, help='time to first token of the OpenAI stand-in')
+    parser.add_argument('--tokens-per-second', type=float, default=60, help='token rate of the OpenAI stand-in')
+    parser.add_argument('--completion-tokens', type=int, default=150, help='number of tokens of generated answers')
+    parser.add_argument('--embedding-latency-ms', type=float, default=150, help='latency of embeddings requests')
+    parser.add_argument('--json', type=Path, help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    processes = []
+    app_pid = None
+    app_url = args.app_url
+
+    try:
+        if app_url is None:
+            mock_url = f'http://127.0.0.1:{args.mock_port}'
+            processes.append(subprocess.Popen([
+                sys.executable, str(REPO_ROOT / 'benchmarks' / 'mock_openai.py'),
+                '--port', str(args.mock_port),
+                '--ttft-ms', str(args.ttft_ms),
+                '--tokens-per-second', str(args.tokens_per_second),
+                '--completion-tokens', str(args.completion_tokens),
+                '--embedding-latency-ms', str(args.embedding_latency_ms)]))
+            wait_until_up(f'{mock_url}/health')
+
+            app_url = f'http://127.0.0.1:{args.app_port}'
+            app = subprocess.Popen(
+                [sys.executable, str(REPO_ROOT / 'benchmarks' / 'serve.py'), '--port', str(args.app_port)],
+                env=os.environ | {'OPENAI_BASE_URL': f'{mock_url}/v1', 'OPENAI_API_KEY': 'mock', 'SENTRY_DSN': ''})
+            processes.append(app)
+            app_pid = app.pid
+            wait_until_up(f'{app_url}/metrics')
+
+        scenarios = args.scenario or sorted(SCENARIOS)
+        results = Results()
+
+        print(f'Running {args.users} users x {args.conversations} conversations ({", ".join(scenarios)}) against {app_url}')
+        start = time.perf_counter()
+
+        async def run_all():
+            await asyncio.gather(*(
+                run_user(app_url, results, i, args.conversations, scenarios) for i in range(args.users)))
+
+        asyncio.run(run_all())
+        wall_time = time.perf_counter() - start
+
+        report = print_report(results, wall_time, read_memory_kb(app_pid) if app_pid else {})
+        if args.json:
+            args.json.write_text(json.dumps(report, indent=2))
+
+        return 1 if report['failed_conversations'] else 0
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(timeout=10)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,301 @@
+'''
+Local stand-in for the OpenAI API, streaming deterministic chat completions, function calls and embeddings
+at configurable rates and latencies.
+
+Usage:
+    python benchmarks/mock_openai.py [--port 8100] [--ttft-ms 400] [--tokens-per-second 60] [--completion-tokens 150]
+
+Then point the OpenAI client at it with OPENAI_BASE_URL=http://127.0.0.1:8100/v1 (and any OPENAI_API_KEY).
+'''
+
+import argparse
+import array
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import time
+import uuid
+from collections import OrderedDict
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Latency profile, configurable from the command line or the environment (eg. when started by load_test.py)
+TTFT_MS = float(os.getenv('MOCK_OPENAI_TTFT_MS', 400))
+TTFT_JITTER_MS = float(os.getenv('MOCK_OPENAI_TTFT_JITTER_MS', 100))
+# Fraction of chat completions whose first token takes SLOW_TTFT_MS instead (tail latency), to exercise hedged requests
+SLOW_FRACTION = float(os.getenv('MOCK_OPENAI_SLOW_FRACTION', 0))
+SLOW_TTFT_MS = float(os.getenv('MOCK_OPENAI_SLOW_TTFT_MS', 5000))
+TOKENS_PER_SECOND = float(os.getenv('MOCK_OPENAI_TOKENS_PER_SECOND', 60))
+COMPLETION_TOKENS = int(os.getenv('MOCK_OPENAI_COMPLETION_TOKENS', 150))
+EMBEDDING_LATENCY_MS = float(os.getenv('MOCK_OPENAI_EMBEDDING_LATENCY_MS', 150))
+# Fraction of embeddings requests answered with a 429 rate limit error, to exercise retries
+EMBEDDING_RATE_LIMITED_FRACTION = float(os.getenv('MOCK_OPENAI_EMBEDDING_RATE_LIMITED_FRACTION', 0))
+# Models whose chat completions fail with a 503, to exercise the fallbacks of the model router (comma separated)
+FAILING_MODELS = {model for model in os.getenv('MOCK_OPENAI_FAILING_MODELS', '').split(',') if model}
+
+# Like the OpenAI API, prompts of at least PROMPT_CACHE_MIN_TOKENS tokens are cached by blocks of PROMPT_CACHE_BLOCK_TOKENS
+# tokens, the prefix of a prompt already seen is reported in usage.prompt_tokens_details.cached_tokens, and the time to
+# first token is shortened by up to PROMPT_CACHE_TTFT_SAVING (fully cached prompt)
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_BLOCK_TOKENS = 128
+PROMPT_CACHE_MAX_BLOCKS = 100_000
+PROMPT_CACHE_TTFT_SAVING = float(os.getenv('MOCK_OPENAI_PROMPT_CACHE_TTFT_SAVING', 0.5))
+_prompt_cache_blocks: OrderedDict[str, None] = OrderedDict()
+
+IMPLICIT_QUESTIONS = [
+    'What measurable outcomes did the program achieve last year?',
+    'What is the budget of the program?',
+    'Which partners does the organization work with?',
+]
+NOT_ENOUGH_INFORMATION = 'Not enough information provided.'
+
+WORDS = (
+    'our organization serves families across the region through housing support education and workforce '
+    'programs that measurably improve outcomes for youth and adults while building lasting community partnerships'
+).split()
+
+app = FastAPI()
+
+
+def _seed(*parts) -> int:
+    return int(hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:16], 16)
+
+
+def _count_tokens(messages: list[dict]) -> int:
+    return sum(len(str(message.get('content') or '').split()) for message in messages)
+
+
+def _completion_text(messages: list[dict]) -> str:
+    '''Deterministic answer: short for implicit questions, and "not enough information" for budget questions.'''
+    system = ' '.join(str(m.get('content') or '') for m in messages if m.get('role') == 'system')
+    last_user = next((str(m.get('content') or '') for m in reversed(messages) if m.get('role') == 'user'), '')
+
+    if 'Be as concise as possible' in system:
+        if 'budget' in last_user.lower():
+            return NOT_ENOUGH_INFORMATION
+        num_words = 25
+    else:
+        num_words = COMPLETION_TOKENS
+
+    rng = random.Random(_seed(messages))
+    words = [rng.choice(WORDS) for _ in range(num_words)]
+    return ' '.join(words).capitalize() + '.'
+
+
+def _function_call_arguments(function_name: str) -> str:
+    if function_name == 'function_for_document_digest':
+        return json.dumps({
+            'mission': 'The organization helps young people from low-income neighborhoods access higher education.',
+            'programs': 'Mentoring, tutoring and college application workshops in three cities.',
+            'metrics': '1,200 students served last year, 85% of whom enrolled in college.',
+            'finances': 'Annual budget of $2.4M, funded by foundations (60%) and individual donors (40%).',
+        })
+    return json.dumps({
+        'missing_information': 'The answer does not mention measurable outcomes, the budget or the partners of the program.',
+        'implicit_questions': [{'question': question} for question in IMPLICIT_QUESTIONS],
+    })
+
+
+def _tokens(text: str) -> list[str]:
+    words = text.split(' ')
+    return [words[0]] + [f' {word}' for word in words[1:]]
+
+
+def _cached_tokens(body: dict) -> int:
+    '''Number of tokens of the longest prefix of the prompt (functions, then messages) seen in previous prompts, in whole blocks.'''
+    tools = body.get('functions') or body.get('tools') or []
+    tokens = json.dumps(tools).split() + [word for message in body.get('messages', []) for word in str(message.get('content') or '').split()]
+
+    cached_tokens = 0
+    prefix = hashlib.sha256()
+    for end in range(PROMPT_CACHE_BLOCK_TOKENS, len(tokens) + 1, PROMPT_CACHE_BLOCK_TOKENS):
+        prefix.update(' '.join(tokens[end - PROMPT_CACHE_BLOCK_TOKENS:end]).encode())
+        block = prefix.hexdigest()
+        if block in _prompt_cache_blocks and cached_tokens == end - PROMPT_CACHE_BLOCK_TOKENS:
+            cached_tokens = end
+        _prompt_cache_blocks[block] = None
+        _prompt_cache_blocks.move_to_end(block)
+    while len(_prompt_cache_blocks) > PROMPT_CACHE_MAX_BLOCKS:
+        _prompt_cache_blocks.popitem(last=False)
+
+    return cached_tokens if len(tokens) >= PROMPT_CACHE_MIN_TOKENS else 0
+
+
+async def _wait_for_first_token(rng: random.Random, cached_share: float = 0) -> None:
+    ttft_ms = (SLOW_TTFT_MS if rng.random() < SLOW_FRACTION else TTFT_MS) * (1 - PROMPT_CACHE_TTFT_SAVING * cached_share)
+    await asyncio.sleep(max(0, ttft_ms + rng.uniform(-TTFT_JITTER_MS, TTFT_JITTER_MS)) / 1000)
+
+
+@app.post('/v1/chat/completions')
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get('model', 'gpt-mock')
+    messages = body.get('messages', [])
+    if model in FAILING_MODELS:
+        return JSONResponse(
+            {'error': {'message': f'The model {model} is overloaded', 'type': 'server_error', 'code': None}},
+            status_code=503)
+
+    rng = random.Random(_seed(messages, time.time()))
+
+    is_function_call = 'functions' in body or 'tools' in body
+    if is_function_call:
+        function_name = (
+            body['functions'][0]['name'] if 'functions' in body else body['tools'][0]['function']['name'])
+        content = _function_call_arguments(function_name)
+    else:
+        content = _completion_text(messages)
+
+    # like the OpenAI API, a completion reaching max_tokens is cut there
+    finish_reason = 'function_call' if is_function_call else 'stop'
+    if not is_function_call and body.get('max_tokens') and len(_tokens(content)) > body['max_tokens']:
+        content = ''.join(_tokens(content)[:body['max_tokens']])
+        finish_reason = 'length'
+
+    completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+    created = int(time.time())
+    prompt_tokens = _count_tokens(messages)
+    cached_tokens = min(_cached_tokens(body), prompt_tokens)
+    cached_share = cached_tokens / prompt_tokens if prompt_tokens else 0
+    usage = {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': len(_tokens(content)),
+        'total_tokens': prompt_tokens + len(_tokens(content)),
+        'prompt_tokens_details': {'cached_tokens': cached_tokens},
+    }
+
+    def message_delta(token: str, is_first: bool) -> dict:
+        # like the OpenAI API, the function name (and tool call id) is only sent with the first chunk
+        if not is_function_call:
+            return {'content': token}
+        function = {'name': function_name, 'arguments': token} if is_first else {'arguments': token}
+        if 'functions' in body:
+            return {'function_call': function}
+        tool_call = {'index': 0, 'id': 'call_0', 'type': 'function', 'function': function} if is_first else {'index': 0, 'function': function}
+        return {'tool_calls': [tool_call]}
+
+    if not body.get('stream'):
+        await _wait_for_first_token(rng, cached_share)
+        await asyncio.sleep(len(_tokens(content)) / TOKENS_PER_SECOND)
+
+        message = {'role': 'assistant', 'content': None if is_function_call else content}
+        if is_function_call and 'functions' in body:
+            message['function_call'] = {'name': function_name, 'arguments': content}
+        elif is_function_call:
+            message['tool_calls'] = [{'id': 'call_0', 'type': 'function', 'function': {'name': function_name, 'arguments': content}}]
+
+        return JSONResponse({
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': created,
+            'model': model,
+            'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}],
+            'usage': usage,
+        })
+
+    def chunk(delta: dict, finish_reason: str | None = None, with_usage: bool = False) -> str:
+        data = {
+            'id': completion_id,
+            'object': 'chat.completion.chunk',
+            'created': created,
+            'model': model,
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}] if not with_usage else [],
+        }
+        if with_usage:
+            data['usage'] = usage
+        return f'data: {json.dumps(data)}\n\n'
+
+    async def stream():
+        await _wait_for_first_token(rng, cached_share)
+        yield chunk({'role': 'assistant', 'content': '' if not is_function_call else None})
+
+        for index, token in enumerate(_tokens(content)):
+            yield chunk(message_delta(token, is_first=index == 0))
+            await asyncio.sleep(1 / TOKENS_PER_SECOND)
+
+        yield chunk({}, finish_reason=finish_reason)
+        if (body.get('stream_options') or {}).get('include_usage'):
+            yield chunk({}, with_usage=True)
+        yield 'data: [DONE]\n\n'
+
+    return StreamingResponse(stream(), media_type='text/event-stream')
+
+
+@app.post('/v1/embeddings')
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body['input']
+    if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+        inputs = [inputs]
+
+    dimensions = body.get('dimensions') or 1536
+    await asyncio.sleep(EMBEDDING_LATENCY_MS / 1000)
+
+    if random.random() < EMBEDDING_RATE_LIMITED_FRACTION:
+        return JSONResponse(
+            {'error': {'message': 'Rate limit reached for requests', 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+            status_code=429,
+            headers={'retry-after': '0.5'})
+
+    data = []
+    num_tokens = 0
+    for index, item in enumerate(inputs):
+        num_tokens += len(item) if isinstance(item, list) else len(item.split())
+        rng = random.Random(_seed(item))
+        vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+        norm = math.sqrt(sum(v * v for v in vector))
+        embedding = [v / norm for v in vector]
+        if body.get('encoding_format') == 'base64':
+            embedding = base64.b64encode(array.array('f', embedding).tobytes()).decode()
+        data.append({'object': 'embedding', 'index': index, 'embedding': embedding})
+
+    return JSONResponse({
+        'object': 'list',
+        'data': data,
+        'model': body.get('model', 'text-embedding-mock'),
+        'usage': {'prompt_tokens': num_tokens, 'total_tokens': num_tokens},
+    })
+
+
+@app.get('/health')
+async def health():
+    return {'status': 'ok'}
+
+
+def main():
+    global TTFT_MS, TOKENS_PER_SECOND, COMPLETION_TOKENS, EMBEDDING_LATENCY_MS, EMBEDDING_RATE_LIMITED_FRACTION, FAILING_MODELS, SLOW_FRACTION, SLOW_TTFT_MS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--ttft-ms', type=float, default=TTFT_MS, help='mean time to first token')
+    parser.add_argument('--tokens-per-second', type=float, default=TOKENS_PER_SECOND, help='rate of streamed tokens')
+    parser.add_argument('--completion-tokens', type=int, default=COMPLETION_TOKENS, help='number of tokens of an answer')
+    parser.add_argument('--embedding-latency-ms', type=float, default=EMBEDDING_LATENCY_MS, help='latency of an embeddings request')
+    parser.add_argument('--embedding-rate-limited-fraction', type=float, default=EMBEDDING_RATE_LIMITED_FRACTION,
+                        help='fraction of embeddings requests answered with a 429')
+    parser.add_argument('--slow-fraction', type=float, default=SLOW_FRACTION, help='fraction of chat completions with a slow first token')
+    parser.add_argument('--slow-ttft-ms', type=float, default=SLOW_TTFT_MS, help='time to first token of the slow chat completions')
+    parser.add_argument('--failing-models', nargs='*', default=sorted(FAILING_MODELS), help='models whose chat completions fail with a 503')
+    args = parser.parse_args()
+
+    TTFT_MS = args.ttft_ms
+    TOKENS_PER_SECOND = args.tokens_per_second
+    COMPLETION_TOKENS = args.completion_tokens
+    EMBEDDING_LATENCY_MS = args.embedding_latency_ms
+    EMBEDDING_RATE_LIMITED_FRACTION = args.embedding_rate_limited_fraction
+    FAILING_MODELS = set(args.failing_models)
+    SLOW_FRACTION = args.slow_fraction
+    SLOW_TTFT_MS = args.slow_ttft_ms
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+'''
+Retrieval quality and cost of shortened and quantized embeddings.
+
+Chunks the files of benchmarks/data/documents and embeds them and the labelled grant application questions of
+benchmarks/data/retrieval_questions.jsonl with the embedding model of the app (EMBEDDING_DIMENSIONS dimensions). Then,
+for each number of dimensions (shortened embeddings) and each quantization of the vector index (with and without
+re-scoring of the top candidates with the float query), reports:
+- recall@k: share of the labelled relevant chunks of each question found in the top k chunks retrieved
+- overlap@k: share of the top k chunks retrieved at full precision and full dimensions that are still retrieved
+- bytes per embedding, and memory saved compared with full precision and full dimensions
+- search time of one query in an index of --search-vectors random embeddings
+
+Embeddings are requested from the OpenAI API (OPENAI_API_KEY and optionally OPENAI_BASE_URL must be set), and can be
+cached in a file to compare configurations without embedding the documents again. Recall is only meaningful with
+the real API: the embeddings of mock_openai.py are random.
+
+Usage:
+    python benchmarks/retrieval_recall.py [--dimensions 1024 512 256] [--k 1 3 5] [--rescore-factor 4]
+    python benchmarks/retrieval_recall.py --embeddings-cache /tmp/retrieval_embeddings.npz --json report.json
+'''
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from configurations.constants import EMBEDDING_DIMENSIONS, EMBEDDING_MODEL, Quantization
+from utilities.document_helpers import create_document, get_documents_chunks_from_documents
+from utilities.vector_index import QuantizedIndex, shorten_embeddings
+
+DOCUMENTS_DIR = REPO_ROOT / 'benchmarks' / 'data' / 'documents'
+QUESTIONS_PATH = REPO_ROOT / 'benchmarks' / 'data' / 'retrieval_questions.jsonl'
+
+
+def load_chunks(documents_dir: Path, chunk_size: int) -> list[dict]:
+    '''Chunk the files of a directory like the app does, returning the source file and text of each chunk.'''
+    documents = [
+        create_document({'file_name': path.name, 'content': path.read_text()})
+        for path in sorted(documents_dir.glob('*.txt'))]
+    chunks = get_documents_chunks_from_documents(documents, chunk_size=chunk_size, chunk_overlap=0)
+    return [{'source': chunk.metadata['source'], 'text': chunk.page_content} for chunk in chunks]
+
+
+def load_questions(path: Path, chunks: list[dict]) -> list[dict]:
+    '''Read the labelled questions, and find the chunks holding the passages relevant to each of them.'''
+    questions = []
+    for line in path.read_text().splitlines():
+        if not line.strip():
+            continue
+        question = json.loads(line)
+        question['relevant_chunks'] = {
+            i for i, chunk in enumerate(chunks) for relevant in question['relevant']
+            if chunk['source'] == relevant['source'] and relevant['passage'] in chunk['text']}
+        if not question['relevant_chunks']:
+            raise ValueError(f'No chunk holds the passages labelled as relevant to "{question["question"]}"')
+        questions.append(question)
+    return questions
+
+
+def embed(texts: list[str], model: str, dimensions: int, cache_path: Path | None) -> np.ndarray:
+    '''Embed texts at full precision, reading and writing them from and to cache_path if given.'''
+    key = json.dumps([model, dimensions, texts])
+    if cache_path is not None and cache_path.exists():
+        cached = np.load(cache_path)
+        if str(cached['key']) == key:
+            return cached['embeddings']
+
+    from utilities.embeddings import BatchedOpenAIEmbeddings
+
+    embeddings = np.asarray(BatchedOpenAIEmbeddings(model=model, dimensions=dimensions).embed_documents(texts), dtype=np.float32)
+    if cache_path is not None:
+        np.savez(cache_path, key=key, embeddings=embeddings)
+    return embeddings
+
+
+def time_search(dimensions: int, quantization: Quantization, rescore_factor: int, num_vectors: int, k: int, num_queries: int = 20) -> float:
+    '''Mean time of a search in an index of num_vectors random embeddings, in milliseconds.'''
+    rng = np.random.default_rng(0)
+    index = QuantizedIndex.from_embeddings(shorten_embeddings(rng.standard_normal((num_vectors, dimensions), dtype=np.float32), dimensions), quantization)
+    queries = shorten_embeddings(rng.standard_normal((num_queries, dimensions), dtype=np.float32), dimensions)
+    index.search(queries[0], k, rescore_factor)
+
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query, k, rescore_factor)
+    return (time.perf_counter() - start) / num_queries * 1000
+
+
+def evaluate(
+    chunk_embeddings: np.ndarray,
+    question_embeddings: np.ndarray,
+    questions: list[dict],
+    dimensions: int,
+    quantization: Quantization,
+    rescore_factor: int,
+    ks: list[int],
+    baseline_rankings: list[np.ndarray] | None
+) -> tuple[dict, list[np.ndarray]]:
+    '''Search the chunks for each question with a configuration, returning its metrics and the ranking of each question.'''
+    index = QuantizedIndex.from_embeddings(shorten_embeddings(chunk_embeddings, dimensions), quantization)
+    queries = shorten_embeddings(question_embeddings, dimensions)
+    rankings = [index.search(query, max(ks), rescore_factor)[0] for query in queries]
+
+    metrics = {'bytes_per_embedding': index.nbytes / len(index)}
+    for k in ks:
+        metrics[f'recall@{k}'] = float(np.mean([
+            len(question['relevant_chunks'] & set(ranking[:k].tolist())) / len(question['relevant_chunks'])
+            for question, ranking in zip(questions, rankings)]))
+        if baseline_rankings is not None:
+            metrics[f'overlap@{k}'] = float(np.mean([
+                len(set(ranking[:k].tolist()) & set(baseline[:k].tolist())) / min(k, len(baseline))
+                for ranking, baseline in zip(rankings, baseline_rankings)]))
+    return metrics, rankings
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents-dir', type=Path, default=DOCUMENTS_DIR, help='directory of the .txt documents to chunk')
+    parser.add_argument('--questions', type=Path, default=QUESTIONS_PATH, help='JSONL file of questions with their relevant passages')
+    parser.add_argument('--chunk-size', type=int, default=150, help='max tokens per chunk')
+    parser.add_argument('--model', default=EMBEDDING_MODEL, help='embedding model')
+    parser.add_argument('--dimensions', type=int, nargs='+', default=[EMBEDDING_DIMENSIONS, 512, 256],
+                        help='numbers of dimensions to evaluate, the largest one being requested from the API and the others shortened from it')
+    parser.add_argument('--quantization', type=Quantization, nargs='+', default=list(Quantization), help='quantizations to evaluate')
+    parser.add_argument('--rescore-factor', type=int, default=4, help='re-score the top k * rescore_factor candidates of quantized indexes')
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 3, 5], help='numbers of chunks retrieved')
+    parser.add_argument('--search-vectors', type=int, default=100_000, help='size of the random index searched to time searches (0: skip)')
+    parser.add_argument('--embeddings-cache', type=Path, help='file caching the embeddings of the chunks and questions')
+    parser.add_argument('--json', type=Path, help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    chunks = load_chunks(args.documents_dir, args.chunk_size)
+    questions = load_questions(args.questions, chunks)
+    print(f'{len(questions)} questions over {len(chunks)} chunks of {len({chunk["source"] for chunk in chunks})} documents')
+
+    full_dimensions = max(args.dimensions)
+    embeddings = embed([chunk['text'] for chunk in chunks] + [question['question'] for question in questions], args.model, full_dimensions, args.embeddings_cache)
+    chunk_embeddings, question_embeddings = embeddings[:len(chunks)], embeddings[len(chunks):]
+
+    # rankings and memory at full precision and full dimensions, which the other configurations are compared with
+    baseline, baseline_rankings = evaluate(
+        chunk_embeddings, question_embeddings, questions, full_dimensions, Quantization.FLOAT32, 0, args.k, None)
+
+    report = []
+    columns = [f'recall@{k}' for k in args.k] + [f'overlap@{k}' for k in args.k]
+    print(f'\n{"dimensions":>10} {"quantization":>12} {"rescore":>7} {"bytes":>7} {"memory":>7} {"search ms":>9} ' + ' '.join(f'{c:>10}' for c in columns))
+    for dimensions in sorted(set(args.dimensions), reverse=True):
+        for quantization in [Quantization.FLOAT32, *(q for q in args.quantization if q != Quantization.FLOAT32)]:
+            for rescore_factor in [0] if quantization == Quantization.FLOAT32 else [0, args.rescore_factor]:
+                metrics, _ = evaluate(
+                    chunk_embeddings, question_embeddings, questions, dimensions, quantization, rescore_factor, args.k, baseline_rankings)
+                metrics['memory_reduction'] = baseline['bytes_per_embedding'] / metrics['bytes_per_embedding']
+                if args.search_vectors:
+                    metrics['search_ms'] = time_search(dimensions, quantization, rescore_factor, args.search_vectors, max(args.k))
+                report.append({'dimensions': dimensions, 'quantization': str(quantization), 'rescore_factor': rescore_factor, **metrics})
+
+                print(
+                    f'{dimensions:>10} {quantization:>12} {rescore_factor or "-":>7} {metrics["bytes_per_embedding"]:>7.0f} '
+                    f'{metrics["memory_reduction"]:>6.1f}x {metrics.get("search_ms", float("nan")):>9.2f} ' +
+                    ' '.join(f'{metrics[c]:>10.3f}' for c in columns))
+
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
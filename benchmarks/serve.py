@@ -0,0 +1,50 @@
+'''
+Run the FastAPI app without any cloud credentials: Firestore is replaced by an in-memory fake, the Storage bucket
+serves the files of benchmarks/data/documents to every user, and any bearer token is accepted as the user ID.
+
+Point the app at the local OpenAI stand-in with OPENAI_BASE_URL (see mock_openai.py). Sessions go through the fake Firestore
+unless another store is selected with SESSION_STORE (eg. SESSION_STORE=sqlite, or SESSION_STORE_CACHE=memory).
+
+Usage:
+    OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=mock python benchmarks/serve.py [--port 8000]
+'''
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+DOCUMENTS_DIR = REPO_ROOT / 'benchmarks' / 'data' / 'documents'
+
+sys.path.insert(0, str(REPO_ROOT))
+os.environ.setdefault('SENTRY_DSN', '')
+os.environ.setdefault('LLM_CACHE_ENABLED', 'true')
+
+
+def install_fakes(documents_dir: Path = DOCUMENTS_DIR) -> None:
+    '''Replace the Firebase clients of the firestore module with local fakes, before the app initializes them.'''
+    import firestore
+    from benchmarks.fakes import FakeBucket, FakeFirestoreClient, FakeTokenCache
+
+    firestore.token_cache = FakeTokenCache()
+    firestore.bucket = FakeBucket(documents_dir)
+    firestore.db = FakeFirestoreClient()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--documents-dir', type=Path, default=DOCUMENTS_DIR, help='directory of the files served by the fake bucket')
+    args = parser.parse_args()
+
+    install_fakes(args.documents_dir)
+
+    import uvicorn
+    from main import app
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
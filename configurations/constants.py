@@ -49,9 +49,47 @@ class Component(IntEnum):
     NUM_OF_TOKENS = auto()
     NUM_OF_DOCS = auto()
 
+class IngestionStatus(StrEnum):
+    NOT_STARTED = auto()
+    RUNNING = auto()
+    SUCCEEDED = auto()
+    FAILED = auto()
+
+class Quantization(StrEnum):
+    FLOAT32 = auto()
+    INT8 = auto()
+    BINARY = auto()
+
+
+EMBEDDING_MODEL = 'text-embedding-3-large'
+# text-embedding-3 embeddings can be shortened (eg. to 256 or 512 dimensions) and remain meaningful, trading some
+# retrieval quality for memory and search time (see benchmarks/retrieval_recall.py)
+EMBEDDING_DIMENSIONS = int(os.getenv('EMBEDDING_DIMENSIONS', 1024))
+EMBEDDING_ENCODING = 'cl100k_base'  # tokenizer of the embedding models
+EMBEDDING_MAX_TOKENS_PER_TEXT = 8191  # longer texts are truncated
+# Texts are packed into requests of at most EMBEDDING_MAX_TOKENS_PER_REQUEST tokens and EMBEDDING_MAX_TEXTS_PER_REQUEST texts,
+# sent EMBEDDING_MAX_CONCURRENCY at a time without exceeding EMBEDDING_TOKENS_PER_MINUTE (the rate limit of the account)
+EMBEDDING_MAX_TOKENS_PER_REQUEST = int(os.getenv('EMBEDDING_MAX_TOKENS_PER_REQUEST', 50_000))
+EMBEDDING_MAX_TEXTS_PER_REQUEST = int(os.getenv('EMBEDDING_MAX_TEXTS_PER_REQUEST', 256))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv('EMBEDDING_MAX_CONCURRENCY', 4))
+EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv('EMBEDDING_TOKENS_PER_MINUTE', 1_000_000))
+EMBEDDING_MAX_RETRIES = int(os.getenv('EMBEDDING_MAX_RETRIES', 6))
+
+# Uploaded documents are ingested (downloaded, parsed, chunked and embedded) by background jobs,
+# and retrieval waits for a running job for at most INGESTION_WAIT_TIMEOUT_SECONDS
+INGESTION_MAX_WORKERS = int(os.getenv('INGESTION_MAX_WORKERS', 4))
+INGESTION_WAIT_TIMEOUT_SECONDS = float(os.getenv('INGESTION_WAIT_TIMEOUT_SECONDS', 300))
+# Once the documents are ingested, an organization profile is built from them: a digest of each document and the chunks
+# most relevant to each of the GRANT_APPLICATION_QUESTIONS_EXAMPLES, which are then answered from the digests and their
+# ORG_PROFILE_NUM_CHUNKS most relevant chunks without searching the vector store
+IS_ORG_PROFILE_ENABLED = os.getenv('ORG_PROFILE', 'False').lower() in ('true', 't', '1', 'yes')
+ORG_PROFILE_NUM_CHUNKS = int(os.getenv('ORG_PROFILE_NUM_CHUNKS', 1))
 
 DEFAULT_NUM_OF_TOKENS = 1000
 DEFAULT_NUM_OF_DOC_CHUNKS = 2
+# Chunks whose text is similar to a previous chunk's above this threshold (estimated Jaccard similarity of their word
+# shingles, eg. the same passage in several versions of an application) are not embedded (0: keep all chunks)
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', 0.8))
 
 
 GRANT_APPLICATION_QUESTIONS_EXAMPLES = [
@@ -67,17 +105,55 @@ GRANT_APPLICATION_QUESTIONS_EXAMPLES = [
 
 GPT_MODEL = 'gpt-4-turbo-preview' if os.getenv('GPT_MODEL', 'gpt-3.5') not in ('3.5', 'gpt-3.5', 'gpt-3.5-turbo') else 'gpt-3.5-turbo'
 IS_DEV_MODE = os.getenv('DEV', 'False').lower() in ('true', 't', '1', 'yes')
+# Several workers or replicas serve the same sessions: cached session states are checked against the revision in the
+# session store on every request, and responses carry a session affinity key for the load balancer
+IS_MULTI_REPLICA = os.getenv('MULTI_REPLICA', 'False').lower() in ('true', 't', '1', 'yes')
+SESSION_AFFINITY_HEADER = 'x-publico-session'
+SESSION_AFFINITY_COOKIE = os.getenv('SESSION_AFFINITY_COOKIE', '')  # also set the key as this cookie, if not empty
+# Directory of the local SQLite databases (session store, LLM response and extraction caches) by default, out of the
+# working directory so that session states, cached responses and document text are never committed with the code
+LOCAL_DATA_DIRECTORY = os.getenv('LOCAL_DATA_DIRECTORY', os.path.join(os.path.expanduser('~'), '.cache', 'publico'))
+
+# Chat responses are streamed as soon as they are generated, and workers never sleep to pace them: the client is sent,
+# in this header, the delay to leave between rendering consecutive messages of a stream
+RENDER_DELAY_HINT_HEADER = 'X-Render-Delay-Hint-Ms'
+RENDER_DELAY_HINT_MS = int(os.getenv('RENDER_DELAY_HINT_MS', 150))
+# The questions of an application form submitted at once (at most BATCH_ANSWER_MAX_QUESTIONS) are answered
+# BATCH_ANSWER_MAX_CONCURRENCY at a time, the tokens of all the answers being streamed as they are generated
+BATCH_ANSWER_MAX_QUESTIONS = int(os.getenv('BATCH_ANSWER_MAX_QUESTIONS', 30))
+BATCH_ANSWER_MAX_CONCURRENCY = int(os.getenv('BATCH_ANSWER_MAX_CONCURRENCY', 4))
+# Generations of answers with a word limit are budgeted in tokens: their max_tokens allows WORD_LIMIT_TOKENS_PER_WORD
+# tokens per word of WORD_LIMIT_MAX_OVERRUN times the limit, the headroom for their stream to be stopped at the limit
+# (and the answer trimmed to it) rather than cut by max_tokens
+WORD_LIMIT_TOKENS_PER_WORD = float(os.getenv('WORD_LIMIT_TOKENS_PER_WORD', 2))
+WORD_LIMIT_MAX_OVERRUN = float(os.getenv('WORD_LIMIT_MAX_OVERRUN', 1.2))
+# Edits of an answer are stored as the changes to the answer before them. If EDIT_COALESCE_SECONDS is set, the edits
+# made within that many seconds of the previous one (eg. autosaves while typing) replace it, losing the answer in between
+EDIT_COALESCE_SECONDS = float(os.getenv('EDIT_COALESCE_SECONDS', 0))
+
+# Vector store shared by the replicas: a Chroma server (CHROMA_HOST) or an index persisted on disk (CHROMA_PERSIST_DIRECTORY),
+# and an in-memory index of the process when neither is set
+CHROMA_HOST = os.getenv('CHROMA_HOST', '')
+CHROMA_PORT = int(os.getenv('CHROMA_PORT', 8000))
+CHROMA_PERSIST_DIRECTORY = os.getenv('CHROMA_PERSIST_DIRECTORY', '')
+CHROMA_COLLECTION = os.getenv('CHROMA_COLLECTION', 'publico_documents')
+# Embeddings are searched at full precision by Chroma (float32), or in in-memory indexes of int8 or binary codes (4x and
+# 32x smaller) whose top k * VECTOR_INDEX_RESCORE_FACTOR candidates are re-scored with the float query (0: no re-scoring).
+# With a shared Chroma, it still stores the full precision embeddings (on disk or on its server) and the indexes of the
+# VECTOR_INDEX_MAX_CACHED_SESSIONS sessions searched most recently are kept in memory, the others being reloaded from it
+VECTOR_INDEX_QUANTIZATION = Quantization(os.getenv('VECTOR_INDEX_QUANTIZATION', Quantization.FLOAT32))
+VECTOR_INDEX_RESCORE_FACTOR = int(os.getenv('VECTOR_INDEX_RESCORE_FACTOR', 4))
+VECTOR_INDEX_MAX_CACHED_SESSIONS = int(os.getenv('VECTOR_INDEX_MAX_CACHED_SESSIONS', 1000))
 
 SERVER_PORT = int(os.getenv('SERVER_PORT', 7860))
 
+# System prompts hold static instructions only, and the retrieved documents are given in a following message, so that
+# all requests share the same prompt prefix, which the provider can serve from its prompt cache
 SYSTEM_PROMPT_FOR_ANSWERING_ORIGINAL_QUESTION = (
     'You are going to help a nonprofit organization that is applying for a grant.\n'
-    'Use the following pieces of context to respond to a grant application question '
+    'Use the pieces of context that follow to respond to a grant application question '
     'in a way that provides a compelling and comprehensive answer from the perspective '
     'of a nonprofit organization applying for grant funding.\n'
-    '----------------\n'
-    '{context}\n'
-    '----------------\n'
     'Make sure to comply with the word limit stated in parentheses at the end of the grant application question as this is crucial! (but do not write the word count itself in the generated answer)'
 )
 
@@ -85,7 +161,5 @@ SYSTEM_PROMPT_FOR_ANSWERING_IMPLICIT_QUESTION = (
     'You are a grantwriting expert who will be helping a non-profit organization applying for a grant. '
     'Please provide your best answer to the following question using the context provided. '
     'Be as concise as possible, using at most one or two lines. '
-    'If you can\'t answer the question, don\'t make something up and simply answer the words \'Not enough information provided.\'.\n'
-    '----------------\n'
-    '{context}'
+    'If you can\'t answer the question, don\'t make something up and simply answer the words \'Not enough information provided.\'.'
 )
@@ -1,16 +1,46 @@
-from langchain.prompts.chat import (
-    ChatPromptTemplate,
-    HumanMessagePromptTemplate,
-    SystemMessagePromptTemplate,
-    AIMessagePromptTemplate
-)
-from langchain.schema.messages import (
-    HumanMessage,
-    SystemMessage
-)
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
 
 from workflow.session_state import Improvement
 
+# LangChain is heavy to import, so prompt classes are only imported when a prompt template is built
+if TYPE_CHECKING:
+    from langchain.prompts.chat import BaseMessagePromptTemplate, ChatPromptTemplate
+
+# Prompts are laid out from the most to the least stable content (static instructions, then the documents of the session,
+# then the content of the current turn), so that consecutive requests share the longest possible prompt prefix, which the
+# provider serves from its prompt cache (cached tokens are recorded in publico_llm_tokens)
+CONTEXT_TEMPLATE = (
+    '----------------\n'
+    '{context}\n'
+    '----------------'
+)
+
+# Appended to every guidance prompt of the user, so that the messages of previous turns are unchanged in the next turns
+WORD_LIMIT_REMINDER_FOR_USER_GUIDANCE = ' (Just make sure to, once again, comply with the word limit of {word_limit} words as this is crucial!)'
+
+
+def escape_template_text(text: str) -> str:
+    '''Escape the braces of text written by the user or the LLM, to use it as is in a prompt template.'''
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+def get_system_message_templates_with_context(system_prompt: str) -> list[BaseMessagePromptTemplate]:
+    '''
+    Get the system message templates of a prompt answering from documents: the system prompt, followed by the documents
+    in a separate message unless the system prompt has its own {context} placeholder (eg. a system prompt set in dev mode)
+        Parameters:
+            system_prompt: the system prompt to use for the chat model
+        Returns:
+            the system message templates of the prompt
+    '''
+    from langchain.prompts.chat import SystemMessagePromptTemplate
+
+    messages = [SystemMessagePromptTemplate.from_template(system_prompt)]
+    if '{context}' not in system_prompt:
+        messages.append(SystemMessagePromptTemplate.from_template(CONTEXT_TEMPLATE))
+    return messages
 
 
 def get_prompt_template_for_generating_original_answer(system_prompt: str) -> ChatPromptTemplate:
@@ -21,9 +51,10 @@ def get_prompt_template_for_generating_original_answer(system_prompt: str) -> Ch
         Returns:
             a prompt template for a chat model to answer a grant application question
     '''
+    from langchain.prompts.chat import ChatPromptTemplate, HumanMessagePromptTemplate
 
     messages = [
-        SystemMessagePromptTemplate.from_template(system_prompt),
+        *get_system_message_templates_with_context(system_prompt),
         HumanMessagePromptTemplate.from_template('{question} ({word_limit} words)'),
     ]
 
@@ -36,6 +67,8 @@ def get_prompt_template_for_comprehensiveness_check_openai_functions() -> ChatPr
         Returns:
             a prompt template for a chat model to check the comprehensiveness of an answer
     '''
+    from langchain.prompts.chat import ChatPromptTemplate, HumanMessagePromptTemplate
+    from langchain.schema.messages import HumanMessage, SystemMessage
 
     sys_msg = (
         'I\'m going to present you with two pieces of information: a question on a grant application, '
@@ -49,19 +82,48 @@ def get_prompt_template_for_comprehensiveness_check_openai_functions() -> ChatPr
     prompt_msgs = [
         SystemMessage(content=sys_msg),
         HumanMessage(
-            content="Make calls to the relevant function to record the missing information and implicit questions in the following input:"
+            content="Make calls to the relevant function to record the missing information and implicit questions in the following input "
+                    "(tips: make sure to answer in the correct format):"
         ),
         HumanMessagePromptTemplate.from_template(
             'Grant application question: {question}\n'
             '----------------\n'
             'Grant application answer: {answer}\n'
         ),
-        HumanMessage(content="Tips: Make sure to answer in the correct format"),
     ]
 
     return ChatPromptTemplate(messages=prompt_msgs, input_variables=["question", "answer"])
 
 
+def get_prompt_template_for_document_digest() -> ChatPromptTemplate:
+    '''
+    Get a prompt template for a chat model to write a digest of a document of a nonprofit using OpenAI functions
+        Returns:
+            a prompt template for a chat model to write the digest of a document
+    '''
+    from langchain.prompts.chat import ChatPromptTemplate, HumanMessagePromptTemplate
+    from langchain.schema.messages import SystemMessage
+
+    sys_msg = (
+        'You are going to help a nonprofit organization that is applying for grants. '
+        'You will be given a document shared by the organization, and your job is to record a concise digest of it '
+        'covering the mission of the organization, its programs, its metrics and its finances. '
+        'Only use information stated in the document, keep the figures and names it gives, '
+        'and leave out anything it does not mention.'
+    )
+    prompt_msgs = [
+        SystemMessage(content=sys_msg),
+        HumanMessagePromptTemplate.from_template(
+            'Document: {source}\n'
+            '----------------\n'
+            '{content}\n'
+            '----------------'
+        ),
+    ]
+
+    return ChatPromptTemplate(messages=prompt_msgs, input_variables=['source', 'content'])
+
+
 def get_prompt_template_for_generating_answer_to_implicit_question(system_prompt: str) -> ChatPromptTemplate:
     '''
     Get a prompt template for a chat model to answer an implicit question
@@ -70,9 +132,10 @@ def get_prompt_template_for_generating_answer_to_implicit_question(system_prompt
         Returns:
             a prompt template for a chat model to answer an implicit question from documents
     '''
+    from langchain.prompts.chat import ChatPromptTemplate, HumanMessagePromptTemplate
 
     messages = [
-        SystemMessagePromptTemplate.from_template(system_prompt),
+        *get_system_message_templates_with_context(system_prompt),
         HumanMessagePromptTemplate.from_template('{question}'),
     ]
 
@@ -85,20 +148,24 @@ def get_prompt_template_for_generating_final_answer() -> ChatPromptTemplate:
         Returns:
             a prompt template for a chat model to generate a final answer
     '''
+    from langchain.prompts.chat import ChatPromptTemplate, HumanMessagePromptTemplate, SystemMessagePromptTemplate
 
     system_template = (
         'You will be given a paragraph which is an answer to a grant application question submitted by a nonprofit.\n'
+        'Improve the answer by incorporating the potentially valuable information contained in the lines that follow the question.\n'
+        'Start your message right away with the new answer without any leading words. '
+        'Make sure to comply with the word limit stated in parentheses at the end of the grant application question as this is crucial! (but do not write the word count itself in the generated answer)'
+    )
+    question_template = (
         'The grant application questions was: "{question} ({word_limit} words)".\n'
-        'Improve the answer by incorporating the potentially valuable information contained in the following lines:\n'
         '----------------\n'
         '{answers_to_implicit_questions}.\n'
-        '----------------\n'
-        'Start your message right away with the new answer without any leading words. '
-        'Make sure to comply with the word limit stated in parentheses at the end of the grant application question as this is crucial! (but do not write the word count itself in the generated answer)'
+        '----------------'
     )
 
     messages = [
         SystemMessagePromptTemplate.from_template(system_template),
+        SystemMessagePromptTemplate.from_template(question_template),
         HumanMessagePromptTemplate.from_template('{original_answer}'),
     ]
 
@@ -111,15 +178,18 @@ def get_prompt_template_for_user_guidance_post_answer(improvements: list[Improve
         Returns:
             a prompt template for a chat model to modify an answer according to user guidance
     '''
+    from langchain.prompts.chat import AIMessagePromptTemplate, ChatPromptTemplate, HumanMessagePromptTemplate
 
     messages = get_prompt_template_for_generating_final_answer().messages
     messages.append(AIMessagePromptTemplate.from_template('{answer}'))
 
+    # previous turns are written exactly as they were sent in their own turn, so that they stay in the cached prompt prefix
     for improvement in improvements[:-1]:
-        messages.append(HumanMessagePromptTemplate.from_template(improvement.user_prompt))
-        messages.append(AIMessagePromptTemplate.from_template(improvement.improved_answer))
+        messages.append(HumanMessagePromptTemplate.from_template(
+            escape_template_text(improvement.user_prompt) + WORD_LIMIT_REMINDER_FOR_USER_GUIDANCE))
+        messages.append(AIMessagePromptTemplate.from_template(escape_template_text(improvement.improved_answer)))
 
-    messages.append(HumanMessagePromptTemplate.from_template(improvements[-1].user_prompt +
-        ' (Just make sure to, once again, comply with the word limit of {word_limit} words as this is crucial!)'))
+    messages.append(HumanMessagePromptTemplate.from_template(
+        escape_template_text(improvements[-1].user_prompt) + WORD_LIMIT_REMINDER_FOR_USER_GUIDANCE))
 
     return ChatPromptTemplate.from_messages(messages)
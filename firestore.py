@@ -2,20 +2,13 @@ import logging
 import json
 import base64
 from os import environ
-from dataclasses import asdict, fields, is_dataclass
-from enum import Enum
 from dotenv import load_dotenv
 
 from fastapi import HTTPException
-import firebase_admin
-from firebase_admin import credentials, firestore, storage, auth
 
-from workflow.session_state import SessionState
+from utilities.instrumentation import span
+from utilities.token_cache import VerifiedTokenCache
 
-# Logging Configuration
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Firebase Configuration
@@ -24,17 +17,49 @@ SERVER_COLLECTION = 'server_session_states'
 
 load_dotenv()  # This loads the environment variables from the .env file
 
-# Make sure to set FIREBASE_CREDENTIALS_B64 in the environment when running the server locally
-# This is the base64 encoded version of the Firebase credentials JSON file
-# Run `base64 -i <path_to_credentials.json>` to get the base64 string
-cred_b64 = environ.get('FIREBASE_CREDENTIALS_B64')
-cred_json = base64.b64decode(cred_b64)
-cred_dict = json.loads(cred_json)
+# Firestore client and Storage bucket, created by initialize_firebase() from the app's lifespan hook (or on first use)
+db = None
+bucket = None
 
-# Firebase Initialization
-cred = credentials.Certificate(cred_dict)
-firebase_admin.initialize_app(cred, {'storageBucket': STORAGE_BUCKET})
-db = firestore.client()
+# Cache of verified ID tokens, created by initialize_firebase() for the project of the Firebase credentials
+token_cache: VerifiedTokenCache | None = None
+
+
+def initialize_firebase() -> None:
+    '''Initialize the Firebase app and the Firestore client, importing firebase_admin only now to keep cold starts fast.'''
+    global db, bucket, token_cache
+    if db is not None:
+        return
+
+    import firebase_admin
+    from firebase_admin import credentials, firestore, storage
+
+    # Make sure to set FIREBASE_CREDENTIALS_B64 in the environment when running the server locally
+    # This is the base64 encoded version of the Firebase credentials JSON file
+    # Run `base64 -i <path_to_credentials.json>` to get the base64 string
+    cred_b64 = environ.get('FIREBASE_CREDENTIALS_B64')
+    cred_json = base64.b64decode(cred_b64)
+    cred_dict = json.loads(cred_json)
+
+    # Firebase Initialization
+    cred = credentials.Certificate(cred_dict)
+    firebase_admin.initialize_app(cred, {'storageBucket': STORAGE_BUCKET})
+    token_cache = VerifiedTokenCache(project_id=cred_dict['project_id'])
+    token_cache.public_keys.start_background_refresh()
+
+    bucket = storage.bucket()
+    db = firestore.client()
+    logger.info('Firebase initialized')
+
+
+def get_db():
+    initialize_firebase()
+    return db
+
+
+def get_bucket():
+    initialize_firebase()
+    return bucket
 
 
 def authenticate_request(authorization: str | None) -> str:
@@ -44,111 +69,50 @@ def authenticate_request(authorization: str | None) -> str:
     # Extract the token from the Authorization header
     token = authorization.split(" ")[1]
 
-    # Validate the token and decode it
+    initialize_firebase()
+
+    # Validate the token and decode it, which is a dict lookup for tokens that were already verified
     try:
-        decoded_token = auth.verify_id_token(token)
-        user_id = decoded_token['uid']  # Extract user ID from the token
-        logger.info(f"User ID retrieved from token: {user_id}")
+        user_id = token_cache.get_user_id(token)
+        logger.debug(f"User ID retrieved from token: {user_id}")
         return user_id
     except Exception as e:
         raise HTTPException(status_code=403, detail="Invalid token") from e
 
-def fetch_document(collection, document_id):
-    doc_ref = db.collection(collection).document(document_id)
-    doc = doc_ref.get()
-    if doc.exists:
-        return doc.to_dict()
-    else:
-        logger.info(f'No such document with ID: {document_id}')
-        return None
-
-def get_files_for_user(file_names: list[str], user_id: str) -> list[dict[str, str]]:
+def get_file_blobs_for_user(file_names: list[str], user_id: str) -> dict:
+    '''Fetch the metadata (generation, MD5 hash...) of the files of a user in Storage without downloading them, by file name.'''
     user_folder = f'chat_documents/{user_id}/'
-    bucket = storage.bucket()
-    logger.info(f'Fetching files for user {user_id} for files: {file_names}')
-    file_contents = []
+    bucket = get_bucket()
+    blobs = {}
     for file_name in file_names:
-        file_path = f'{user_folder}{file_name}'
-        blob = bucket.blob(file_path)
-        if blob.exists():
-            try:
-                if file_name.endswith('.txt'):
-                    content = blob.download_as_text()
-                elif file_name.endswith('.docx'):
-                    content = blob.download_as_bytes()
-                else:
-                    logger.error(f'Unsupported file type for {file_name}')
-                    continue
-                file_contents.append(content)
-            except Exception as e:
-                logger.error(f'Error reading content from {file_path}: {e}')
-
-    logger.info(f'Fetched {len(file_contents)} files for user {user_id}')
-    return [{'file_name': file_name, 'content': content} for file_name, content in zip(file_names, file_contents)]
-
-def convert_value(type_hint, value):
-    if not isinstance(type_hint, type):
-        return [convert_value(dict, item) for item in value] if isinstance(value, list) else value
-
-    try:
-        if is_dataclass(type_hint):
-            return deserialize_to_dataclass(type_hint, value)
-        if isinstance(value, list):
-            return deserialize_list(type_hint, value)
-        if issubclass(type_hint, Enum):
-            return type_hint[value.upper()] if isinstance(value, str) else type_hint(value)
-    except Exception as e:
-        logger.error(f"Failed to convert value '{value}' with type_hint '{type_hint}': {e}")
-        return None
-    return value
-
-def deserialize_list(field_type, value):
-    element_type = field_type.__args__[0] if hasattr(field_type, '__args__') else dict
-    return [convert_value(element_type, item) for item in value]
-
-def deserialize_to_dataclass(cls, data):
-    if not isinstance(data, dict):
-        return data
-
-    field_types = {f.name: f.type for f in fields(cls)}
-    converted_data = {}
-
-    for key, value in data.items():
-        type_hint = field_types.get(key)
-        if not type_hint:
-            logger.debug(f"Field '{key}' not defined in dataclass '{cls.__name__}'. Skipping...")
+        if not file_name.endswith(('.txt', '.docx')):
+            logger.error(f'Unsupported file type for {file_name}')
             continue
-
         try:
-            converted_data[key] = deserialize_list(type_hint, value) if isinstance(value, list) else convert_value(type_hint, value)
+            if (blob := bucket.get_blob(f'{user_folder}{file_name}')) is not None:
+                blobs[file_name] = blob
         except Exception as e:
-            logger.error(f"Error processing field '{key}' in dataclass '{cls.__name__}': {e}", exc_info=True)
-            converted_data[key] = None
+            logger.error(f'Error reading metadata of {user_folder}{file_name}: {e}')
+    return blobs
 
-    return cls(**converted_data)
 
-def serialize_for_firestore(obj):
-    if is_dataclass(obj):
-        return {k: serialize_for_firestore(v) for k, v in asdict(obj).items() if v is not None}
-    return serialize_iterable_for_firestore(obj) if isinstance(obj, (list, tuple, dict)) else obj
+def download_file(file_name: str, blob) -> str | bytes:
+    '''Download the content of a file of a user: the text of .txt files, the bytes of .docx files.'''
+    with span('file_download', file_type=file_name.rsplit('.', 1)[-1]):
+        # download the version whose metadata was fetched, rather than a newer one uploaded in the meantime
+        if file_name.endswith('.txt'):
+            return blob.download_as_text(if_generation_match=blob.generation)
+        return blob.download_as_bytes(if_generation_match=blob.generation)
 
-def serialize_iterable_for_firestore(obj):
-    if isinstance(obj, dict):
-        return {k: serialize_for_firestore(v) for k, v in obj.items() if v is not None}
-    else:  # it's a list or tuple
-        return [serialize_for_firestore(v) for v in obj if v is not None]
 
-def retrieve_session_state_from_firestore(session_id: str) -> SessionState:
-    session_state_raw = fetch_document(SERVER_COLLECTION, session_id)
-    if session_state_raw is None:
-        raise ValueError(f'No session state found in Firestore for session_id={session_id}')
-
-    try:
-        session_state = deserialize_to_dataclass(SessionState, session_state_raw)
-        return session_state
-    except Exception as e:
-        raise ValueError(f'Error deserializing session state for session_id={session_id}\n{e}') from e
+def get_files_for_user(file_names: list[str], user_id: str) -> list[dict[str, str]]:
+    logger.info(f'Fetching files for user {user_id} for files: {file_names}')
+    file_contents = []
+    for file_name, blob in get_file_blobs_for_user(file_names, user_id).items():
+        try:
+            file_contents.append({'file_name': file_name, 'content': download_file(file_name, blob)})
+        except Exception as e:
+            logger.error(f'Error reading content from {blob.name}: {e}')
 
-def update_chat_session_in_firestore(session_state: SessionState):
-    session_state_serialized = serialize_for_firestore(session_state)
-    db.collection(SERVER_COLLECTION).document(session_state.session_id).set(session_state_serialized, merge=True)
+    logger.info(f'Fetched {len(file_contents)} files for user {user_id}')
+    return file_contents
@@ -1,26 +1,83 @@
+from contextlib import asynccontextmanager
+from contextvars import copy_context
 from enum import IntEnum, auto
+import asyncio
+import json
+import os
 import uuid
 import logging
 import traceback
 from threading import Thread
-from asyncio import Queue, sleep
+from asyncio import Queue
 
 import sentry_sdk
-from fastapi import FastAPI, HTTPException, Header
+from sentry_sdk.integrations.fastapi import FastApiIntegration
+from sentry_sdk.integrations.starlette import StarletteIntegration
+from fastapi import FastAPI, HTTPException, Header, Request, Response
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import UUID4, BaseModel
-
-from configurations.constants import JOB_DONE, Component
-from firestore import authenticate_request, update_chat_session_in_firestore, retrieve_session_state_from_firestore
-from utilities.document_helpers import add_files_to_vector_store
+from pydantic import UUID4, BaseModel, Field
+
+from configurations.constants import (
+    BATCH_ANSWER_MAX_QUESTIONS,
+    IS_MULTI_REPLICA,
+    JOB_DONE,
+    RENDER_DELAY_HINT_HEADER,
+    RENDER_DELAY_HINT_MS,
+    SESSION_AFFINITY_COOKIE,
+    SESSION_AFFINITY_HEADER,
+    Component
+)
+from firestore import authenticate_request, initialize_firebase
+from message_generation.batch_answers import BatchStream, generate_answers_to_questions
+from persistence.compaction import load_archived_question
+from persistence.session_store import SessionConflictError, close_session_store, get_session_store
+from utilities.document_helpers import get_vector_store
+from utilities.ingestion import get_ingestion_job, needs_ingestion, shutdown_ingestion, start_ingestion
+from utilities.logging_utils import LogCategory, configure_logging, log_lazy, stop_logging
+from utilities.instrumentation import (
+    METRICS_CONTENT_TYPE,
+    current_step_id,
+    get_metrics,
+    request_span,
+    setup_tracing,
+    traces_sampler
+)
+from utilities.usage_ledger import (
+    UsageTotals,
+    check_budget,
+    close_user_usage_accountant,
+    get_totals_by_step,
+    get_user_usage_accountant
+)
 from workflow.chatbot_step import EditorContentType
-from workflow.session_state import SessionState
+from workflow.session_state import IngestionContext, SessionState
 from workflow.steps import get_chatbot_step
 
+configure_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    '''Initialize Firebase, the session store and the vector store once the server starts rather than at import time, to keep cold starts fast.'''
+    setup_tracing()
+    initialize_firebase()
+    get_session_store()
+    get_vector_store()
+    yield
+    shutdown_ingestion()
+    close_user_usage_accountant()  # writes the usage of the users not stored yet, before the session store is closed
+    close_session_store()  # flushes the sessions waiting to be persisted in write-behind mode
+
+    from utilities.extraction_cache import close_extraction_cache
+    from utilities.llm_cache import close_llm_cache
+    close_llm_cache()
+    close_extraction_cache()
+    stop_logging()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:3000",  # Local development
@@ -33,23 +90,41 @@ app.add_middleware(
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"],)
+    allow_headers=["*"],
+    expose_headers=[SESSION_AFFINITY_HEADER, RENDER_DELAY_HINT_HEADER],)
 
 
-# create a dict of sessions to session state
+@app.middleware('http')
+async def trace_request(request: Request, call_next):
+    with request_span(f'{request.method} {request.url.path}', request.headers):
+        return await call_next(request)
+
+
+# create a dict of sessions to session state, which is a cache of the session store
+# (checked against the store on every request in multi-replica mode, as another replica may have updated the session)
 sessions: dict[UUID4, SessionState] = {}
 
 sentry_sdk.init(
-    dsn="https://9975d9646ca4c2e0a43c7dae8f11d2d0@o4507169705951232.ingest.de.sentry.io/4507169726988368",
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for performance monitoring.
-    traces_sample_rate=1.0,
+    # Set SENTRY_DSN to an empty string to disable Sentry (eg. when benchmarking locally)
+    dsn=os.getenv('SENTRY_DSN', "https://9975d9646ca4c2e0a43c7dae8f11d2d0@o4507169705951232.ingest.de.sentry.io/4507169726988368"),
+    # Decide per request whether its transaction is captured for performance monitoring
+    # (TRACES_SAMPLE_RATE of requests, and all requests sent with the x-publico-trace header)
+    traces_sampler=traces_sampler,
     # Set profiles_sample_rate to 1.0 to profile 100%
     # of sampled transactions.
     # We recommend adjusting this value in production.
     profiles_sample_rate=1.0,
+    # Only enable the integrations we use, as auto-enabling integrations imports every supported library
+    # that is installed (LangChain, OpenAI, SQLAlchemy, ...) at startup, which slows down cold starts
+    auto_enabling_integrations=False,
+    integrations=[StarletteIntegration(), FastApiIntegration()],
 )
 
+@app.get("/metrics")
+async def metrics() -> Response:
+    return Response(content=get_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
 @app.get("/sentry-debug")
 async def trigger_error():
     division_by_zero = 1 / 0
@@ -82,7 +157,7 @@ async def async_queue_generator(queue: Queue):
         except Exception as e:
             logger.error(f'Error in async_queue_generator: {e}')
             logger.error(traceback.format_exc())
-            await sleep(0.01)
+            break
 
 class NewSessionResponse(BaseModel):
     session_id: UUID4
@@ -99,25 +174,94 @@ class AfterChatResponse(BaseModel):
     initial_message: str
     components: set[Component]
     updated_content: UpdatedEditorContent | None
+    ingestion_job_id: str | None = None  # running ingestion job, whose progress is streamed by /ingestion/{job_id}/events
 
 class AfterChatRequest(BaseModel):
     session_id: UUID4
 
+class IngestionStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    num_files: int
+    num_files_processed: int
+    num_chunks: int
+    num_chunks_embedded: int
+    error: str | None = None
+
+    @classmethod
+    def from_context(cls, context: IngestionContext) -> 'IngestionStatusResponse':
+        return cls(
+            job_id=context.job_id,
+            status=context.status,
+            num_files=context.num_files,
+            num_files_processed=context.num_files_processed,
+            num_chunks=context.num_chunks,
+            num_chunks_embedded=context.num_chunks_embedded,
+            error=context.error)
+
 class EditAnswerRequest(BaseModel):
     session_id: UUID4
     question_index: int
     answer: str
 
+class AnswerHistoryResponse(BaseModel):
+    question: str | None
+    word_limit: str | None
+    answer: str | None  # answer first generated
+    edited_answers: list[str]  # answer after each edit, from the first to the last (the current answer)
+
+class BatchQuestion(BaseModel):
+    question: str = Field(min_length=1)
+    word_limit: int = Field(gt=0)
+
+class BatchAnswerRequest(BaseModel):
+    session_id: UUID4
+    questions: list[BatchQuestion] = Field(min_length=1, max_length=BATCH_ANSWER_MAX_QUESTIONS)
+
+class StepUsage(BaseModel):
+    prompt_tokens: int
+    cached_tokens: int
+    completion_tokens: int
+    embedding_tokens: int
+    cost_usd: float
+
+    @classmethod
+    def from_totals(cls, totals: UsageTotals) -> 'StepUsage':
+        return cls(
+            prompt_tokens=totals.prompt_tokens,
+            cached_tokens=totals.cached_tokens,
+            completion_tokens=totals.completion_tokens,
+            embedding_tokens=totals.embedding_tokens,
+            cost_usd=totals.cost_usd)
+
+class UsageResponse(BaseModel):
+    session: dict[str, StepUsage]  # usage of the session per workflow step
+    session_cost_usd: float
+    user_today: dict[str, StepUsage]  # usage of the user today (UTC) per workflow step, in all their sessions
+    user_cost_usd_today: float
+
+
+def is_cached_session_state_stale(session_id: str) -> bool:
+    stored_revision = get_session_store().load_revision(str(session_id))
+    return stored_revision is not None and stored_revision > sessions[session_id].revision
+
 
 def get_session_state(session_id: str) -> SessionState:
+    if IS_MULTI_REPLICA and session_id in sessions and is_cached_session_state_stale(session_id):
+        logging.info(f'Session state of session_id={session_id} was updated by another replica')
+        del sessions[session_id]
+
     if session_id not in sessions:
-        logging.info(f'Retrieving session state from Firestore for session_id={session_id}')
+        logging.info(f'Retrieving session state from the session store for session_id={session_id}')
 
         try:
-            session_state = retrieve_session_state_from_firestore(str(session_id))
+            session_state = get_session_store().get(str(session_id))
+            if session_state is None:
+                raise ValueError(f'No session state found for session_id={session_id}')
             sessions[session_id] = session_state
-            if session_state.uploaded_files:
-                add_files_to_vector_store(session_state)
+            # make sure the documents are in the vector store, in the background (unless a job has ingested them or is on it)
+            if needs_ingestion(session_state):
+                start_ingestion(session_state)
         except Exception as e:
             if isinstance(e, ValueError):
                 logging.error(f'Failed to retrieve session state: {e}')
@@ -129,6 +273,27 @@ def get_session_state(session_id: str) -> SessionState:
     return sessions[session_id]
 
 
+def save_session_state(state: SessionState) -> None:
+    try:
+        get_session_store().put(state)
+    except SessionConflictError as e:
+        logging.error(f'Failed to save session state: {e}')
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+def set_session_affinity(response: Response, session_id: UUID4) -> None:
+    '''
+    Set the session affinity key on a response, which clients send back in the SESSION_AFFINITY_HEADER header
+    (or SESSION_AFFINITY_COOKIE cookie) of their requests so that a load balancer can route a session to the same replica
+    '''
+    if not IS_MULTI_REPLICA:
+        return
+
+    response.headers[SESSION_AFFINITY_HEADER] = str(session_id)
+    if SESSION_AFFINITY_COOKIE:
+        response.set_cookie(SESSION_AFFINITY_COOKIE, str(session_id), secure=True, httponly=True, samesite='none')
+
+
 def get_updated_content(state: SessionState) -> UpdatedEditorContent | None:
     updated_content = None
 
@@ -153,24 +318,46 @@ def get_updated_content(state: SessionState) -> UpdatedEditorContent | None:
 
 
 def handle_chat_request(request: ChatRequest, queue: Queue):
-    user_input = request.user_input.input_value
-    state = get_session_state(request.session_id)
-    chatbot_step = get_chatbot_step(state.current_step_id)
-
-    if save_fn := chatbot_step.save_event_outcome_fn:
-        save_fn(state, user_input)
-
-    for fn in chatbot_step.get_generate_chatbot_messages_fns_for_trigger(trigger=state.last_user_input):
-        fn(state, queue)
-
-    update_chat_session_in_firestore(state)
-    queue.put_nowait(JOB_DONE)
+    try:
+        user_input = request.user_input.input_value
+        state = get_session_state(request.session_id)
+        current_step_id.set(state.current_step_id)
+        check_budget(state)
+        chatbot_step = get_chatbot_step(state.current_step_id)
+
+        if save_fn := chatbot_step.save_event_outcome_fn:
+            save_fn(state, user_input)
+
+        for fn in chatbot_step.get_generate_chatbot_messages_fns_for_trigger(trigger=state.last_user_input):
+            fn(state, queue)
+
+        save_session_state(state)
+    except Exception as e:
+        logger.error(f'Error handling chat request for session_id={request.session_id}: {e}', exc_info=True)
+    finally:
+        # always end the stream, otherwise the client waits for it forever
+        queue.put_nowait(JOB_DONE)
+
+
+def handle_batch_answer_request(request: BatchAnswerRequest, state: SessionState, stream: BatchStream):
+    try:
+        current_step_id.set('batch_answer')
+        check_budget(state)
+        generate_answers_to_questions(
+            state, [(question.question, question.word_limit) for question in request.questions], stream)
+        save_session_state(state)
+    except Exception as e:
+        logger.error(f'Error handling batch answer request for session_id={request.session_id}: {e}', exc_info=True)
+        stream.put_event('error', detail='Failed to answer the questions')
+    finally:
+        # always end the stream, otherwise the client waits for it forever
+        stream.close()
 
 
 '''API Endpoints'''
 
 @app.post('/new_session')
-async def new_session(authorization: str = Header(None)) -> NewSessionResponse:
+async def new_session(response: Response, authorization: str = Header(None)) -> NewSessionResponse:
     logger.info(f'New session request')
     user_id = authenticate_request(authorization=authorization)
 
@@ -179,13 +366,15 @@ async def new_session(authorization: str = Header(None)) -> NewSessionResponse:
 
     state = SessionState(session_id=str(session_id), user_id=user_id)
     sessions[session_id] = state
+    current_step_id.set(state.current_step_id)
 
     chatbot_step = get_chatbot_step(state.current_step_id)
 
     initial_message = chatbot_step.get_initial_chatbot_message(state)
     components=chatbot_step.get_components(state)
 
-    update_chat_session_in_firestore(state)
+    save_session_state(state)
+    set_session_affinity(response, session_id)
     return NewSessionResponse(session_id=session_id, initial_message=initial_message, components=components)
 
 
@@ -203,15 +392,39 @@ async def chat(request: ChatRequest, authorization: str = Header(None)) -> Strea
         None)
 
     queue = Queue()
-    Thread(target=handle_chat_request, kwargs=dict(request=request, queue=queue)).start()
+    # run in a copy of the current context so that the worker thread's spans belong to the request's trace
+    Thread(target=copy_context().run, args=(handle_chat_request,), kwargs=dict(request=request, queue=queue)).start()
+
+    response = StreamingResponse(content=async_queue_generator(queue=queue), media_type="text/event-stream")
+    response.headers[RENDER_DELAY_HINT_HEADER] = str(RENDER_DELAY_HINT_MS)
+    set_session_affinity(response, request.session_id)
+    return response
+
+
+@app.post("/batch_answer")
+async def batch_answer(request: BatchAnswerRequest, authorization: str = Header(None)) -> StreamingResponse:
+    logger.info(f'Batch answer request for session_id={request.session_id}: {len(request.questions)} questions')
+    user_id = authenticate_request(authorization)
+
+    state = get_session_state(request.session_id)
+    if state.user_id != user_id:
+        raise HTTPException(status_code=403, detail=f'Session {request.session_id} belongs to another user')
+
+    queue = Queue()
+    stream = BatchStream(queue=queue, loop=asyncio.get_running_loop())
+    # run in a copy of the current context so that the worker threads' spans belong to the request's trace
+    Thread(target=copy_context().run, args=(handle_batch_answer_request,), kwargs=dict(request=request, state=state, stream=stream)).start()
 
-    return StreamingResponse(content=async_queue_generator(queue=queue), media_type="text/event-stream")
+    response = StreamingResponse(content=async_queue_generator(queue=queue), media_type="application/x-ndjson")
+    set_session_affinity(response, request.session_id)
+    return response
 
 
 @app.post("/after_chat")
-async def after_chat(request: AfterChatRequest) -> AfterChatResponse:
+async def after_chat(request: AfterChatRequest, response: Response) -> AfterChatResponse:
     logger.info(f'After chat request: {request}')
     state = get_session_state(request.session_id)
+    current_step_id.set(state.current_step_id)
     
     chatbot_step = get_chatbot_step(state.current_step_id)
 
@@ -222,21 +435,103 @@ async def after_chat(request: AfterChatRequest) -> AfterChatResponse:
     chatbot_step.initialize_step_func(state)
     logger.info(f'Current chatbot step: {state.current_step_id}')
 
-    response = AfterChatResponse(
+    after_chat_response = AfterChatResponse(
         initial_message=chatbot_step.get_initial_chatbot_message(state),
         components=chatbot_step.get_components(state),
-        updated_content=updated_content
+        updated_content=updated_content,
+        ingestion_job_id=state.ingestion.job_id if state.ingestion.is_running() else None
     )
 
-    update_chat_session_in_firestore(state)
-    return response
+    save_session_state(state)
+    set_session_affinity(response, request.session_id)
+    return after_chat_response
 
 
 @app.post("/edit")
-async def edit(request: EditAnswerRequest) -> None:
+async def edit(request: EditAnswerRequest, response: Response) -> None:
     state = get_session_state(request.session_id)
+    current_step_id.set(state.current_step_id)
 
     state.edit_last_question(request.question_index, request.answer)
-    logger.info(f'Edited answer for question {request.question_index} to: {request.answer}\n')
+    log_lazy(LogCategory.ANSWERS, logging.DEBUG, f'Edited answer for question {request.question_index}', lambda: {
+        'answer': request.answer})
+
+    save_session_state(state)
+    set_session_affinity(response, request.session_id)
+
+
+@app.get("/history/{session_id}/{question_index}")
+async def answer_history(session_id: UUID4, question_index: int, authorization: str = Header(None)) -> AnswerHistoryResponse:
+    user_id = authenticate_request(authorization)
+
+    state = get_session_state(session_id)
+    if state.user_id != user_id or not 0 <= question_index < len(state.questions):
+        raise HTTPException(status_code=404, detail=f'No question {question_index} in session {session_id}')
+
+    # with the fields and edits of the question that were archived when the session state was compacted
+    question = await asyncio.to_thread(load_archived_question, get_session_store(), str(session_id), state.questions[question_index], question_index)
+    return AnswerHistoryResponse(
+        question=question.question,
+        word_limit=question.word_limit,
+        answer=question.get_original_answer(),
+        edited_answers=question.get_edited_answers())
+
+
+@app.get("/ingestion/{job_id}")
+async def ingestion_status(job_id: str, session_id: UUID4 | None = None, authorization: str = Header(None)) -> IngestionStatusResponse:
+    user_id = authenticate_request(authorization)
+
+    if (job := get_ingestion_job(job_id)) is not None:
+        state, context = job.state, job.context
+    elif session_id is not None:
+        # the job ran (or runs) on another replica, which persists its status in the session state
+        state = get_session_state(session_id)
+        context = state.ingestion
+    else:
+        raise HTTPException(status_code=404, detail=f'No ingestion job {job_id}')
+
+    if state.user_id != user_id or context.job_id != job_id:
+        raise HTTPException(status_code=404, detail=f'No ingestion job {job_id}')
+
+    return IngestionStatusResponse.from_context(context)
+
+
+@app.get("/ingestion/{job_id}/events")
+async def ingestion_events(job_id: str, authorization: str = Header(None)) -> StreamingResponse:
+    user_id = authenticate_request(authorization)
+
+    job = get_ingestion_job(job_id)
+    if job is None or job.state.user_id != user_id:
+        raise HTTPException(status_code=404, detail=f'No ingestion job {job_id}')
+
+    async def stream_events():
+        num_events_read = 0
+        while True:
+            events = await asyncio.to_thread(job.wait_for_events, num_events_read, 15)
+            num_events_read += len(events)
+            for event in events:
+                yield f'data: {json.dumps(event)}\n\n'
+
+            if job.is_finished() and num_events_read == len(job.events):
+                break
+            if not events:
+                yield ': keep-alive\n\n'
+
+    return StreamingResponse(content=stream_events(), media_type="text/event-stream")
+
+
+@app.get("/usage/{session_id}")
+async def usage(session_id: UUID4, authorization: str = Header(None)) -> UsageResponse:
+    user_id = authenticate_request(authorization)
+
+    state = get_session_state(session_id)
+    if state.user_id != user_id:
+        raise HTTPException(status_code=404, detail=f'No session {session_id}')
 
-    update_chat_session_in_firestore(state)
+    session_totals = get_totals_by_step(list(state.usage.entries))
+    user_totals = await asyncio.to_thread(get_user_usage_accountant().get_totals_by_step, user_id)
+    return UsageResponse(
+        session={step: StepUsage.from_totals(totals) for step, totals in session_totals.items()},
+        session_cost_usd=sum(totals.cost_usd for totals in session_totals.values()),
+        user_today={step: StepUsage.from_totals(totals) for step, totals in user_totals.items()},
+        user_cost_usd_today=sum(totals.cost_usd for totals in user_totals.values()))
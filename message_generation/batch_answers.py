@@ -0,0 +1,123 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from configurations.constants import BATCH_ANSWER_MAX_CONCURRENCY, JOB_DONE
+from configurations.prompts import get_prompt_template_for_generating_original_answer
+from message_generation.msg_gen import get_documents_for_answering_question, parse_word_limit
+from utilities.ingestion import wait_for_ingestion
+from utilities.instrumentation import span
+from utilities.llm_streaming_utils import stream_from_llm_generation
+from workflow.session_state import GrantApplicationQuestionContext, SessionState
+
+logger = logging.getLogger(__name__)
+
+
+class BatchStream:
+    '''
+    Stream of the answers to a batch of grant application questions, multiplexed as JSON lines (one per event, each
+    holding the 'event' and, for the events of one question, its 'question_index') put on the queue of a streaming
+    response by the threads generating the answers
+    '''
+
+    def __init__(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+        self.queue = queue
+        self.loop = loop
+
+    def put_event(self, event: str, **fields) -> None:
+        # asyncio queues are not thread-safe, so the lines are put on the queue by the event loop of the response
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, json.dumps(dict(event=event, **fields)) + '\n')
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, JOB_DONE)
+
+
+class _QuestionStream:
+    '''Queue the answer to one question of a batch is streamed to, which puts each of its tokens on the batch stream.'''
+
+    def __init__(self, stream: BatchStream, question_index: int):
+        self.stream = stream
+        self.question_index = question_index
+
+    def put_nowait(self, token: str) -> None:
+        self.stream.put_event('token', question_index=self.question_index, content=token)
+
+
+def generate_draft_answer(state: SessionState, question_index: int, stream: BatchStream) -> bool:
+    '''
+    Generate the draft answer to a question of a batch from the most relevant documents, streaming its tokens (trimmed
+    to its word limit as they are streamed), and set it as the original answer of the question
+
+        Parameters:
+            state (SessionState): session state
+            question_index (int): index of the question in the session's questions
+            stream (BatchStream): stream of the batch
+
+        Returns:
+            bool: whether the answer was generated
+    '''
+    question_context = state.questions[question_index]
+    try:
+        documents = get_documents_for_answering_question(state, question_context.question)
+
+        def on_llm_end(answer: str):
+            question_context.answer = answer
+
+        stream_from_llm_generation(
+            prompt=get_prompt_template_for_generating_original_answer(state.get_system_prompt_for_original_question()),
+            queue=_QuestionStream(stream, question_index),
+            on_llm_end=on_llm_end,
+            chain_type='qa_chain',
+            route='original_answer',
+            docs=documents,
+            max_words=parse_word_limit(question_context.word_limit),
+            question=question_context.question,
+            word_limit=question_context.word_limit
+        )
+    except Exception as e:
+        logger.error(f'Error answering question {question_index} of session_id={state.session_id}: {e}', exc_info=True)
+        stream.put_event('error', question_index=question_index, detail=str(e))
+        return False
+
+    stream.put_event(
+        'answer',
+        question_index=question_index,
+        answer=question_context.answer,
+        num_words=len(question_context.answer.split()))
+    return True
+
+
+def generate_answers_to_questions(state: SessionState, questions: list[tuple[str, int]], stream: BatchStream) -> None:
+    '''
+    Answer the questions of an application form at once: each is added to the session's questions, and their draft
+    answers are generated BATCH_ANSWER_MAX_CONCURRENCY at a time, so that the whole form takes about as long as its
+    slowest answer rather than the sum of them
+
+        Parameters:
+            state (SessionState): session state
+            questions (list[tuple[str, int]]): question and word limit of each question of the form
+            stream (BatchStream): stream the events of the batch are put on
+    '''
+    question_indexes = []
+    for question, word_limit in questions:
+        state.questions.append(GrantApplicationQuestionContext(question=question, word_limit=str(word_limit)))
+        question_indexes.append(len(state.questions) - 1)
+
+    stream.put_event('questions', question_indexes=question_indexes)
+
+    if state.ingestion.is_running():
+        stream.put_event('waiting_for_documents')
+        if not wait_for_ingestion(state):
+            logger.warning(f'Ingestion job {state.ingestion.job_id} still running, retrieving from the documents read so far')
+
+    with span('batch_answer', num_questions=len(questions)):
+        with ThreadPoolExecutor(max_workers=min(len(questions), BATCH_ANSWER_MAX_CONCURRENCY), thread_name_prefix='batch_answer') as executor:
+            # each answer is generated in a copy of the current context, for its spans and token usage to be recorded under it
+            futures = [
+                executor.submit(copy_context().run, generate_draft_answer, state, question_index, stream)
+                for question_index in question_indexes]
+            num_answered = sum(future.result() for future in futures)
+
+    stream.put_event('done', num_answered=num_answered, num_failed=len(questions) - num_answered)
@@ -1,19 +1,21 @@
+from __future__ import annotations
+
 from asyncio import Queue
 import time
-
-from devtools import debug
-
-from langchain_community.callbacks import get_openai_callback
-from langchain.chains.openai_functions import create_openai_fn_runnable
-from langchain_openai import ChatOpenAI
+from typing import TYPE_CHECKING
 
 from workflow.session_state import ImplicitQuestion, SessionState
+from utilities.instrumentation import record_llm_stream, span
 from utilities.llm_streaming_utils import stream_from_llm_generation
 from utilities.openai_functions_utils import function_for_comprehensiveness_check
+from utilities.streaming_json import JSONPath, StreamingJSONParser
 from utilities.document_helpers import (
     add_files_to_vector_store,
     get_most_relevant_docs_in_vector_store_for_answering_question,
 )
+from utilities.ingestion import start_ingestion, wait_for_ingestion
+from utilities.org_profile import get_pre_retrieved_documents
+from utilities.usage_ledger import get_num_of_doc_chunks
 from configurations.constants import IS_DEV_MODE
 from configurations.prompts import (
     get_prompt_template_for_generating_original_answer,
@@ -24,21 +26,54 @@ from configurations.prompts import (
 )
 import logging
 
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+
 dnl = '\n&nbsp;\n'
 
 def generate_validation_message_following_files_upload(state: SessionState, queue: Queue) -> list[str]:
-    '''Generate a validation message following a file upload.'''
+    '''Generate a validation message following a file upload, and start ingesting the files in the background.'''
 
     files = state.uploaded_files
     file_or_files = 'file' if len(files) == 1 else 'files'
 
     queue.put_nowait(f'Uploading **{len(files)}** {file_or_files} ... 📤\n')
 
-    add_files_to_vector_store(state)
+    start_ingestion(state)
 
     queue.put_nowait(
         f'You successfully uploaded **{len(files)}** {file_or_files}! 🎉{dnl}' +
-        'Now, on to your first grant application question!')
+        'I\'ll read through them while you type your first grant application question!')
+
+
+def wait_for_documents(state: SessionState, queue: Queue) -> None:
+    '''Wait for the uploaded documents to be ingested if they are still being read, before retrieving from them.'''
+
+    if state.ingestion.is_running():
+        queue.put_nowait(f'Just a moment, I\'m still reading your documents ... 📚{dnl}')
+        if not wait_for_ingestion(state):
+            logging.warning(f'Ingestion job {state.ingestion.job_id} still running, retrieving from the documents read so far')
+
+
+def get_documents_for_answering_question(state: SessionState, question: str) -> list[Document]:
+    '''Get the documents to answer a grant application question, from the organization profile if it is a common question.'''
+
+    # common questions are answered from the organization profile, if built, without searching the vector store
+    if (documents := get_pre_retrieved_documents(state, question)) is not None:
+        return documents
+
+    return get_most_relevant_docs_in_vector_store_for_answering_question(
+        session_id=str(state.session_id),
+        question=question,
+        n_results=get_num_of_doc_chunks(state.get_num_of_doc_chunks_to_consider()))
+
+
+def parse_word_limit(word_limit: str | None) -> int | None:
+    '''Get the word limit of a question as a number, None if it has none.'''
+    try:
+        return int(word_limit) if word_limit is not None and int(word_limit) > 0 else None
+    except ValueError:
+        return None
 
 
 def generate_answer_to_question_stream(state: SessionState, queue: Queue) -> None:
@@ -49,17 +84,14 @@ def generate_answer_to_question_stream(state: SessionState, queue: Queue) -> Non
         queue.put_nowait('No answer generated due to missing application question.')
         return
 
-    most_relevant_documents = get_most_relevant_docs_in_vector_store_for_answering_question(
-        session_id=str(state.session_id),
-        question=question_state.question,
-        n_results=state.get_num_of_doc_chunks_to_consider())
+    wait_for_documents(state, queue)
+    most_relevant_documents = get_documents_for_answering_question(state, question_state.question)
 
     intro_to_answer = f'Based on the information you provided, here\'s the best answer I could put together:{dnl}'
     queue.put_nowait(intro_to_answer)
 
     def on_llm_end(answer: str):
         state.set_answer_to_current_grant_application_question(answer)
-        time.sleep(0.15)
         queue.put_nowait(f'{dnl}Generated answer contains **{len(answer.split())}** words.{dnl}')
 
     stream_from_llm_generation(
@@ -67,29 +99,108 @@ def generate_answer_to_question_stream(state: SessionState, queue: Queue) -> Non
         queue=queue,
         on_llm_end=on_llm_end,
         chain_type='qa_chain',
+        route='original_answer',
         docs=most_relevant_documents,
+        max_words=parse_word_limit(question_state.word_limit),
         question=question_state.question,
         word_limit=question_state.word_limit
     )
 
 def check_for_comprehensiveness(state: SessionState, queue: Queue) -> None:
-    '''Check for comprehensiveness of an answer to a grant application question using OpenAI functions.'''
+    '''
+    Check for comprehensiveness of an answer to a grant application question using OpenAI functions, streaming the
+    missing information as it is generated and each implicit question as soon as it is complete.
+    '''
 
     queue.put_nowait(f'Give me a moment while I think about how to improve it ... 🔍{dnl}')
 
+    from langchain.chains.openai_functions import create_openai_fn_runnable
+    from langchain_openai import ChatOpenAI
+    from utilities.llm_cache import get_llm_cache
+    from utilities.llm_callbacks import FunctionArgumentsCallback
+    from utilities.model_router import estimate_prompt_tokens, get_model_router
+    from utilities.openai_client import get_chat_completions
+
     question_state = state.get_last_question_context()
     comprehensiveness_state = question_state.comprehensiveness
 
-    with get_openai_callback() as cb:
-        prompt = get_prompt_template_for_comprehensiveness_check_openai_functions()
-        chat_openai = ChatOpenAI(model='gpt-4-turbo-preview', temperature=0)
+    is_streaming_missing_information = False
+    has_streamed_missing_information = False
+    num_questions_streamed = 0
+
+    def put_implicit_question(question: str) -> None:
+        nonlocal num_questions_streamed
+        if num_questions_streamed == 0:
+            queue.put_nowait(f'{dnl}To make the answer as strong as possible, I\'d include answers to the following questions:')
+        num_questions_streamed += 1
+        queue.put_nowait(f'\n(**{num_questions_streamed}**) **{question}**')
+
+    def on_string_delta(path: JSONPath, text: str) -> None:
+        nonlocal is_streaming_missing_information
+        if path == ('missing_information',):
+            queue.put_nowait(text if is_streaming_missing_information else f'*{text.lstrip()}')
+            is_streaming_missing_information = True
+
+    def on_value(path: JSONPath, value) -> None:
+        nonlocal has_streamed_missing_information
+        if path == ('missing_information',) and is_streaming_missing_information:
+            queue.put_nowait('*')
+            has_streamed_missing_information = True
+        # implicit questions come as a list of strings or of {'question': ...}, or as a dict of strings
+        elif len(path) == 2 and path[0] == 'implicit_questions':
+            question = value.get('question') if isinstance(value, dict) else value
+            if isinstance(question, str) and question:
+                put_implicit_question(question)
+
+    parser = StreamingJSONParser(on_string_delta=on_string_delta, on_value=on_value)
+    time_to_first_token = None
+    stream_error = None
+
+    def on_arguments(arguments: str) -> None:
+        nonlocal time_to_first_token, stream_error
+        if time_to_first_token is None:
+            time_to_first_token = time.perf_counter() - start_time
+        if stream_error is not None:
+            return
+        try:
+            parser.feed(arguments)
+        except ValueError as e:
+            # what was not streamed yet is sent once the response is complete
+            stream_error = e
+            logging.warning(f'Stopped streaming the comprehensiveness check: {e}')
+
+    prompt = get_prompt_template_for_comprehensiveness_check_openai_functions()
+    router = get_model_router()
+    callback = FunctionArgumentsCallback(on_arguments)
+
+    def check(model: str) -> dict:
+        nonlocal start_time
+        chat_openai = ChatOpenAI(
+            model=model,
+            temperature=0,
+            streaming=True,
+            callbacks=[callback],
+            client=get_chat_completions(),
+            cache=get_llm_cache() or False)
         chain = create_openai_fn_runnable([function_for_comprehensiveness_check], chat_openai, prompt)
 
-        response = chain.invoke(
-            dict(question=question_state.question, answer=question_state.answer)
-        )
-
-        debug(**{'Summary info OpenAI callback': cb})
+        start_time = time.perf_counter()
+        with span('llm_function_call', model=model):
+            response = chain.invoke(
+                dict(question=question_state.question, answer=question_state.answer)
+            )
+        if not callback.served_from_cache:
+            record_llm_stream(model, time_to_first_token, time.perf_counter() - start_time, callback.num_chunks)
+            if time_to_first_token is not None:
+                router.record_time_to_first_token(model, time_to_first_token)
+        return response
+
+    start_time = time.perf_counter()
+    # the check is only made again with another model if none of its arguments was streamed to the user
+    response = router.call_with_fallback(
+        'comprehensiveness_check', check,
+        prompt_tokens=estimate_prompt_tokens([question_state.question or '', question_state.answer or '']),
+        can_fall_back=lambda: callback.num_chunks == 0)
 
     comprehensiveness_state.missing_information = response['missing_information']
 
@@ -103,17 +214,13 @@ def check_for_comprehensiveness(state: SessionState, queue: Queue) -> None:
     else:
         raise ValueError(f'Unexpected type for implicit questions: {type(questions)}\n')
 
-    #debug(**{f'Implicit question #{i}': q.question for i, q in comprehensiveness_state.implicit_questions.items()})
-
-    queue.put_nowait(f'*{comprehensiveness_state.missing_information}*')
-
-    time.sleep(0.15)
-    queue.put_nowait(f'{dnl}To make the answer as strong as possible, I\'d include answers to the following questions:')
+    if not is_streaming_missing_information:
+        queue.put_nowait(f'*{comprehensiveness_state.missing_information}*')
+    elif not has_streamed_missing_information:
+        queue.put_nowait('*')
 
-    time.sleep(0.15)
-    for i, q in enumerate(comprehensiveness_state.implicit_questions):
-        time.sleep(0.1)
-        queue.put_nowait(f'\n(**{i+1}**) **{q.question}**')
+    for q in comprehensiveness_state.implicit_questions[num_questions_streamed:]:
+        put_implicit_question(q.question)
 
 
 def generate_answer_for_implicit_question_stream(state: SessionState, queue: Queue) -> None:
@@ -124,11 +231,13 @@ def generate_answer_for_implicit_question_stream(state: SessionState, queue: Que
 
     if IS_DEV_MODE and state.user_has_changed_num_of_tokens():
         add_files_to_vector_store(state)
+    else:
+        wait_for_documents(state, queue)
 
     most_relevant_documents = get_most_relevant_docs_in_vector_store_for_answering_question(
         session_id=str(state.session_id),
         question=state.get_current_implicit_question(),
-        n_results=state.get_num_of_doc_chunks_to_consider())
+        n_results=get_num_of_doc_chunks(state.get_num_of_doc_chunks_to_consider()))
 
     def on_llm_end(answer: str):
         if 'Not enough information' not in answer:
@@ -140,7 +249,7 @@ def generate_answer_for_implicit_question_stream(state: SessionState, queue: Que
         queue=queue,
         on_llm_end=on_llm_end,
         chain_type='qa_chain',
-        model='gpt-3.5-turbo',
+        route='implicit_question_answer',
         verbose=False,
         docs=most_relevant_documents,
         question=state.get_current_implicit_question()
@@ -161,7 +270,7 @@ def generate_final_answer_stream(state: SessionState, queue: Queue) -> None:
         chatbot_msg = f'No final answer generated due to having answered none of the implicit questions.'
 
     if chatbot_msg != '':
-        debug(chatbot_msg)
+        logging.warning(chatbot_msg)
         queue.put_nowait('Something went wrong, please try again.')
         return
 
@@ -184,7 +293,9 @@ def generate_final_answer_stream(state: SessionState, queue: Queue) -> None:
         queue=queue,
         on_llm_end=on_llm_end,
         chain_type='llm_chain',
-        verbose=True,
+        route='final_answer',
+        verbose=False,
+        max_words=parse_word_limit(question_context.word_limit),
         question=question_context.question,
         answers_to_implicit_questions=dnl.join([f'{q.question}\n{q.answer}' for q in implicit_questions_answered]),
         word_limit=question_context.word_limit,
@@ -211,7 +322,9 @@ def generate_improved_answer_following_user_guidance_prompt(state: SessionState,
         queue=queue,
         on_llm_end=on_llm_end,
         chain_type='llm_chain',
-        verbose=True,
+        route='improved_answer',
+        verbose=False,
+        max_words=parse_word_limit(question_context.word_limit),
         question=question_context.question,
         answers_to_implicit_questions=dnl.join([f'{q.question}\n{q.answer}' for q in implicit_questions_answered]),
         word_limit=question_context.word_limit,
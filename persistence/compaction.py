@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+
+from persistence.serialization import deserialize_to_dataclass, serialize_dataclass, to_json
+from utilities.instrumentation import SESSION_DOCUMENT_BYTES, span
+from workflow.session_state import GrantApplicationQuestionContext, get_utc_time
+
+logger = logging.getLogger(__name__)
+
+# Session states are kept within a size budget, so that writing them costs the same however old the session is (and
+# stays well under the 1 MiB Firestore allows per document): once a session state is written over
+# SESSION_DOCUMENT_BUDGET_BYTES (as JSON), all but its last SESSION_HOT_QUESTIONS questions are archived, keeping only what
+# the workflow reads of them, and so are the edits of the other questions but their last SESSION_HOT_EDITS. Archives are
+# documents of the session store, one per question (a subcollection of the session in Firestore). The usage entries but
+# the last SESSION_HOT_USAGE_ENTRIES are folded into one entry per step and model, which keeps the totals of the session
+SESSION_DOCUMENT_BUDGET_BYTES = int(os.getenv('SESSION_DOCUMENT_BUDGET_BYTES', 128 * 1024))
+SESSION_HOT_QUESTIONS = int(os.getenv('SESSION_HOT_QUESTIONS', 3))
+SESSION_HOT_EDITS = int(os.getenv('SESSION_HOT_EDITS', 20))
+SESSION_HOT_USAGE_ENTRIES = int(os.getenv('SESSION_HOT_USAGE_ENTRIES', 50))
+
+# Fields of an archived question kept in the session state
+ARCHIVED_QUESTION_FIELDS = ('question', 'word_limit', 'current_answer', 'is_archived')
+
+
+def get_archive_key(question_index: int) -> str:
+    return f'question-{question_index}'
+
+
+def fold_usage_entries(entries: list[dict]) -> list[dict]:
+    '''Fold serialized usage entries into one per step and model, with the totals of its tokens and the time of the last one.'''
+    folded: dict[tuple[str, str], dict] = {}
+    for entry in entries:
+        total = folded.setdefault((entry.get('step'), entry.get('model')), {'step': entry.get('step'), 'model': entry.get('model')})
+        for kind in ('prompt_tokens', 'cached_tokens', 'completion_tokens', 'embedding_tokens'):
+            total[kind] = total.get(kind, 0) + entry.get(kind, 0)
+        total['time'] = max(total.get('time', 0), entry.get('time', 0))
+    return list(folded.values())
+
+
+def compact_document(data: dict, num_hot_questions: int = SESSION_HOT_QUESTIONS, num_hot_edits: int = SESSION_HOT_EDITS) -> tuple[dict, dict[int, dict]]:
+    '''
+    Split a serialized session state into what stays in its document and what is archived
+
+        Parameters:
+            data (dict): serialized session state
+            num_hot_questions (int): number of last questions kept whole
+            num_hot_edits (int): number of last edits kept of each of them
+
+        Returns:
+            tuple[dict, dict[int, dict]]: compacted session state, and the fields archived of each question by index
+    '''
+    questions = data.get('questions', [])
+    compacted_questions = []
+    archived = {}
+
+    for index, question in enumerate(questions):
+        if question.get('is_archived'):
+            # only its edits since it was archived, its other fields being defaults
+            kept = {key: value for key, value in question.items() if key in ARCHIVED_QUESTION_FIELDS}
+            moved = {'edited_answers': question.get('edited_answers', [])}
+        elif index < len(questions) - num_hot_questions:
+            kept = {key: value for key, value in question.items() if key in ARCHIVED_QUESTION_FIELDS} | {'is_archived': True}
+            moved = {key: value for key, value in question.items() if key not in ARCHIVED_QUESTION_FIELDS}
+        else:
+            edits = question.get('edited_answers', [])
+            num_archived_edits = max(len(edits) - num_hot_edits, 0)
+            kept = question | {'edited_answers': edits[num_archived_edits:]}
+            moved = {'edited_answers': edits[:num_archived_edits]}
+
+        compacted_questions.append(kept)
+        if moved := {key: value for key, value in moved.items() if value not in (None, [], {})}:
+            archived[index] = moved
+
+    compacted = data | {'questions': compacted_questions}
+    entries = data.get('usage', {}).get('entries', [])
+    if len(entries) > SESSION_HOT_USAGE_ENTRIES:
+        num_folded = len(entries) - SESSION_HOT_USAGE_ENTRIES
+        compacted['usage'] = data['usage'] | {'entries': fold_usage_entries(entries[:num_folded]) + entries[num_folded:]}
+
+    return compacted, archived
+
+
+def _get_edit_key(edit: dict) -> str:
+    '''Identify an archived edit, to archive it only once if a question is archived again after a failed compaction.'''
+    # the time of an edit is read back as an ISO string from the JSON backends, and as an aware datetime from Firestore
+    time = get_utc_time(edit['time']).isoformat() if edit.get('time') is not None else None
+    return json.dumps({**edit, 'time': time}, sort_keys=True, default=str)
+
+
+def archive_questions(store, session_id: str, archived: dict[int, dict]) -> None:
+    '''Add the archived fields of questions to their archives, the edits after the ones already archived.'''
+    for index, moved in archived.items():
+        key = get_archive_key(index)
+        stored = store.load_archive(session_id, key) or {'question_index': index}
+        edits = stored.get('edited_answers', [])
+        known_edits = {_get_edit_key(edit) for edit in edits}
+
+        stored |= {field: value for field, value in moved.items() if field != 'edited_answers'}
+        stored['edited_answers'] = edits + [edit for edit in moved.get('edited_answers', []) if _get_edit_key(edit) not in known_edits]
+        store.save_archive(session_id, key, stored)
+
+
+def get_compacted_document(store, session_id: str, data: dict) -> dict | None:
+    '''
+    Archive what a serialized session state over its size budget does not keep (see SESSION_DOCUMENT_BUDGET_BYTES)
+
+        Parameters:
+            store (SessionStore): store of the session state and its archives
+            session_id (str): ID of the session
+            data (dict): serialized session state, as just written
+
+        Returns:
+            dict | None: compacted session state to write, None if it is within its budget or has nothing to compact
+    '''
+    size = len(to_json(data))
+    SESSION_DOCUMENT_BYTES.observe(size)
+    if size <= SESSION_DOCUMENT_BUDGET_BYTES:
+        return None
+
+    compacted, archived = compact_document(data)
+    if compacted == data:
+        logger.info(f'Session state of session_id={session_id} is {size} bytes, over its budget of {SESSION_DOCUMENT_BUDGET_BYTES} bytes, with nothing left to compact')
+        return None
+
+    if archived:
+        with span('session_archive', num_questions=len(archived)):
+            archive_questions(store, session_id, archived)
+    logger.info(f'Compacted the session state of session_id={session_id} ({size} bytes), archiving {len(archived)} questions')
+    return compacted
+
+
+def load_archived_question(store, session_id: str, question: GrantApplicationQuestionContext, question_index: int) -> GrantApplicationQuestionContext:
+    '''
+    Get a question of a session whole, with what is archived of it (eg. to show the full history of its answer)
+
+        Parameters:
+            store (SessionStore): store of the session state and its archives
+            session_id (str): ID of the session
+            question (GrantApplicationQuestionContext): question, as in the session state
+            question_index (int): index of the question in the session's questions
+
+        Returns:
+            GrantApplicationQuestionContext: question with its archived fields and edits
+    '''
+    stored = store.load_archive(session_id, get_archive_key(question_index))
+    if stored is None:
+        return question
+
+    # an archived question only has the defaults of the fields that were archived
+    data = {
+        field: value for field, value in serialize_dataclass(question).items()
+        if not question.is_archived or field in ARCHIVED_QUESTION_FIELDS or field == 'edited_answers'}
+    archived_edits = stored.pop('edited_answers', [])
+    stored.pop('question_index', None)
+    whole = stored | {field: value for field, value in data.items() if field != 'edited_answers'}
+    whole['edited_answers'] = archived_edits + data.get('edited_answers', [])
+    whole['is_archived'] = False
+    return deserialize_to_dataclass(GrantApplicationQuestionContext, whole)
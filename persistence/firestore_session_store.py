@@ -0,0 +1,71 @@
+import logging
+
+from firestore import SERVER_COLLECTION, get_db
+from persistence.session_store import SessionConflictError, SessionStore, check_revision
+from utilities.instrumentation import span
+
+logger = logging.getLogger(__name__)
+
+# Subcollection of a session document holding the archives of its session state (see persistence/compaction.py)
+ARCHIVE_COLLECTION = 'archive'
+
+
+class FirestoreSessionStore(SessionStore):
+    '''Session states as documents of the SERVER_COLLECTION Firestore collection.'''
+
+    name = 'firestore'
+
+    def __init__(self, collection: str = SERVER_COLLECTION):
+        self.collection = collection
+
+    def load(self, session_id: str) -> dict | None:
+        doc_ref = get_db().collection(self.collection).document(session_id)
+        with span('firestore_fetch', collection=self.collection):
+            doc = doc_ref.get()
+        if doc.exists:
+            return doc.to_dict()
+        else:
+            logger.info(f'No such document with ID: {session_id}')
+            return None
+
+    def load_revision(self, session_id: str) -> int | None:
+        with span('firestore_fetch', collection=self.collection):
+            doc = get_db().collection(self.collection).document(session_id).get(field_paths=['revision'])
+        return doc.to_dict().get('revision', 0) if doc.exists else None
+
+    def save(self, session_id: str, data: dict, expected_revision: int | None = None) -> None:
+        doc_ref = get_db().collection(self.collection).document(session_id)
+        if expected_revision is None:
+            with span('firestore_write', collection=self.collection):
+                doc_ref.set(data, merge=True)
+            return
+
+        from google.api_core.exceptions import Conflict, FailedPrecondition, NotFound
+
+        # Conditional write with Firestore preconditions: a new session is created only if it does not exist yet, and
+        # an existing one is updated only if it has not been written since its revision was read (session documents
+        # written before revisions were introduced have none, and are at revision 0)
+        try:
+            with span('firestore_fetch', collection=self.collection):
+                doc = doc_ref.get(field_paths=['revision'])
+            check_revision(session_id, doc.to_dict().get('revision', 0) if doc.exists else None, expected_revision)
+
+            with span('firestore_write', collection=self.collection):
+                if not doc.exists:
+                    doc_ref.create(data)
+                else:
+                    doc_ref.update(data, option=get_db().write_option(last_update_time=doc.update_time))
+        except (Conflict, FailedPrecondition, NotFound) as e:
+            raise SessionConflictError(f'Session {session_id} was updated concurrently: {e}') from e
+
+    def load_archive(self, session_id: str, key: str) -> dict | None:
+        with span('firestore_fetch', collection=ARCHIVE_COLLECTION):
+            doc = get_db().collection(self.collection).document(session_id).collection(ARCHIVE_COLLECTION).document(key).get()
+        return doc.to_dict() if doc.exists else None
+
+    def save_archive(self, session_id: str, key: str, data: dict) -> None:
+        with span('firestore_write', collection=ARCHIVE_COLLECTION):
+            get_db().collection(self.collection).document(session_id).collection(ARCHIVE_COLLECTION).document(key).set(data)
+
+    def delete(self, session_id: str) -> None:
+        get_db().collection(self.collection).document(session_id).delete()
@@ -0,0 +1,82 @@
+from dataclasses import asdict
+from typing import Any
+
+from workflow.text_changes import TextChange, apply_text_changes, get_text_changes
+
+
+def merge_documents(base: Any, ours: Any, theirs: Any) -> Any:
+    '''
+    Three-way merge of two serialized versions of a document that were both derived from base: changes made by only
+    one side are kept, maps are merged key by key, lists are merged item by item and keep the items appended by either
+    side (theirs first), and conflicting changes of a same value are resolved in favour of ours. The edits of an answer
+    are merged by rebasing those of ours on those of theirs (see _merge_edits).
+
+        Parameters:
+            base (Any): version both sides were derived from
+            ours (Any): version being written
+            theirs (Any): version currently stored
+
+        Returns:
+            Any: merged version
+    '''
+    if ours == theirs or theirs == base:
+        return ours
+    if ours == base:
+        return theirs
+
+    if isinstance(ours, dict) and isinstance(theirs, dict):
+        base = base if isinstance(base, dict) else {}
+        merged = {}
+        for key in [*ours, *(key for key in theirs if key not in ours)]:
+            if key == 'edited_answers' and isinstance(ours.get(key), list) and isinstance(theirs.get(key), list):
+                value = _merge_edits(base, ours, theirs)
+            else:
+                value = merge_documents(base.get(key), ours.get(key), theirs.get(key))
+            if value is not None:
+                merged[key] = value
+        return merged
+
+    if isinstance(ours, list) and isinstance(theirs, list):
+        base = base if isinstance(base, list) else []
+        num_common = len(base)
+        if len(ours) >= num_common and len(theirs) >= num_common:
+            return (
+                [merge_documents(b, o, t) for b, o, t in zip(base, ours, theirs)] +
+                theirs[num_common:] +
+                ours[num_common:])
+
+    return ours
+
+
+def _get_num_common(base: list, items: list) -> int:
+    '''Get the number of first items of a list that are those of base.'''
+    return next((i for i, (b, item) in enumerate(zip(base, items)) if b != item), min(len(base), len(items)))
+
+
+def _merge_edits(base: dict, ours: dict, theirs: dict) -> list:
+    '''
+    Merge the edits of the answer of a serialized question: those of theirs first (which may have been compacted), then
+    those of ours. As each edit stores the changes turning the answer after it into the answer before it, the changes
+    of the first edit of ours are computed again against the current answer of theirs, which it now follows, rather
+    than against the answer both sides were derived from.
+    '''
+    base_edits = (base if isinstance(base, dict) else {}).get('edited_answers') or []
+    our_edits, their_edits = ours['edited_answers'], theirs['edited_answers']
+    our_new_edits = our_edits[_get_num_common(base_edits, our_edits):]
+    if not our_new_edits:
+        return their_edits
+    if not their_edits[_get_num_common(base_edits, their_edits):]:
+        return our_edits
+
+    # answer after the first new edit of ours, from its current answer and the changes of the edits that followed it
+    answer = ours.get('current_answer') or ''
+    for edit in reversed(our_new_edits[1:]):
+        if edit.get('new_answer') is not None:
+            answer = edit.get('previous_answer') or ''
+        else:
+            answer = apply_text_changes(answer, [TextChange(**change) for change in edit.get('changes_to_previous_answer', [])])
+
+    rebased_edit = {key: value for key, value in our_new_edits[0].items() if key not in ('new_answer', 'previous_answer')} | {
+        'changes_to_previous_answer': [asdict(change) for change in get_text_changes(answer, theirs.get('current_answer') or '')],
+        'is_first_edit': False}
+    return their_edits + [rebased_edit] + our_new_edits[1:]
@@ -0,0 +1,54 @@
+import os
+
+from persistence.serialization import from_json, to_json
+from persistence.session_store import SessionConflictError, SessionStore, check_revision
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+# Sessions that are not written for this long are evicted from Redis (they stay in the durable store, if any)
+SESSION_STORE_REDIS_TTL_SECONDS = int(os.getenv('SESSION_STORE_REDIS_TTL_SECONDS', 7 * 24 * 3600))
+
+
+class RedisSessionStore(SessionStore):
+    '''Session states as JSON strings in Redis, a fast tier shared by all the replicas of the app.'''
+
+    name = 'redis'
+
+    def __init__(self, url: str = REDIS_URL, ttl_seconds: int = SESSION_STORE_REDIS_TTL_SECONDS, key_prefix: str = 'session:'):
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self.key_prefix = key_prefix
+
+    def _key(self, session_id: str) -> str:
+        return f'{self.key_prefix}{session_id}'
+
+    def load(self, session_id: str) -> dict | None:
+        raw = self._client.get(self._key(session_id))
+        return from_json(raw) if raw is not None else None
+
+    def save(self, session_id: str, data: dict, expected_revision: int | None = None) -> None:
+        key = self._key(session_id)
+        if expected_revision is None:
+            self._client.set(key, to_json(data), ex=self.ttl_seconds)
+            return
+
+        import redis
+
+        # optimistic transaction: the write is discarded if the key changes between WATCH and EXEC
+        with self._client.pipeline() as pipeline:
+            try:
+                pipeline.watch(key)
+                raw = pipeline.get(key)
+                check_revision(session_id, from_json(raw).get('revision', 0) if raw is not None else None, expected_revision)
+                pipeline.multi()
+                pipeline.set(key, to_json(data), ex=self.ttl_seconds)
+                pipeline.execute()
+            except redis.WatchError as e:
+                raise SessionConflictError(f'Session {session_id} was updated concurrently') from e
+
+    def delete(self, session_id: str) -> None:
+        self._client.delete(self._key(session_id))
+
+    def close(self) -> None:
+        self._client.close()
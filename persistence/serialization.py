@@ -0,0 +1,88 @@
+import datetime
+import json
+import logging
+import types
+import typing
+from dataclasses import asdict, fields, is_dataclass
+from enum import Enum
+
+logger = logging.getLogger(__name__)
+
+
+def unwrap_optional(type_hint):
+    '''Get X from an X | None (or Optional[X]) type hint, whose values are converted like those of X.'''
+    if isinstance(type_hint, types.UnionType) or typing.get_origin(type_hint) is typing.Union:
+        args = [arg for arg in typing.get_args(type_hint) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return type_hint
+
+
+def convert_value(type_hint, value):
+    type_hint = unwrap_optional(type_hint)
+    if not isinstance(type_hint, type):
+        return [convert_value(dict, item) for item in value] if isinstance(value, list) else value
+
+    try:
+        if is_dataclass(type_hint):
+            return deserialize_to_dataclass(type_hint, value)
+        if isinstance(value, list):
+            return deserialize_list(type_hint, value)
+        if issubclass(type_hint, Enum):
+            return type_hint[value.upper()] if isinstance(value, str) else type_hint(value)
+        if issubclass(type_hint, datetime.datetime) and isinstance(value, str):
+            return datetime.datetime.fromisoformat(value)  # JSON backends store datetimes as ISO strings
+    except Exception as e:
+        logger.error(f"Failed to convert value '{value}' with type_hint '{type_hint}': {e}")
+        return None
+    return value
+
+def deserialize_list(field_type, value):
+    field_type = unwrap_optional(field_type)
+    element_type = field_type.__args__[0] if hasattr(field_type, '__args__') else dict
+    return [convert_value(element_type, item) for item in value]
+
+def deserialize_to_dataclass(cls, data):
+    if not isinstance(data, dict):
+        return data
+
+    field_types = {f.name: f.type for f in fields(cls)}
+    converted_data = {}
+
+    for key, value in data.items():
+        type_hint = field_types.get(key)
+        if not type_hint:
+            logger.debug(f"Field '{key}' not defined in dataclass '{cls.__name__}'. Skipping...")
+            continue
+
+        try:
+            converted_data[key] = deserialize_list(type_hint, value) if isinstance(value, list) else convert_value(type_hint, value)
+        except Exception as e:
+            logger.error(f"Error processing field '{key}' in dataclass '{cls.__name__}': {e}", exc_info=True)
+            converted_data[key] = None
+
+    return cls(**converted_data)
+
+def serialize_dataclass(obj):
+    if is_dataclass(obj):
+        return {k: serialize_dataclass(v) for k, v in asdict(obj).items() if v is not None}
+    return serialize_iterable(obj) if isinstance(obj, (list, tuple, dict)) else obj
+
+def serialize_iterable(obj):
+    if isinstance(obj, dict):
+        return {k: serialize_dataclass(v) for k, v in obj.items() if v is not None}
+    else:  # it's a list or tuple
+        return [serialize_dataclass(v) for v in obj if v is not None]
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def to_json(data: dict) -> str:
+    '''Dump a serialized dataclass to JSON, for the backends that store documents as strings (SQLite, Redis).'''
+    return json.dumps(data, default=_json_default, separators=(',', ':'))
+
+def from_json(raw: str | bytes) -> dict:
+    return json.loads(raw)
@@ -0,0 +1,367 @@
+import copy
+import logging
+import os
+from abc import ABC, abstractmethod
+from dataclasses import fields
+from threading import Condition, Lock, Thread
+from typing import Callable
+
+from persistence.merge import merge_documents
+from persistence.serialization import deserialize_to_dataclass, serialize_dataclass
+from utilities.instrumentation import SESSION_COMPACTIONS, SESSION_WRITE_CONFLICTS, span
+from workflow.session_state import SessionState
+
+logger = logging.getLogger(__name__)
+
+# Backend storing the session states: 'firestore', 'sqlite', 'redis' or 'memory'
+SESSION_STORE = os.getenv('SESSION_STORE', 'firestore')
+# Optional fast tier in front of SESSION_STORE ('sqlite', 'redis' or 'memory'), and how writes reach SESSION_STORE:
+# 'through' writes both tiers before returning, 'behind' writes the fast tier and persists in the background
+SESSION_STORE_CACHE = os.getenv('SESSION_STORE_CACHE', '')
+SESSION_STORE_WRITE_MODE = os.getenv('SESSION_STORE_WRITE_MODE', 'through')
+
+# Number of attempts to write a session state that keeps being updated concurrently, merging the changes on each conflict
+SESSION_WRITE_MAX_ATTEMPTS = 3
+
+# Attribute of a SessionState holding the serialized version it was loaded as (or last written as),
+# the base of the three-way merge of a conflicting write
+SNAPSHOT_ATTRIBUTE = '_stored_snapshot'
+
+# Writes of a same session by this process are serialized, with a lock per stripe of sessions
+_SESSION_LOCKS = [Lock() for _ in range(64)]
+
+
+class SessionConflictError(Exception):
+    '''The session state in the store does not have the revision the write was based on.'''
+    pass
+
+
+def check_revision(session_id: str, stored_revision: int | None, expected_revision: int | None) -> None:
+    '''
+    Raise a SessionConflictError if a write expecting a session state at expected_revision would overwrite another one
+    (a missing session state is at revision 0)
+    '''
+    if expected_revision is None:
+        return
+    stored_revision = stored_revision or 0
+    if stored_revision != expected_revision:
+        raise SessionConflictError(f'Session {session_id} is at revision {stored_revision}, not {expected_revision}')
+
+
+def _get_session_lock(session_id: str) -> Lock:
+    return _SESSION_LOCKS[hash(session_id) % len(_SESSION_LOCKS)]
+
+
+class SessionStore(ABC):
+    '''Storage backend of session states, which backends implement as serialized documents keyed by session ID.'''
+
+    name: str
+
+    @abstractmethod
+    def load(self, session_id: str) -> dict | None:
+        '''Return the serialized session state of session_id, or None if there is none.'''
+        pass
+
+    @abstractmethod
+    def save(self, session_id: str, data: dict, expected_revision: int | None = None) -> None:
+        '''
+        Store the serialized session state of session_id, only if the stored one is at expected_revision (if not None)
+
+            Raises:
+                SessionConflictError: if the stored session state is at another revision
+        '''
+        pass
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None:
+        pass
+
+    def close(self) -> None:
+        '''Flush pending writes and release the resources of the store.'''
+        pass
+
+    def load_revision(self, session_id: str) -> int | None:
+        '''Return the revision of the stored session state of session_id, which backends can read without the whole document.'''
+        data = self.load(session_id)
+        return data.get('revision', 0) if data is not None else None
+
+    def load_archive(self, session_id: str, key: str) -> dict | None:
+        '''Return an archive of the session state of session_id (see persistence/compaction.py), or None if there is none.'''
+        return self.load(f'{session_id}:archive:{key}')
+
+    def save_archive(self, session_id: str, key: str, data: dict) -> None:
+        '''Store an archive of the session state of session_id, next to it.'''
+        self.save(f'{session_id}:archive:{key}', data)
+
+    def get(self, session_id: str) -> SessionState | None:
+        with span('session_fetch', store=self.name):
+            data = self.load(session_id)
+        if data is None:
+            return None
+
+        with span('deserialization'):
+            state = deserialize_to_dataclass(SessionState, data)
+        setattr(state, SNAPSHOT_ATTRIBUTE, data)
+        return state
+
+    def put(self, state: SessionState) -> None:
+        '''
+        Write a session state as its next revision. If another writer (eg. another replica) has stored a newer revision
+        in the meantime, the changes of both are merged into state, which is written again on top of the stored revision.
+
+            Raises:
+                SessionConflictError: if the session kept being updated concurrently for SESSION_WRITE_MAX_ATTEMPTS attempts
+        '''
+        with _get_session_lock(state.session_id):
+            for _ in range(SESSION_WRITE_MAX_ATTEMPTS):
+                with span('serialization'):
+                    data = serialize_dataclass(state) | {'revision': state.revision + 1}
+
+                try:
+                    with span('session_write', store=self.name):
+                        self.save(state.session_id, data, expected_revision=state.revision)
+                except SessionConflictError as e:
+                    logger.info(f'{e}, merging concurrent changes')
+                    self._merge_stored_changes(state, data)
+                    continue
+
+                state.revision += 1
+                setattr(state, SNAPSHOT_ATTRIBUTE, data)
+                self._compact(state, data)
+                return
+
+        SESSION_WRITE_CONFLICTS.labels(outcome='failed').inc()
+        raise SessionConflictError(f'Session {state.session_id} kept being updated concurrently')
+
+    def update(self, session_id: str, update: Callable[[SessionState], None], cached: SessionState | None = None) -> SessionState | None:
+        '''
+        Apply an update to a fresh copy of the stored session state of session_id and write it, for background tasks to
+        persist the fields they own without touching the session state that requests are changing and writing (which
+        picks the update up by merging it on its next write)
+
+            Parameters:
+                session_id (str): ID of the session
+                update (Callable[[SessionState], None]): function changing the fields of the copy to persist
+                cached (SessionState | None): session state of the requests, which the update is also applied to if it
+                    is at the revision the update was written on top of, so that the write does not make it stale
+
+            Returns:
+                SessionState | None: copy written, None if no session state is stored
+
+            Raises:
+                SessionConflictError: if the session kept being updated concurrently for SESSION_WRITE_MAX_ATTEMPTS attempts
+        '''
+        if (state := self.get(session_id)) is None:
+            return None
+        revision = state.revision
+        update(state)
+        self.put(state)
+
+        # brought to the revision written unless it was changed in the meantime (and then merges the update on its next write)
+        with _get_session_lock(session_id):
+            if cached is not None and cached.revision == revision and state.revision == revision + 1:
+                update(cached)
+                cached.revision = state.revision
+                setattr(cached, SNAPSHOT_ATTRIBUTE, getattr(state, SNAPSHOT_ATTRIBUTE))
+        return state
+
+    def _compact(self, state: SessionState, data: dict) -> None:
+        '''
+        Write a compacted version of a session state just written over its size budget, once what it does not keep is
+        archived (see persistence/compaction.py). It is written on top of the revision just written only, so that no
+        concurrent change is lost to it: a session updated in the meantime is compacted on a later write.
+        '''
+        from persistence.compaction import get_compacted_document
+
+        try:
+            if (compacted := get_compacted_document(self, state.session_id, data)) is None:
+                return
+            compacted['revision'] = state.revision + 1
+            with span('session_write', store=self.name):
+                self.save(state.session_id, compacted, expected_revision=state.revision)
+        except Exception as e:
+            logger.warning(f'Failed to compact the session state of session_id={state.session_id}: {e}')
+            SESSION_COMPACTIONS.labels(outcome='failed').inc()
+            return
+
+        compacted_state = deserialize_to_dataclass(SessionState, compacted)
+        state.questions = compacted_state.questions
+        state.usage = compacted_state.usage
+        state.revision = compacted['revision']
+        setattr(state, SNAPSHOT_ATTRIBUTE, compacted)
+        SESSION_COMPACTIONS.labels(outcome='compacted').inc()
+
+    def _merge_stored_changes(self, state: SessionState, data: dict) -> None:
+        '''Update state with the changes of the stored session state, merged with its own since the version it was based on.'''
+        if (stored := self.load(state.session_id)) is None:
+            return
+
+        with span('session_merge'):
+            merged = merge_documents(getattr(state, SNAPSHOT_ATTRIBUTE, {}), data, stored)
+            merged_state = deserialize_to_dataclass(SessionState, merged)
+
+        for field in fields(SessionState):
+            setattr(state, field.name, getattr(merged_state, field.name))
+        state.revision = stored.get('revision', 0)
+        setattr(state, SNAPSHOT_ATTRIBUTE, stored)
+        SESSION_WRITE_CONFLICTS.labels(outcome='merged').inc()
+
+
+class InMemorySessionStore(SessionStore):
+    '''Process-local store, for tests and offline benchmarks (or as the fast tier of a single replica).'''
+
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = Lock()
+        self._documents: dict[str, dict] = {}
+
+    def load(self, session_id: str) -> dict | None:
+        with self._lock:
+            data = self._documents.get(session_id)
+        return copy.deepcopy(data)
+
+    def save(self, session_id: str, data: dict, expected_revision: int | None = None) -> None:
+        data = copy.deepcopy(data)
+        with self._lock:
+            stored = self._documents.get(session_id)
+            check_revision(session_id, stored.get('revision', 0) if stored is not None else None, expected_revision)
+            self._documents[session_id] = data
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._documents.pop(session_id, None)
+
+
+class LayeredSessionStore(SessionStore):
+    '''
+    Fast store in front of a durable one: reads are served by the fast store when it has the session, and writes go to
+    both, either before returning (write-through) or to the durable store from a background thread (write-behind).
+    With write-behind, successive writes of a session that is waiting to be persisted are coalesced into the last one.
+
+    Conditional writes are checked by the durable store with write-through, and by the fast store with write-behind
+    (which must then be shared by all replicas, eg. Redis).
+    '''
+
+    def __init__(self, fast: SessionStore, durable: SessionStore, write_behind: bool = False):
+        self.fast = fast
+        self.durable = durable
+        self.write_behind = write_behind
+        self.name = f'{fast.name}+{durable.name}'
+
+        self._pending: dict[str, dict] = {}
+        self._condition = Condition()
+        self._closed = False
+        self._writer: Thread | None = None
+        if write_behind:
+            self._writer = Thread(target=self._persist_pending, name='session-write-behind', daemon=True)
+            self._writer.start()
+
+    def load(self, session_id: str) -> dict | None:
+        if (data := self.fast.load(session_id)) is not None:
+            return data
+
+        with self._condition:
+            if session_id in self._pending:
+                return copy.deepcopy(self._pending[session_id])
+
+        if (data := self.durable.load(session_id)) is not None:
+            self.fast.save(session_id, data)
+        return data
+
+    def load_revision(self, session_id: str) -> int | None:
+        if (revision := self.fast.load_revision(session_id)) is not None:
+            return revision
+        return self.durable.load_revision(session_id)
+
+    def save(self, session_id: str, data: dict, expected_revision: int | None = None) -> None:
+        if not self.write_behind:
+            try:
+                self.durable.save(session_id, data, expected_revision)
+            except SessionConflictError:
+                self.fast.delete(session_id)  # stale, so that the stored session state is read from the durable store
+                raise
+            self.fast.save(session_id, data)
+            return
+
+        self.fast.save(session_id, data, expected_revision)
+        with self._condition:
+            self._pending[session_id] = data
+            self._condition.notify()
+
+    def load_archive(self, session_id: str, key: str) -> dict | None:
+        return self.durable.load_archive(session_id, key)  # archives are read rarely, so they are not cached
+
+    def save_archive(self, session_id: str, key: str, data: dict) -> None:
+        self.durable.save_archive(session_id, key, data)
+
+    def delete(self, session_id: str) -> None:
+        with self._condition:
+            self._pending.pop(session_id, None)
+        self.fast.delete(session_id)
+        self.durable.delete(session_id)
+
+    def close(self) -> None:
+        if self._writer is not None:
+            with self._condition:
+                self._closed = True
+                self._condition.notify()
+            self._writer.join()
+        self.fast.close()
+        self.durable.close()
+
+    def _persist_pending(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return  # closed and flushed
+                session_id, data = next(iter(self._pending.items()))
+                del self._pending[session_id]
+
+            try:
+                with span('session_write_behind', store=self.durable.name):
+                    self.durable.save(session_id, data)
+            except Exception as e:
+                logger.error(f'Failed to persist session_id={session_id} to the {self.durable.name} store: {e}', exc_info=True)
+
+
+def create_session_store(name: str) -> SessionStore:
+    if name == 'firestore':
+        from persistence.firestore_session_store import FirestoreSessionStore
+        return FirestoreSessionStore()
+    if name == 'sqlite':
+        from persistence.sqlite_session_store import SQLiteSessionStore
+        return SQLiteSessionStore()
+    if name == 'redis':
+        from persistence.redis_session_store import RedisSessionStore
+        return RedisSessionStore()
+    if name == 'memory':
+        return InMemorySessionStore()
+    raise ValueError(f'Unknown session store: {name}')
+
+
+_session_store: SessionStore | None = None
+
+
+def get_session_store() -> SessionStore:
+    '''Return the session store configured by SESSION_STORE, SESSION_STORE_CACHE and SESSION_STORE_WRITE_MODE.'''
+    global _session_store
+    if _session_store is None:
+        store = create_session_store(SESSION_STORE)
+        if SESSION_STORE_CACHE:
+            store = LayeredSessionStore(
+                fast=create_session_store(SESSION_STORE_CACHE),
+                durable=store,
+                write_behind=SESSION_STORE_WRITE_MODE == 'behind')
+        logger.info(f'Using the {store.name} session store')
+        _session_store = store
+    return _session_store
+
+
+def close_session_store() -> None:
+    global _session_store
+    if _session_store is not None:
+        _session_store.close()
+        _session_store = None
@@ -0,0 +1,64 @@
+import os
+import sqlite3
+import time
+from threading import Lock
+
+from configurations.constants import LOCAL_DATA_DIRECTORY
+from persistence.serialization import from_json, to_json
+from persistence.session_store import SessionStore, check_revision
+
+SESSION_STORE_SQLITE_PATH = os.getenv('SESSION_STORE_SQLITE_PATH', os.path.join(LOCAL_DATA_DIRECTORY, 'sessions.db'))
+
+
+class SQLiteSessionStore(SessionStore):
+    '''Session states as JSON rows of a local SQLite database, a fast tier for the sessions served by this host.'''
+
+    name = 'sqlite'
+
+    def __init__(self, path: str = SESSION_STORE_SQLITE_PATH):
+        self._lock = Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)')
+
+    def load(self, session_id: str) -> dict | None:
+        with self._lock:
+            row = self._connection.execute('SELECT data FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return from_json(row[0]) if row is not None else None
+
+    def load_revision(self, session_id: str) -> int | None:
+        with self._lock:
+            return self._select_revision(session_id)
+
+    def _select_revision(self, session_id: str) -> int | None:
+        row = self._connection.execute(
+            "SELECT coalesce(json_extract(data, '$.revision'), 0) FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def save(self, session_id: str, data: dict, expected_revision: int | None = None) -> None:
+        raw = to_json(data)
+        with self._lock:
+            # the revision is checked and the row written in an immediate transaction, which other processes wait for
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                if expected_revision is not None:
+                    check_revision(session_id, self._select_revision(session_id), expected_revision)
+                self._connection.execute(
+                    'INSERT INTO sessions (session_id, data, updated_at) VALUES (?, ?, ?) '
+                    'ON CONFLICT(session_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at',
+                    (session_id, raw, time.time()))
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._connection.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,4 @@
+import os
+
+# the tests import the app, which must not report to Sentry
+os.environ.setdefault('SENTRY_DSN', '')
@@ -0,0 +1,26 @@
+import uuid
+
+from fastapi.testclient import TestClient
+
+import main
+import persistence.session_store
+from benchmarks.serve import install_fakes
+from persistence.session_store import InMemorySessionStore
+from workflow.session_state import SessionState
+
+
+def test_batch_of_another_users_session_is_forbidden(monkeypatch):
+    install_fakes()
+    store = InMemorySessionStore()
+    monkeypatch.setattr(persistence.session_store, '_session_store', store)
+    session_id = str(uuid.uuid4())
+    store.put(SessionState(session_id=session_id, user_id='owner'))
+
+    response = TestClient(main.app).post(
+        '/batch_answer',
+        json={'session_id': session_id, 'questions': [{'question': 'What is your mission?', 'word_limit': 100}]},
+        headers={'Authorization': 'Bearer other'})
+
+    assert response.status_code == 403
+    assert main.sessions[uuid.UUID(session_id)].questions == []
+    assert store.get(session_id).questions == []
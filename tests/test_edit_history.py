@@ -0,0 +1,112 @@
+import random
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import persistence.compaction
+import persistence.session_store
+import workflow.session_state
+from benchmarks.serve import install_fakes
+from persistence.compaction import load_archived_question
+from persistence.session_store import InMemorySessionStore
+from persistence.sqlite_session_store import SQLiteSessionStore
+from workflow.session_state import SessionState
+from workflow.text_changes import apply_text_changes, get_text_changes
+
+TEXT_PAIRS = [
+    ('', ''),
+    ('', 'A new answer.'),
+    ('An old answer.', ''),
+    ('Our mission is to feed families.', 'Our mission is to feed 1,000 families in Boston.'),
+    ('We  serve\nthe city.', 'We serve the\n\ncity and its suburbs.'),
+    ('Café naïve 😀 résumé.', 'Café 😀 naïve résumé!'),
+    ('one two three four five', 'five four three two one'),
+]
+
+
+@pytest.mark.parametrize('text, target', TEXT_PAIRS)
+def test_text_changes_round_trip(text, target):
+    assert apply_text_changes(text, get_text_changes(text, target)) == target
+    assert apply_text_changes(target, get_text_changes(target, text)) == text
+
+
+def test_random_edits_round_trip():
+    rng = random.Random(0)
+    words = 'the grant will fund staff, food and 2 new vans for our pantry .'.split()
+    for _ in range(200):
+        text = ' '.join(rng.choices(words, k=rng.randint(0, 30)))
+        target = ' '.join(rng.choices(words, k=rng.randint(0, 30)))
+        assert apply_text_changes(text, get_text_changes(text, target)) == target
+
+
+def add_question(state: SessionState, question: str, answers: list[str]) -> None:
+    state.add_new_question()
+    state.set_grant_application_question(question)
+    state.set_word_limit('150')
+    state.set_answer_to_current_grant_application_question(answers[0])
+    for answer in answers:
+        state.edit_last_question(state.get_index_of_last_question(), answer)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    return InMemorySessionStore() if request.param == 'memory' else SQLiteSessionStore(str(tmp_path / 'sessions.db'))
+
+
+def test_archived_questions_are_reconstructed_after_compaction(store, monkeypatch):
+    monkeypatch.setattr(workflow.session_state, 'EDIT_COALESCE_SECONDS', 0)
+    monkeypatch.setattr(persistence.compaction, 'SESSION_DOCUMENT_BUDGET_BYTES', 0)
+
+    state = SessionState(session_id='session', user_id='user')
+    answers = {}
+    for index in range(6):
+        # the last question has more edits than are kept in the session state
+        num_edits = 25 if index == 5 else 3
+        answers[index] = [f'Answer {index}, version {version}: we feed {version} families.' for version in range(num_edits)]
+        add_question(state, f'Question {index}?', answers[index])
+    store.put(state)
+
+    stored = store.get('session')
+    assert [question.is_archived for question in stored.questions] == [True, True, True, False, False, False]
+    assert len(stored.questions[5].edited_answers) == persistence.compaction.SESSION_HOT_EDITS
+
+    for index, question in enumerate(stored.questions):
+        whole = load_archived_question(store, 'session', question, index)
+        assert whole.question == f'Question {index}?'
+        assert whole.answer == answers[index][0]
+        assert whole.get_edited_answers() == answers[index]
+
+    # edits of an archived question are archived after the ones already archived, once only
+    stored.edit_last_question(0, 'Answer 0, version 3: we feed 3 families.')
+    store.put(stored)
+    store.put(store.get('session'))
+
+    whole = load_archived_question(store, 'session', store.get('session').questions[0], 0)
+    assert whole.get_edited_answers() == answers[0] + ['Answer 0, version 3: we feed 3 families.']
+
+
+def test_history_of_an_archived_answer_is_served(monkeypatch):
+    install_fakes()
+    store = InMemorySessionStore()
+    monkeypatch.setattr(persistence.session_store, '_session_store', store)
+    monkeypatch.setattr(workflow.session_state, 'EDIT_COALESCE_SECONDS', 0)
+    monkeypatch.setattr(persistence.compaction, 'SESSION_DOCUMENT_BUDGET_BYTES', 0)
+
+    session_id = str(uuid.uuid4())
+    state = SessionState(session_id=session_id, user_id='user')
+    answers = [f'We feed {version} families.' for version in range(3)]
+    for index in range(4):
+        add_question(state, f'Question {index}?', answers)
+    store.put(state)
+    assert store.get(session_id).questions[0].is_archived
+    client = TestClient(main.app)
+
+    response = client.get(f'/history/{session_id}/0', headers={'Authorization': 'Bearer user'})
+
+    assert response.status_code == 200
+    assert response.json() == {
+        'question': 'Question 0?', 'word_limit': '150', 'answer': answers[0], 'edited_answers': answers}
+    assert client.get(f'/history/{session_id}/0', headers={'Authorization': 'Bearer other'}).status_code == 404
+    assert client.get(f'/history/{session_id}/4', headers={'Authorization': 'Bearer user'}).status_code == 404
@@ -0,0 +1,46 @@
+import pytest
+
+import firestore
+from benchmarks.fakes import FakeFirestoreClient
+from persistence.firestore_session_store import FirestoreSessionStore
+from persistence.session_store import SessionConflictError
+from workflow.session_state import SessionState
+
+
+@pytest.fixture
+def store(monkeypatch):
+    monkeypatch.setattr(firestore, 'db', FakeFirestoreClient())
+    return FirestoreSessionStore()
+
+
+def test_new_session_is_created(store):
+    state = SessionState(session_id='session', user_id='user')
+
+    store.put(state)
+
+    assert store.load_revision('session') == 1
+    assert store.get('session').user_id == 'user'
+
+
+def test_session_without_revision_is_updated(store):
+    # written before revisions were introduced
+    store.save('session', {'session_id': 'session', 'user_id': 'user', 'uploaded_files': ['report.pdf']})
+    state = store.get('session')
+    assert state.revision == 0
+
+    state.add_new_question()
+    state.set_grant_application_question('What is your mission?')
+    store.put(state)
+
+    stored = store.get('session')
+    assert stored.revision == 1
+    assert stored.uploaded_files == ['report.pdf']
+    assert stored.questions[0].question == 'What is your mission?'
+
+
+def test_stale_write_over_a_session_without_revision_conflicts(store):
+    store.save('session', {'session_id': 'session', 'user_id': 'user'})
+    store.save('session', {'revision': 1})
+
+    with pytest.raises(SessionConflictError):
+        store.save('session', {'session_id': 'session', 'user_id': 'user', 'revision': 1}, expected_revision=0)
@@ -0,0 +1,85 @@
+import threading
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import persistence.session_store
+import utilities.ingestion
+from benchmarks.serve import install_fakes
+from configurations.constants import IngestionStatus
+from persistence.session_store import InMemorySessionStore
+from workflow.session_state import SessionState
+
+
+@pytest.fixture
+def store(monkeypatch):
+    install_fakes()
+    store = InMemorySessionStore()
+    monkeypatch.setattr(persistence.session_store, '_session_store', store)
+    monkeypatch.setattr(main, 'IS_MULTI_REPLICA', True)
+    monkeypatch.setattr(utilities.ingestion, 'IS_ORG_PROFILE_ENABLED', False)
+    return store
+
+
+@pytest.fixture
+def ingested():
+    '''Event set to let the ingestion jobs finish, which add the files of a session to the vector store once it is set.'''
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def get_jobs(session_id: str) -> list[utilities.ingestion.IngestionJob]:
+    with utilities.ingestion._jobs_lock:
+        return [job for job in utilities.ingestion._jobs.values() if job.state.session_id == session_id]
+
+
+def test_requests_during_an_ingestion_start_one_job(store, ingested, monkeypatch):
+    monkeypatch.setattr(utilities.ingestion, 'add_files_to_vector_store', lambda state, on_progress: ingested.wait(10))
+    session_id = str(uuid.uuid4())
+    state = SessionState(session_id=session_id, user_id='user')
+    state.set_uploaded_files(['report.pdf', 'budget.xlsx'])
+    store.put(state)
+    client = TestClient(main.app)
+
+    def request() -> None:
+        response = client.get(f'/usage/{session_id}', headers={'Authorization': 'Bearer user'})
+        assert response.status_code == 200
+
+    for _ in range(5):
+        request()
+    cached = main.sessions[uuid.UUID(session_id)]
+    assert len(get_jobs(session_id)) == 1
+    # the writes of the session's own ingestion job do not make its cached state stale
+    assert cached.revision == store.load_revision(session_id)
+
+    # reloaded once another replica writes the session, while the job is running
+    store.update(session_id, lambda stored_state: stored_state.set_uploaded_files(['report.pdf', 'budget.xlsx']))
+    request()
+    assert main.sessions[uuid.UUID(session_id)] is not cached
+
+    ingested.set()
+    assert get_jobs(session_id)[0].wait(timeout=10)
+    assert store.get(session_id).ingestion.status == IngestionStatus.SUCCEEDED
+
+    # and once it is finished
+    store.update(session_id, lambda stored_state: stored_state.set_uploaded_files(['budget.xlsx', 'report.pdf']))
+    for _ in range(3):
+        request()
+    assert len(get_jobs(session_id)) == 1
+
+
+def test_changed_files_are_ingested_again(store, ingested, monkeypatch):
+    monkeypatch.setattr(utilities.ingestion, 'add_files_to_vector_store', lambda state, on_progress: None)
+    state = SessionState(session_id=str(uuid.uuid4()), user_id='user')
+    state.set_uploaded_files(['report.pdf'])
+    store.put(state)
+
+    job = utilities.ingestion.start_ingestion(state)
+    assert job.wait(timeout=10)
+    assert not utilities.ingestion.needs_ingestion(state)
+
+    state.set_uploaded_files(['report.pdf', 'budget.xlsx'])
+    assert utilities.ingestion.needs_ingestion(state)
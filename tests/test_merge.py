@@ -0,0 +1,109 @@
+from persistence.merge import merge_documents
+from persistence.session_store import InMemorySessionStore
+from workflow.session_state import SessionState
+
+
+def test_unchanged_side_takes_the_other_one():
+    base = {'a': 1, 'b': [1, 2]}
+    changed = {'a': 2, 'b': [1, 2, 3]}
+
+    assert merge_documents(base, base, changed) == changed
+    assert merge_documents(base, changed, base) == changed
+
+
+def test_concurrent_appends_keep_both_theirs_first():
+    base = {'questions': [{'question': 'first'}]}
+    ours = {'questions': [{'question': 'first'}, {'question': 'ours'}]}
+    theirs = {'questions': [{'question': 'first'}, {'question': 'theirs'}]}
+
+    assert merge_documents(base, ours, theirs) == {
+        'questions': [{'question': 'first'}, {'question': 'theirs'}, {'question': 'ours'}]}
+
+
+def test_edits_of_different_fields_are_both_kept():
+    base = {'questions': [{'question': 'q', 'answer': 'a'}], 'user_id': 'user'}
+    ours = {'questions': [{'question': 'q', 'answer': 'our answer'}], 'user_id': 'user'}
+    theirs = {'questions': [{'question': 'their question', 'answer': 'a'}], 'user_id': 'user', 'org_profile': {'digests': []}}
+
+    assert merge_documents(base, ours, theirs) == {
+        'questions': [{'question': 'their question', 'answer': 'our answer'}],
+        'user_id': 'user',
+        'org_profile': {'digests': []}}
+
+
+def test_conflicting_edits_are_resolved_in_favour_of_ours():
+    assert merge_documents({'answer': 'a'}, {'answer': 'ours'}, {'answer': 'theirs'}) == {'answer': 'ours'}
+
+
+def test_edit_and_append_to_a_same_list_are_both_kept():
+    base = {'edits': [{'text': 'a'}]}
+    ours = {'edits': [{'text': 'edited'}]}
+    theirs = {'edits': [{'text': 'a'}, {'text': 'b'}]}
+
+    assert merge_documents(base, ours, theirs) == {'edits': [{'text': 'edited'}, {'text': 'b'}]}
+
+
+def test_key_removed_by_one_side_is_removed():
+    assert merge_documents({'a': 1, 'b': 2}, {'a': 1}, {'a': 1, 'b': 2, 'c': 3}) == {'a': 1, 'c': 3}
+
+
+def test_concurrent_writes_of_a_session_are_merged():
+    store = InMemorySessionStore()
+    state = SessionState(session_id='session', user_id='user')
+    state.add_new_question()
+    state.set_grant_application_question('What is your mission?')
+    store.put(state)
+
+    first, second = store.get('session'), store.get('session')
+    first.set_answer_to_current_grant_application_question('To feed families.')
+    second.set_uploaded_files(['report.pdf'])
+    second.add_new_question()
+    second.set_grant_application_question('What is your budget?')
+    store.put(first)
+    store.put(second)
+
+    stored = store.get('session')
+    assert stored.revision == 3
+    assert [question.question for question in stored.questions] == ['What is your mission?', 'What is your budget?']
+    assert stored.questions[0].answer == 'To feed families.'
+    assert stored.uploaded_files == ['report.pdf']
+    assert second.questions[0].answer == 'To feed families.'
+
+
+def test_concurrent_edits_of_an_answer_are_rebased():
+    store = InMemorySessionStore()
+    state = SessionState(session_id='session', user_id='user')
+    state.add_new_question()
+    state.set_answer_to_current_grant_application_question('We feed families in Boston.')
+    state.edit_last_question(0, 'We feed families in Boston.')
+    state.edit_last_question(0, 'We feed 1,000 families in Boston.')
+    store.put(state)
+
+    first, second = store.get('session'), store.get('session')
+    first.edit_last_question(0, 'We feed 1,000 families in Boston every week.')
+    second.edit_last_question(0, 'Each year, we feed 1,000 families in Greater Boston.')
+    second.edit_last_question(0, 'Each year, we feed 1,200 families in Greater Boston.')
+    store.put(first)
+    store.put(second)
+
+    question = store.get('session').questions[0]
+    assert question.current_answer == 'Each year, we feed 1,200 families in Greater Boston.'
+    assert question.get_edited_answers() == [
+        'We feed families in Boston.',
+        'We feed 1,000 families in Boston.',
+        'We feed 1,000 families in Boston every week.',
+        'Each year, we feed 1,000 families in Greater Boston.',
+        'Each year, we feed 1,200 families in Greater Boston.',
+    ]
+
+
+def test_first_edits_of_an_answer_are_rebased():
+    base = {'current_answer': None, 'edited_answers': []}
+    ours = {'current_answer': 'ours', 'edited_answers': [{'time': 2, 'changes_to_previous_answer': [], 'is_first_edit': True}]}
+    theirs = {'current_answer': 'theirs', 'edited_answers': [{'time': 1, 'changes_to_previous_answer': [], 'is_first_edit': True}]}
+
+    merged = merge_documents(base, ours, theirs)
+
+    assert merged['current_answer'] == 'ours'
+    assert [edit['is_first_edit'] for edit in merged['edited_answers']] == [True, False]
+    assert merged['edited_answers'][1]['changes_to_previous_answer'] == [{'start': 0, 'end': 4, 'text': 'theirs'}]
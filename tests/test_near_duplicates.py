@@ -0,0 +1,116 @@
+import random
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from configurations.constants import NEAR_DUPLICATE_THRESHOLD
+from utilities import document_helpers
+from utilities.document_helpers import get_files_of_chunks
+from utilities.near_duplicates import get_minhash_signature, get_shingles, remove_near_duplicates
+from workflow.session_state import SessionState
+
+_rng = random.Random(0)
+_VOCABULARY = [f'word{i}' for i in range(500)]
+
+
+def get_passage(num_words: int = 100) -> list[str]:
+    return _rng.choices(_VOCABULARY, k=num_words)
+
+
+def replace_words(words: list[str], positions: list[int]) -> list[str]:
+    words = list(words)
+    for position in positions:
+        words[position] = f'replaced{position}'
+    return words
+
+
+def jaccard(text: str, other: str) -> float:
+    shingles, other_shingles = get_shingles(text), get_shingles(other)
+    return len(shingles & other_shingles) / len(shingles | other_shingles)
+
+
+def chunk(words: list[str], source: str) -> Document:
+    return Document(page_content=' '.join(words), metadata={'source': source})
+
+
+def test_minhash_estimates_the_jaccard_similarity():
+    passage = get_passage()
+    for num_replaced in (1, 5, 10, 20):
+        edited = replace_words(passage, list(range(5, 100, 100 // num_replaced))[:num_replaced])
+        text, other = ' '.join(passage), ' '.join(edited)
+
+        estimate = np.mean(get_minhash_signature(text) == get_minhash_signature(other))
+
+        assert abs(estimate - jaccard(text, other)) < 0.1
+
+
+def test_near_duplicates_above_the_threshold_are_removed():
+    passage = get_passage()
+    near_duplicate = replace_words(passage, [50])  # similarity of about 0.9
+    assert jaccard(' '.join(passage), ' '.join(near_duplicate)) > NEAR_DUPLICATE_THRESHOLD + 0.05
+
+    other = get_passage()
+    documents = [chunk(passage, 'v1.pdf'), chunk(other, 'v1.pdf'), chunk(near_duplicate, 'v2.pdf')]
+    kept, num_removed = remove_near_duplicates(documents, NEAR_DUPLICATE_THRESHOLD)
+
+    assert num_removed == 1
+    assert [document.page_content for document in kept] == [' '.join(passage), ' '.join(other)]
+    assert kept[0].metadata['duplicates'] == 'v2.pdf#1'
+    assert kept[0].metadata['num_duplicates'] == 1
+    assert 'duplicates' not in kept[1].metadata
+
+
+def test_similar_chunks_below_the_threshold_are_kept():
+    passage = get_passage()
+    edited = replace_words(passage, list(range(5, 100, 10)))  # similarity of about 0.3
+    assert jaccard(' '.join(passage), ' '.join(edited)) < NEAR_DUPLICATE_THRESHOLD - 0.2
+
+    kept, num_removed = remove_near_duplicates([chunk(passage, 'a.pdf'), chunk(edited, 'b.pdf')], NEAR_DUPLICATE_THRESHOLD)
+
+    assert num_removed == 0
+    assert len(kept) == 2
+
+
+def test_case_and_punctuation_are_ignored():
+    passage = get_passage()
+    documents = [
+        chunk(passage, 'a.pdf'),
+        Document(page_content=', '.join(word.upper() for word in passage) + '.', metadata={'source': 'a.pdf'})]
+
+    kept, num_removed = remove_near_duplicates(documents, NEAR_DUPLICATE_THRESHOLD)
+
+    assert num_removed == 1
+    assert kept[0].metadata['duplicates'] == 'a.pdf#2'
+
+
+class StoredChunks:
+    '''Vector store holding the chunks of a session, as add_files_to_vector_store reads them.'''
+
+    def __init__(self, metadatas: list[dict]):
+        self.metadatas = metadatas
+
+    def get(self, where: dict) -> dict:
+        return {'ids': [str(i) for i in range(len(self.metadatas))], 'metadatas': self.metadatas}
+
+
+def test_files_whose_chunks_are_all_duplicates_are_ingested(monkeypatch):
+    passage = get_passage()
+    kept, _ = remove_near_duplicates(
+        [chunk(passage, 'v1.pdf'), chunk(get_passage(), 'v1.pdf'), chunk(replace_words(passage, [50]), 'v2.pdf')],
+        NEAR_DUPLICATE_THRESHOLD)
+    metadatas = [document.metadata | {'session_id': 'session'} for document in kept]
+    assert get_files_of_chunks(metadatas) == {'v1', 'v2'}
+
+    def chunk_files(**kwargs):
+        raise AssertionError('files already in the vector store are chunked again')
+
+    monkeypatch.setattr(document_helpers, 'get_vector_store', lambda: StoredChunks(metadatas))
+    monkeypatch.setattr(document_helpers, 'get_documents_chunks_for_files', chunk_files)
+    monkeypatch.setattr(document_helpers, 'IS_DEV_MODE', False)
+    state = SessionState(session_id='session', user_id='user')
+    state.set_uploaded_files(['v1.pdf', 'v2.pdf'])
+    events = []
+
+    document_helpers.add_files_to_vector_store(state, on_progress=events.append)
+
+    assert events == [{'event': 'already_embedded', 'num_files': 2}]
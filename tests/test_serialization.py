@@ -0,0 +1,44 @@
+import datetime
+
+from configurations.constants import Component, IngestionStatus
+from persistence.serialization import deserialize_to_dataclass, from_json, serialize_dataclass, to_json
+from workflow.session_state import EditedAnswer, IngestionContext, SessionState
+from workflow.text_changes import TextChange
+
+
+def round_trip(state: SessionState) -> SessionState:
+    return deserialize_to_dataclass(SessionState, from_json(to_json(serialize_dataclass(state))))
+
+
+def test_optional_enum_is_deserialized_as_enum():
+    state = SessionState(session_id='session', user_id='user', last_user_input=Component.WORD_LIMIT)
+
+    restored = round_trip(state)
+
+    assert isinstance(restored.last_user_input, Component)
+    assert restored.last_user_input == Component.WORD_LIMIT
+
+
+def test_unset_optional_enum_stays_none():
+    assert round_trip(SessionState(session_id='session', user_id='user')).last_user_input is None
+
+
+def test_nested_dataclasses_enums_and_datetimes_round_trip():
+    state = SessionState(
+        session_id='session',
+        user_id='user',
+        ingestion=IngestionContext(job_id='job', status=IngestionStatus.SUCCEEDED, started_at=1.5, num_files=2))
+    state.add_new_question()
+    state.set_grant_application_question('What is your mission?')
+    edit_time = datetime.datetime(2024, 5, 1, 12, 30, tzinfo=datetime.timezone.utc)
+    state.get_last_question_context().edited_answers.append(EditedAnswer(
+        time=edit_time, changes_to_previous_answer=[TextChange(start=0, end=3, text='Our')], is_first_edit=True))
+
+    restored = round_trip(state)
+
+    assert restored.ingestion == state.ingestion
+    assert isinstance(restored.ingestion.status, IngestionStatus)
+    edited_answer = restored.get_last_question_context().edited_answers[0]
+    assert edited_answer.time == edit_time
+    assert edited_answer.changes_to_previous_answer == [TextChange(start=0, end=3, text='Our')]
+    assert restored.get_last_question_context().question == 'What is your mission?'
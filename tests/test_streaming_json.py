@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from utilities.streaming_json import StreamingJSONParser
+
+DOCUMENTS = [
+    '{"answer": "Our mission is to feed 1,000 families.", "confidence": 0.9}',
+    '{"text": "quote \\" backslash \\\\ slash \\/ \\b\\f\\n\\r\\t tab"}',
+    '{"accents": "caf\\u00e9 na\\u00EFve", "emoji": "smile \\ud83d\\ude00 and \\ud83c\\udf89!"}',
+    '{"raw": "café 😀 — naïve"}',
+    '  {"items": [1, -2.5e3, true, false, null, [], {}, [[]], {"nested": ["a", "b"]}]}  ',
+    '["first", {"key": "value"}, 42]',
+    '"a root string"',
+    '-12.75',
+    'null',
+]
+
+
+def parse(chunks: list[str]) -> tuple[object, dict, list]:
+    '''Parse a document fed in chunks, returning its value, the text streamed for each string and the values reported.'''
+    deltas, values = {}, []
+    parser = StreamingJSONParser(
+        on_string_delta=lambda path, text: deltas.__setitem__(path, deltas.get(path, '') + text),
+        on_value=lambda path, value: values.append((path, value)))
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close(), deltas, values
+
+
+@pytest.mark.parametrize('document', DOCUMENTS)
+def test_every_split_point_parses_like_json_loads(document):
+    expected = json.loads(document)
+
+    for split in range(len(document) + 1):
+        value, _, values = parse([document[:split], document[split:]])
+
+        assert value == expected, f'split at {split}'
+        assert values[-1] == ((), expected)
+
+
+@pytest.mark.parametrize('document', DOCUMENTS)
+def test_strings_are_streamed_in_full_one_character_at_a_time(document):
+    value, deltas, values = parse(list(document))
+
+    assert value == json.loads(document)
+    for path, string in values:
+        if isinstance(string, str):
+            assert deltas[path] == string
+
+
+def test_values_are_reported_with_their_path():
+    _, _, values = parse(['{"a": [1, {"b": "c"}]}'])
+
+    assert values == [
+        (('a', 0), 1),
+        (('a', 1, 'b'), 'c'),
+        (('a', 1), {'b': 'c'}),
+        (('a',), [1, {'b': 'c'}]),
+        ((), {'a': [1, {'b': 'c'}]}),
+    ]
+
+
+@pytest.mark.parametrize('document', ['{"a" 1}', '[1 2]', '{"a": "\\x"}', '{"a": tru}', '{"a": 1}}', '"\\u12g4"'])
+def test_invalid_documents_raise(document):
+    with pytest.raises(ValueError):
+        parse(list(document))
+
+
+def test_incomplete_document_raises_on_close():
+    parser = StreamingJSONParser()
+    parser.feed('{"answer": "unfinished')
+
+    with pytest.raises(ValueError):
+        parser.close()
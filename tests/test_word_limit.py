@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+from utilities.llm_streaming_utils import WordLimitedText, trim_to_word_limit
+
+ANSWER = (
+    'Our pantry feeds 1,200 families a week. Volunteers sort 3.5 tons of food!\n\n'
+    'The grant will fund two vans and a driver. In conclusion, your support keeps our shelves full.')
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def test_answer_within_the_limit_is_kept():
+    assert trim_to_word_limit(ANSWER, count_words(ANSWER)) == ANSWER
+
+
+def test_answer_over_the_limit_is_cut_at_the_end_of_its_last_sentence():
+    # the conclusion is dropped rather than the answer being rewritten to fit
+    assert trim_to_word_limit(ANSWER, 25) == (
+        'Our pantry feeds 1,200 families a week. Volunteers sort 3.5 tons of food!\n\n'
+        'The grant will fund two vans and a driver.')
+
+
+def test_answer_without_a_sentence_ending_in_the_last_third_is_cut_at_the_limit():
+    assert trim_to_word_limit(ANSWER, 11) == 'Our pantry feeds 1,200 families a week. Volunteers sort 3.5 tons'
+
+
+def stream(text: str, max_words: int, rng: random.Random) -> tuple[str, WordLimitedText]:
+    '''Stream a text in random tokens, until it is over the limit, returning the text streamed.'''
+    limited_text = WordLimitedText(max_words)
+    streamed, position = [], 0
+    while position < len(text) and not limited_text.is_over_limit:
+        token = text[position:position + rng.randint(1, 6)]
+        position += len(token)
+        streamed.append(limited_text.add(token))
+    streamed.append(limited_text.flush())
+    return ''.join(streamed), limited_text
+
+
+@pytest.mark.parametrize('max_words', [5, 12, 19, 25, 32, 100])
+def test_streamed_text_is_the_answer_kept(max_words):
+    rng = random.Random(max_words)
+    for _ in range(50):
+        streamed, limited_text = stream(ANSWER, max_words, rng)
+
+        assert streamed == limited_text.text == trim_to_word_limit(ANSWER, max_words)
+        assert count_words(streamed) <= max_words
+        assert limited_text.is_over_limit == (count_words(ANSWER) > max_words)
+
+
+def test_streamed_random_answers_are_the_answers_kept():
+    rng = random.Random(0)
+    words = ['grant', 'food', '1.5', 'families.', 'vans!', 'why?', 'the', 'we\n\n', 'and', 'serve']
+    for _ in range(300):
+        answer = ' '.join(rng.choices(words, k=rng.randint(1, 60)))
+        max_words = rng.randint(1, 50)
+
+        streamed, limited_text = stream(answer, max_words, rng)
+
+        expected = trim_to_word_limit(answer, max_words) if count_words(answer) > max_words else answer
+        assert streamed == limited_text.text == expected
@@ -1,34 +1,87 @@
+from __future__ import annotations
+
 import logging
 import os
 import tempfile
-from devtools import debug
+import uuid
+from collections.abc import Callable
+from typing import TYPE_CHECKING
+
+from configurations.constants import (
+    CHROMA_COLLECTION,
+    CHROMA_HOST,
+    CHROMA_PERSIST_DIRECTORY,
+    CHROMA_PORT,
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_MODEL,
+    IS_DEV_MODE,
+    GPT_MODEL,
+    NEAR_DUPLICATE_THRESHOLD,
+    VECTOR_INDEX_QUANTIZATION,
+    Quantization
+)
+from firestore import download_file, get_file_blobs_for_user
+from utilities.instrumentation import NEAR_DUPLICATE_CHUNKS, span
+from utilities.logging_utils import LogCategory, log_lazy
+from workflow.session_state import SessionState
 
-import tiktoken
+# LangChain, Chroma, tiktoken and Unstructured are heavy to import, so they are imported lazily at first use
+if TYPE_CHECKING:
+    from chromadb import Collection
+    from langchain.docstore.document import Document
+    from langchain_community.vectorstores.chroma import Chroma
+    from utilities.vector_index import QuantizedVectorStore
 
-from langchain.docstore.document import Document
-from langchain_community.document_loaders import UnstructuredFileLoader
-from langchain_openai import OpenAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores.chroma import Chroma
+logger = logging.getLogger(__name__)
 
-from configurations.constants import IS_DEV_MODE, GPT_MODEL
-from firestore import get_files_for_user
-from workflow.session_state import SessionState
+# Callback receiving the progress events of document ingestion (eg. {'event': 'file_processed', 'file_name': ...})
+ProgressCallback = Callable[[dict], None]
 
-logger = logging.getLogger(__name__)
 
+# Vector store holding the embeddings of all sessions, created by get_vector_store() on first use
+VECTOR_STORE: Chroma | QuantizedVectorStore | None = None
+# Chroma collection of the vector store, if any, to which the embeddings computed by the batched requests are written
+CHROMA_STORE_COLLECTION: Collection | None = None
 
-VECTOR_STORE: Chroma = Chroma(embedding_function=OpenAIEmbeddings(client=None, model='text-embedding-3-large', dimensions=1024))
 
-def print_pretty_index(index: int):
+def get_vector_store() -> Chroma | QuantizedVectorStore:
     '''
-    Print pretty index for document chunks with index+1 surrounded by underscores
-    
-        Parameters:
-            index (int): index to print pretty
+    Get the vector store, creating it (and importing Chroma and OpenAI embeddings) on first call
+
+        Returns:
+            Chroma | QuantizedVectorStore: vector store holding the document chunks embeddings of all sessions, shared by
+                all replicas if CHROMA_HOST or CHROMA_PERSIST_DIRECTORY is set, and searched in in-memory indexes of
+                quantized embeddings unless VECTOR_INDEX_QUANTIZATION is float32
     '''
-    print(f"{'_'*35}\n|{'_'*15} {index+1} {'_'*15}|\n")
-    
+    global VECTOR_STORE, CHROMA_STORE_COLLECTION
+    if VECTOR_STORE is None:
+        from langchain_community.vectorstores.chroma import Chroma
+        from utilities.embeddings import BatchedOpenAIEmbeddings
+
+        embeddings = BatchedOpenAIEmbeddings(model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+        chroma: Chroma | None = None
+        if CHROMA_HOST or CHROMA_PERSIST_DIRECTORY or VECTOR_INDEX_QUANTIZATION == Quantization.FLOAT32:
+            import chromadb
+            if CHROMA_HOST:
+                client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+            elif CHROMA_PERSIST_DIRECTORY:
+                client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIRECTORY)
+            else:
+                client = chromadb.EphemeralClient()
+            chroma = Chroma(collection_name=CHROMA_COLLECTION, embedding_function=embeddings, client=client)
+            # the collection as Chroma creates it, without an embedding function of its own
+            CHROMA_STORE_COLLECTION = client.get_or_create_collection(CHROMA_COLLECTION, embedding_function=None)
+
+        if VECTOR_INDEX_QUANTIZATION != Quantization.FLOAT32:
+            from utilities.vector_index import QuantizedVectorStore
+            VECTOR_STORE = QuantizedVectorStore(embeddings, VECTOR_INDEX_QUANTIZATION, chroma=chroma, chroma_collection=CHROMA_STORE_COLLECTION)
+        else:
+            VECTOR_STORE = chroma
+        logger.info(
+            f'Vector store: {CHROMA_HOST or CHROMA_PERSIST_DIRECTORY or "in memory"}, '
+            f'{EMBEDDING_DIMENSIONS} dimensions searched as {VECTOR_INDEX_QUANTIZATION}')
+
+    return VECTOR_STORE
 
 def get_token_count_in_text(text: str, model: str = GPT_MODEL) -> int:
     '''
@@ -41,6 +94,8 @@ def get_token_count_in_text(text: str, model: str = GPT_MODEL) -> int:
             Returns:
                 int: token count in text
     '''
+    import tiktoken
+
     return len(tiktoken.encoding_for_model(model).encode(text))
 
 
@@ -60,7 +115,8 @@ def get_token_count_in_documents(documents: list[Document], model: str = GPT_MOD
 
 def add_index_and_current_token_count_to_metadata_in_documents(
     documents: list[Document],
-    model: str = GPT_MODEL
+    model: str = GPT_MODEL,
+    token_counts: list[int] | None = None
 ) -> None:
     '''
     Add index and current token count to metadata in documents
@@ -68,51 +124,76 @@ def add_index_and_current_token_count_to_metadata_in_documents(
         Parameters:
             documents (list[Document]): list of documents to add index and current token count to metadata
             model (str): name of the model to use for tokenization (default: GPT_MODEL)
+            token_counts (list[int] | None): token count of each document, if already known (default: None)
         
     '''
-    for i, doc in enumerate(documents):
-        doc.metadata['current_token_count'] = get_token_count_in_text(doc.page_content, model)
+    if token_counts is None:
+        token_counts = get_token_count_in_documents(documents, model)
+    for i, (doc, token_count) in enumerate(zip(documents, token_counts)):
+        doc.metadata['current_token_count'] = token_count
         doc.metadata['index'] = i + 1
 
 
-def create_document(file: dict[str, str]) -> Document:
+def create_document(file: dict[str, str], token_count: int | None = None) -> Document:
     '''
     Create document from file and return it
 
         Parameters:
-            file (dict[str, str]): dictionary containing file name and content
+            file (dict[str, str]): dictionary containing file name and content, and optionally the key of the content in
+                the extraction cache ('content_key')
+            token_count (int | None): token count of the content, if already known (default: None)
         
         Returns:
             Document: document created from file
     '''
-
-    document = Document(
-        page_content=file['content'],
-        metadata={'source': file['file_name'], 'original_token_count': get_token_count_in_text(file['content'])}
-    )
-
-    # print document created from txt file and its token count in metadata
-    print(f'• Document containing {document.metadata["original_token_count"]} tokens created from txt file \'{document.metadata["source"].split("/")[-1]}\'')
+    from langchain.docstore.document import Document
+
+    metadata = {
+        'source': file['file_name'],
+        'original_token_count': token_count if token_count is not None else get_token_count_in_text(file['content'])}
+    if file.get('content_key'):
+        metadata['content_key'] = file['content_key']
+    document = Document(page_content=file['content'], metadata=metadata)
+
+    # log document created from txt file and its token count in metadata
+    log_lazy(LogCategory.CHUNKS, logging.DEBUG, 'Document created from file', lambda: {
+        'source': document.metadata['source'].split('/')[-1],
+        'token_count': document.metadata['original_token_count']})
     
     return document
 
 
-def create_documents_from_files(file_names: list[str], user_id: str) -> list[Document]:
+def create_documents_from_files(file_names: list[str], user_id: str, on_progress: ProgressCallback | None = None) -> list[Document]:
     '''
-    Create list of (type) Documents from files of different types and return it
+    Create list of (type) Documents from files of different types and return it. Only the metadata of the files is
+    fetched from Storage for the files whose text is in the extraction cache, the others are downloaded and parsed.
     
         Parameters:
             files (list[str]): list of paths to files
             user_id (str): user ID for file retrieval
+            on_progress (ProgressCallback | None): callback notified of each file processed (default: None)
         
         Returns:
             list[Document]: list of documents created
     '''
+    on_progress = on_progress or (lambda _: None)
+
+    from utilities.extraction_cache import get_extraction_cache, get_extraction_key
+
+    extraction_cache = get_extraction_cache()
 
     documents: list[Document] = []
-    files = get_files_for_user(file_names, user_id)
-    for file in files:
+    for file_name, blob in get_file_blobs_for_user(file_names, user_id).items():
+        file = {'file_name': file_name, 'content_key': get_extraction_key(file_name, blob) if extraction_cache else None}
         try:
+            if file['content_key'] and (cached := extraction_cache.get_text(file['content_key'])) is not None:
+                file['content'], token_count = cached
+                document = create_document(file, token_count)
+                documents.append(document)
+                on_progress({'event': 'file_processed', 'file_name': file_name, 'token_count': token_count, 'cached': True})
+                continue
+
+            file['content'] = download_file(file_name, blob)
             if file['file_name'].endswith('.docx'):
                 # Handle .docx files by writing byte content to a temporary file
                 with tempfile.NamedTemporaryFile(delete=False, suffix='.docx') as tmp:
@@ -120,33 +201,67 @@ def create_documents_from_files(file_names: list[str], user_id: str) -> list[Doc
                     tmp_path = tmp.name  # Get the path of the temporary file
 
                 # Load .docx file using UnstructuredFileLoader with the file path
+                from langchain_community.document_loaders import UnstructuredFileLoader
                 loader = UnstructuredFileLoader(
                     tmp_path,
                     mode="single"
                 )
-                file['content'] = loader.load()[0].page_content
+                with span('file_parse', file_type='docx'):
+                    file['content'] = loader.load()[0].page_content
                 os.remove(tmp_path)  # Clean up the temporary file
 
             # For .txt and other types that don't need special processing
             document = create_document(file)
             documents.append(document)
+            if file['content_key']:
+                extraction_cache.put_text(file['content_key'], document.page_content, document.metadata['original_token_count'])
+            on_progress({
+                'event': 'file_processed',
+                'file_name': file['file_name'],
+                'token_count': document.metadata['original_token_count'],
+                'cached': False})
         except Exception as e:
             logger.error(f'Error processing file {file["file_name"]}: {e}')
+            on_progress({'event': 'file_failed', 'file_name': file['file_name'], 'error': str(e)})
 
-    print(f'\n{len(documents)} Documents created from given list of files')
+    log_lazy(LogCategory.CHUNKS, logging.DEBUG, f'{len(documents)} Documents created from given list of files')
 
     return documents
 
 
+def get_chunk_boundaries(text: str, chunks: list[Document]) -> list[tuple[int, int]] | None:
+    '''
+    Get the start and end offsets of each chunk split from a text, in order (chunks may overlap)
+
+        Parameters:
+            text (str): text that was split
+            chunks (list[Document]): chunks split from the text
+
+        Returns:
+            list[tuple[int, int]] | None: offsets of each chunk, None if a chunk is not found in the text
+    '''
+    boundaries = []
+    start = 0
+    for chunk in chunks:
+        start = text.find(chunk.page_content, start)
+        if start == -1:
+            return None
+        boundaries.append((start, start + len(chunk.page_content)))
+        start += 1
+    return boundaries
+
+
 def get_documents_chunks_from_documents(
     documents: list[Document],
     model=GPT_MODEL,
     chunk_size=4000,
     chunk_overlap=400,
-    separators=["\n\n", "\n"]
+    separators=["\n\n", "\n"],
+    near_duplicate_threshold: float = NEAR_DUPLICATE_THRESHOLD
 ) -> list[Document]:
     '''
-    Get list of (type) Documents containing chunks of documents with given model name, chunk size, chunk overlap and separators
+    Get list of (type) Documents containing chunks of documents with given model name, chunk size, chunk overlap and separators,
+    without the chunks that are near duplicates of a previous chunk
     
         Parameters:
             documents (list[Document]): list of documents to split into chunks
@@ -154,11 +269,20 @@ def get_documents_chunks_from_documents(
             chunk_size (int): max token size of chunks (default: 4000)
             chunk_overlap (int): max overlap of chunks (default: 400)
             separators (list[str]): list of separators to use for splitting documents into chunks (default: ["\n\n", "\n"])
+            near_duplicate_threshold (float): similarity above which a chunk is a near duplicate of a previous one, 0 to
+                keep all chunks (default: NEAR_DUPLICATE_THRESHOLD)
         
         Returns:
             list[Document]: list of documents containing chunks of documents
     '''
 
+    from langchain.docstore.document import Document
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from utilities.extraction_cache import CachedChunks, get_extraction_cache
+
+    extraction_cache = get_extraction_cache()
+    chunking_parameters = dict(model=model, chunk_size=chunk_size, chunk_overlap=chunk_overlap, separators=separators)
+
     # create text splitter for splitting documents into chunks
     text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
         model_name=model,
@@ -166,21 +290,53 @@ def get_documents_chunks_from_documents(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap)
 
-    print(f'\nSplitting original Documents using separators {separators} into chunks ' +
-        f'with max token size of {chunk_size} and max overlap of {chunk_overlap}\n')
-
-    # split documents into chunks
-    documents_chunks = text_splitter.split_documents(documents)
-
-    print(f'{len(documents_chunks)} Documents created after split:')
+    # split documents into chunks, or rebuild the chunks of the documents whose chunk boundaries are cached
+    documents_chunks: list[Document] = []
+    token_counts: list[int] = []
+    with span('chunking', model=model, num_documents=len(documents)):
+        for document in documents:
+            content_key = document.metadata.get('content_key') if extraction_cache else None
+            if content_key and (cached := extraction_cache.get_chunks(content_key, chunking_parameters)) is not None:
+                documents_chunks.extend(
+                    Document(page_content=document.page_content[start:end], metadata=dict(document.metadata))
+                    for start, end in cached.boundaries)
+                token_counts.extend(cached.token_counts)
+                continue
+
+            chunks = text_splitter.split_documents([document])
+            chunks_token_counts = get_token_count_in_documents(chunks, model)
+            documents_chunks.extend(chunks)
+            token_counts.extend(chunks_token_counts)
+            if content_key and (boundaries := get_chunk_boundaries(document.page_content, chunks)) is not None:
+                extraction_cache.put_chunks(content_key, chunking_parameters, CachedChunks(boundaries, chunks_token_counts))
+
+    # remove the chunks that are near duplicates of previous ones (eg. in several versions of an application), recording
+    # their provenance in the metadata of the chunk that is kept
+    if near_duplicate_threshold > 0 and len(documents_chunks) > 1:
+        from utilities.near_duplicates import remove_near_duplicates
+
+        token_count_by_chunk = {id(doc): token_count for doc, token_count in zip(documents_chunks, token_counts)}
+        with span('near_duplicates', num_chunks=len(documents_chunks)):
+            documents_chunks, num_duplicates = remove_near_duplicates(documents_chunks, near_duplicate_threshold)
+        token_counts = [token_count_by_chunk[id(doc)] for doc in documents_chunks]
+        NEAR_DUPLICATE_CHUNKS.inc(num_duplicates)
+        log_lazy(LogCategory.CHUNKS, logging.DEBUG, f'{num_duplicates} near duplicate chunks removed', lambda: {
+            'threshold': near_duplicate_threshold,
+            'duplicates': [
+                f'{doc.metadata["source"].rsplit("/", 1)[-1]}: {doc.metadata["duplicates"]}'
+                for doc in documents_chunks if 'duplicates' in doc.metadata]})
 
     # add current token count and index to metadata for each document
-    add_index_and_current_token_count_to_metadata_in_documents(documents_chunks)
+    add_index_and_current_token_count_to_metadata_in_documents(documents_chunks, model, token_counts)
 
-    # print summary of metadata for each document
-    for doc in documents_chunks:
-        print(f'• {doc.metadata["current_token_count"]} tokens in documents chunks from source \'{doc.metadata["source"].rsplit("/", 1)[-1]}\'')
-    print()
+    # log summary of metadata for each document
+    log_lazy(LogCategory.CHUNKS, logging.DEBUG, f'{len(documents_chunks)} Documents created after split', lambda: {
+        'separators': separators,
+        'chunk_size': chunk_size,
+        'chunk_overlap': chunk_overlap,
+        'chunks': [
+            f'{doc.metadata["current_token_count"]} tokens from source \'{doc.metadata["source"].rsplit("/", 1)[-1]}\''
+            for doc in documents_chunks]})
 
     return documents_chunks
     
@@ -191,7 +347,8 @@ def get_documents_chunks_for_files(
     model=GPT_MODEL,
     chunk_size=4000,
     chunk_overlap=400,
-    separators=["\n\n", "\n"]
+    separators=["\n\n", "\n"],
+    on_progress: ProgressCallback | None = None
 ) -> list[Document]:
     '''
     Split documents into chunks with max token size of chunk_size and
@@ -204,53 +361,49 @@ def get_documents_chunks_for_files(
             chunk_size (int): max token size of each chunk (default: 4000)
             chunk_overlap (int): max overlap of each chunk (default: 400)
             separators (list[str]): list of separators to use for splitting text into chunks (default: ["\n\n", "\n"])
+            on_progress (ProgressCallback | None): callback notified of each file processed (default: None)
 
         Returns:
             list[Document]: list of documents chunks created from files
     '''
 
-    documents = create_documents_from_files(files, user_id)
+    documents = create_documents_from_files(files, user_id, on_progress)
 
     return get_documents_chunks_from_documents(documents, model, chunk_size, chunk_overlap, separators)
 
 
 def print_summary_of_relevant_documents_and_scored(docs: list[tuple[Document, float]]):
+    log_lazy(LogCategory.RETRIEVAL, logging.DEBUG, f'Retrieved {len(docs)} most relevant Documents', lambda: {
+        'Similarities (distance)': [f'{score:.3f}' for _, score in docs],
+        'Sources': [doc.metadata['source'].rsplit('/', 1)[-1] for doc, _ in docs],
+        'Total token count of relevant documents': sum(doc.metadata['current_token_count'] for doc, _ in docs)})
 
-    debug(**{'Similarities (distance)': [f'{score:.3f}' for _, score in docs]})
-
-    # print summary of each relevant document and its similarity score (distance) to question
-    '''for i, (doc, score) in enumerate(docs):
-        print_pretty_index(i)
-        words = doc.page_content.split()
-        debug(**{
-            'Similarity score (distance)': f'{score:.3f}',
-            'Index': doc.metadata['index'],
-            'Character length of chunk': len(doc.page_content),
-            'Token count of chunk': doc.metadata['current_token_count'],
-            'Source': doc.metadata['source'].rsplit("/", 1)[-1],
-            'Session ID': doc.metadata['session_id'],
-            'Content (Preview of first and last 15 words)': ' '.join(words[:15]) + ' ... ' + ' '.join(words[-15:]),
-        })
-    '''
-
-    # print total token count of relevant documents
-    debug(**{'Total token count of relevant documents': sum([doc.metadata["current_token_count"] for doc, _ in docs])})
 
+def get_files_of_chunks(metadatas: list[dict]) -> set[str]:
+    '''
+    Get the files (without their extension) of chunks in the vector store, and of the near duplicates they replaced (see
+    near_duplicates.py), as all the chunks of a file may have been dropped as duplicates of the chunks of other files
+    '''
+    sources = set()
+    for metadata in metadatas:
+        sources.add(metadata['source'])
+        sources.update(duplicate.rsplit('#', 1)[0] for duplicate in metadata.get('duplicates', '').split(',') if duplicate)
+    return {source.rsplit('.', 1)[0] for source in sources}
 
-def add_files_to_vector_store(state: SessionState):
+def add_files_to_vector_store(state: SessionState, on_progress: ProgressCallback | None = None):
     '''
-    Get vector store for files uploaded by user and return it
-        Parameters:
-            session_id (str): session ID of the user
-            files (list[str]): list of paths to files uploaded by user
-            tokens_per_doc_chunk (int): number of tokens per document chunk (default: 1000)
+    Add the chunks of the files uploaded by the user to the vector store, unless they are already in it
 
-        Returns:
-            VectorStore: vector store for files uploaded by user
+        Parameters:
+            state (SessionState): session state holding the session ID, user ID and files uploaded by the user
+            on_progress (ProgressCallback | None): callback notified of each file processed and of each embedding request
+                completed (default: None)
     '''
+    on_progress = on_progress or (lambda _: None)
+    vector_store = get_vector_store()
 
     # get the files in the vector store
-    files_for_session = set(md['source'].rsplit('.', 1)[0] for md in VECTOR_STORE.get(where={'session_id': state.session_id})['metadatas'])
+    files_for_session = get_files_of_chunks(vector_store.get(where={'session_id': state.session_id})['metadatas'])
 
     # get the files uploaded by the user
     files_uploaded = set(file.rsplit('.', 1)[0] for file in state.uploaded_files)
@@ -262,16 +415,32 @@ def add_files_to_vector_store(state: SessionState):
             files=state.uploaded_files,
             user_id=state.user_id,
             chunk_size=state.get_num_of_tokens_per_doc_chunk(),
-            chunk_overlap=150)
+            chunk_overlap=150,
+            on_progress=on_progress)
+        on_progress({'event': 'chunked', 'num_chunks': len(documents_chunks)})
 
         # delete the current embeddings in the vector store
         if files_for_session:
-            VECTOR_STORE.delete(ids=VECTOR_STORE.get(where={'session_id': state.session_id})['ids'])
-
-        # add the documents chunks to the vector store as embeddings
-        VECTOR_STORE.add_texts(
-            texts=[doc.page_content for doc in documents_chunks],
-            metadatas=[doc.metadata | {"session_id": state.session_id} for doc in documents_chunks])
+            vector_store.delete(ids=vector_store.get(where={'session_id': state.session_id})['ids'])
+
+        # embed the documents chunks with concurrent batched requests, reporting progress as requests complete,
+        # and add them to the vector store with their embeddings
+        texts = [doc.page_content for doc in documents_chunks]
+        with span('embedding', model=EMBEDDING_MODEL, num_chunks=len(documents_chunks)):
+            embeddings = vector_store.embeddings.embed_documents(texts, on_progress=lambda num_embedded, num_chunks: on_progress({
+                'event': 'chunks_embedded',
+                'num_chunks_embedded': num_embedded,
+                'num_chunks': num_chunks}))
+
+        if documents_chunks:
+            ids = [str(uuid.uuid4()) for _ in documents_chunks]
+            metadatas = [doc.metadata | {"session_id": state.session_id} for doc in documents_chunks]
+            if VECTOR_INDEX_QUANTIZATION != Quantization.FLOAT32:
+                vector_store.add_embeddings(texts, embeddings, metadatas, ids)
+            else:
+                CHROMA_STORE_COLLECTION.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=texts)
+    else:
+        on_progress({'event': 'already_embedded', 'num_files': len(files_uploaded)})
 
 def get_most_relevant_docs_in_vector_store_for_answering_question(
     session_id: str,
@@ -290,12 +459,15 @@ def get_most_relevant_docs_in_vector_store_for_answering_question(
     '''
 
     # perform similarity search in vector store for question and return the n_results most relevant documents
-    relevant_docs_and_scores = VECTOR_STORE.similarity_search_with_score(query=question, k=n_results, filter={'session_id': session_id})
+    with span('retrieval', model=EMBEDDING_MODEL, k=n_results):
+        relevant_docs_and_scores = get_vector_store().similarity_search_with_score(query=question, k=n_results, filter={'session_id': session_id})
 
-    print(f'Retrieved {n_results} most relevant Documents by performing a similarity search for question "{question}"')
     print_summary_of_relevant_documents_and_scored(relevant_docs_and_scores)
 
-    # return list of the relevant documents without their similarity scores
-    relevant_docs = [doc for doc, _ in relevant_docs_and_scores]
+    # return list of the relevant documents without their similarity scores, in the order of the documents rather than of
+    # their scores, so that questions retrieving the same chunks get the same context (and prompt prefix)
+    relevant_docs = sorted(
+        (doc for doc, _ in relevant_docs_and_scores),
+        key=lambda doc: (doc.metadata.get('source', ''), doc.metadata.get('index', 0)))
 
     return relevant_docs
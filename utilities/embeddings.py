@@ -0,0 +1,191 @@
+import logging
+import random
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+
+from langchain_core.embeddings import Embeddings
+
+from configurations.constants import (
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_ENCODING,
+    EMBEDDING_MAX_CONCURRENCY,
+    EMBEDDING_MAX_RETRIES,
+    EMBEDDING_MAX_TEXTS_PER_REQUEST,
+    EMBEDDING_MAX_TOKENS_PER_REQUEST,
+    EMBEDDING_MAX_TOKENS_PER_TEXT,
+    EMBEDDING_MODEL,
+    EMBEDDING_TOKENS_PER_MINUTE
+)
+from utilities.instrumentation import EMBEDDING_RETRIES, EMBEDDING_TOKENS_PER_SECOND, record_embedding_usage, span
+from utilities.usage_ledger import record_usage
+
+logger = logging.getLogger(__name__)
+
+# Base and max delay of the exponential backoff between retries of a failed request (full jitter)
+RETRY_BASE_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 60.0
+
+
+class TokenRateLimiter:
+    '''Token bucket allowing at most tokens_per_minute tokens per minute, with bursts of up to a minute's worth.'''
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self._available = float(tokens_per_minute)
+        self._updated_at = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self, num_tokens: int) -> None:
+        '''Block until num_tokens tokens can be spent without exceeding the rate, and spend them.'''
+        num_tokens = min(num_tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._available = min(self.capacity, self._available + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._available >= num_tokens:
+                    self._available -= num_tokens
+                    return
+                wait = (num_tokens - self._available) / self.rate
+            time.sleep(wait)
+
+
+class BatchedOpenAIEmbeddings(Embeddings):
+    '''
+    OpenAI embeddings packing texts into requests by token and text count, sending several requests concurrently
+    under a tokens per minute limit, and retrying rate limited (429) and failed requests with jittered backoff
+    '''
+
+    def __init__(
+        self,
+        model: str = EMBEDDING_MODEL,
+        dimensions: int | None = EMBEDDING_DIMENSIONS,
+        max_tokens_per_request: int = EMBEDDING_MAX_TOKENS_PER_REQUEST,
+        max_texts_per_request: int = EMBEDDING_MAX_TEXTS_PER_REQUEST,
+        max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+        tokens_per_minute: int = EMBEDDING_TOKENS_PER_MINUTE,
+        max_retries: int = EMBEDDING_MAX_RETRIES
+    ):
+        import openai
+        import tiktoken
+
+        self.model = model
+        self.dimensions = dimensions
+        self.max_tokens_per_request = max_tokens_per_request
+        self.max_texts_per_request = max_texts_per_request
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.rate_limiter = TokenRateLimiter(tokens_per_minute)
+
+        # retries are handled here, to back off from rate limits shared by all concurrent requests
+        self._client = openai.OpenAI(max_retries=0)
+        self._encoding = tiktoken.get_encoding(EMBEDDING_ENCODING)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='embedding')
+
+    def embed_documents(self, texts: list[str], on_progress: Callable[[int, int], None] | None = None) -> list[list[float]]:
+        '''
+        Embed texts with as few requests as the request limits allow, sent concurrently
+
+            Parameters:
+                texts (list[str]): texts to embed
+                on_progress (Callable[[int, int], None] | None): called with the number of texts embedded so far
+                    and the total number of texts each time a request completes (default: None)
+
+            Returns:
+                list[list[float]]: embeddings of the texts, in the same order
+        '''
+        if not texts:
+            return []
+
+        tokens = [self._tokenize(text) for text in texts]
+        batches = self._pack(tokens)
+        num_tokens = sum(len(t) for t in tokens)
+
+        embeddings: list[list[float] | None] = [None] * len(texts)
+        num_embedded = 0
+        start = time.perf_counter()
+        with span('embedding_requests', model=self.model, num_texts=len(texts), num_requests=len(batches), num_tokens=num_tokens):
+            futures = {
+                self._executor.submit(self._embed_with_retries, [tokens[i] for i in batch]): batch
+                for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                for i, embedding in zip(batch, future.result()):
+                    embeddings[i] = embedding
+                num_embedded += len(batch)
+                if on_progress is not None:
+                    on_progress(num_embedded, len(texts))
+
+        # recorded once all the requests are done, as they are sent from the threads of the executor rather than in the current context
+        record_embedding_usage(self.model, num_tokens)
+        record_usage(self.model, embedding_tokens=num_tokens)
+        elapsed = time.perf_counter() - start
+        if elapsed > 0:
+            EMBEDDING_TOKENS_PER_SECOND.labels(model=self.model).observe(num_tokens / elapsed)
+        logger.info(
+            f'Embedded {len(texts)} texts ({num_tokens} tokens) in {len(batches)} requests '
+            f'in {elapsed:.2f}s ({num_tokens / max(elapsed, 1e-9):.0f} tokens/s)')
+
+        return embeddings
+
+    def embed_query(self, text: str) -> list[float]:
+        tokens = self._tokenize(text)
+        embedding = self._embed_with_retries([tokens])[0]
+        record_embedding_usage(self.model, len(tokens))
+        record_usage(self.model, embedding_tokens=len(tokens))
+        return embedding
+
+    def _tokenize(self, text: str) -> list[int]:
+        tokens = self._encoding.encode(text or ' ', disallowed_special=())
+        if len(tokens) > EMBEDDING_MAX_TOKENS_PER_TEXT:
+            logger.warning(f'Truncating text of {len(tokens)} tokens to {EMBEDDING_MAX_TOKENS_PER_TEXT} tokens before embedding it')
+            tokens = tokens[:EMBEDDING_MAX_TOKENS_PER_TEXT]
+        return tokens
+
+    def _pack(self, tokens: list[list[int]]) -> list[list[int]]:
+        '''Pack texts (given by their tokens) into requests, in order, returning the indices of the texts of each request.'''
+        batches: list[list[int]] = []
+        batch: list[int] = []
+        batch_tokens = 0
+        for i, text_tokens in enumerate(tokens):
+            if batch and (batch_tokens + len(text_tokens) > self.max_tokens_per_request or len(batch) == self.max_texts_per_request):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += len(text_tokens)
+        batches.append(batch)
+        return batches
+
+    def _embed_with_retries(self, tokens: list[list[int]]) -> list[list[float]]:
+        import openai
+
+        num_tokens = sum(len(t) for t in tokens)
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(num_tokens)
+            try:
+                kwargs = {'dimensions': self.dimensions} if self.dimensions is not None else {}
+                response = self._client.embeddings.create(model=self.model, input=tokens, **kwargs)
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                if attempt == self.max_retries:
+                    raise
+
+                reason = 'rate_limited' if isinstance(e, openai.RateLimitError) else 'error'
+                EMBEDDING_RETRIES.labels(model=self.model, reason=reason).inc()
+                delay = self._retry_delay(e, attempt)
+                logger.warning(f'Embedding request of {num_tokens} tokens failed ({reason}), retrying in {delay:.1f}s: {e}')
+                time.sleep(delay)
+
+    @staticmethod
+    def _retry_delay(error: Exception, attempt: int) -> float:
+        '''Delay before retrying: the server's retry-after if any, and otherwise an exponential backoff with full jitter.'''
+        response = getattr(error, 'response', None)
+        if response is not None and (retry_after := response.headers.get('retry-after')) is not None:
+            try:
+                return float(retry_after) + random.uniform(0, RETRY_BASE_DELAY_SECONDS)
+            except ValueError:
+                pass
+        return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
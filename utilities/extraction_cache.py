@@ -0,0 +1,169 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any
+
+from configurations.constants import LOCAL_DATA_DIRECTORY
+from utilities.instrumentation import EXTRACTION_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+# Text extracted from the uploaded files, and the boundaries and token counts of its chunks, are cached in a local SQLite
+# database (disabled if empty) by the content of the file in Storage, for at most EXTRACTION_CACHE_MAX_BYTES (the least
+# recently used entries are evicted first), so that unchanged files are neither downloaded, parsed nor chunked again
+EXTRACTION_CACHE_PATH = os.getenv('EXTRACTION_CACHE_PATH', os.path.join(LOCAL_DATA_DIRECTORY, 'extraction_cache.db'))
+EXTRACTION_CACHE_MAX_BYTES = int(os.getenv('EXTRACTION_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+
+# Bump to invalidate the cached extractions when the parsing of the files changes
+EXTRACTION_VERSION = 1
+
+
+def get_extraction_key(file_name: str, blob: Any) -> str | None:
+    '''
+    Key of the text extracted from a file, from the metadata of its blob in Storage: its MD5 hash (the same content
+    uploaded twice, even by different users, is extracted once), or else its name and generation
+
+        Parameters:
+            file_name (str): name of the file, whose extension determines how it is parsed
+            blob (google.cloud.storage.Blob): blob of the file, with its metadata
+
+        Returns:
+            str | None: key of the extracted text, None if the blob has neither an MD5 hash nor a generation
+    '''
+    extension = file_name.rsplit('.', 1)[-1].lower()
+    if md5_hash := getattr(blob, 'md5_hash', None):
+        content_id = f'md5:{md5_hash}'
+    elif generation := getattr(blob, 'generation', None):
+        content_id = f'generation:{blob.name}#{generation}'
+    else:
+        return None
+    return hashlib.sha256(json.dumps([EXTRACTION_VERSION, extension, content_id]).encode()).hexdigest()
+
+
+@dataclass
+class CachedChunks:
+    boundaries: list[tuple[int, int]]  # start and end offsets of each chunk in the extracted text
+    token_counts: list[int]
+
+
+class ExtractionCache:
+    '''
+    Cache of the text extracted from files and of the chunks it was split into (per chunking parameters), in a local
+    SQLite database whose least recently used entries are evicted when they exceed max_bytes
+    '''
+
+    def __init__(self, path: str = EXTRACTION_CACHE_PATH, max_bytes: int = EXTRACTION_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS extractions ('
+            'key TEXT PRIMARY KEY, text TEXT NOT NULL, token_count INTEGER NOT NULL, size INTEGER NOT NULL, used_at REAL NOT NULL)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS chunks ('
+            'key TEXT NOT NULL, parameters TEXT NOT NULL, chunks TEXT NOT NULL, size INTEGER NOT NULL, used_at REAL NOT NULL, '
+            'PRIMARY KEY (key, parameters))')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS extractions_used_at ON extractions (used_at)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS chunks_used_at ON chunks (used_at)')
+
+    def get_text(self, key: str) -> tuple[str, int] | None:
+        '''Get the text extracted from a file and its token count, None if it is not cached.'''
+        with self._lock:
+            row = self._connection.execute('SELECT text, token_count FROM extractions WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self._connection.execute('UPDATE extractions SET used_at = ? WHERE key = ?', (time.time(), key))
+
+        EXTRACTION_CACHE_LOOKUPS.labels(kind='text', result='hit' if row is not None else 'miss').inc()
+        return (row[0], row[1]) if row is not None else None
+
+    def put_text(self, key: str, text: str, token_count: int) -> None:
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO extractions (key, text, token_count, size, used_at) VALUES (?, ?, ?, ?, ?)',
+                (key, text, token_count, len(text), time.time()))
+            self._evict()
+
+    def get_chunks(self, key: str, parameters: dict) -> CachedChunks | None:
+        '''Get the chunks of the text extracted from a file, split with the given chunking parameters, None if they are not cached.'''
+        serialized_parameters = json.dumps(parameters, sort_keys=True)
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT chunks FROM chunks WHERE key = ? AND parameters = ?', (key, serialized_parameters)).fetchone()
+            if row is not None:
+                self._connection.execute(
+                    'UPDATE chunks SET used_at = ? WHERE key = ? AND parameters = ?', (time.time(), key, serialized_parameters))
+
+        EXTRACTION_CACHE_LOOKUPS.labels(kind='chunks', result='hit' if row is not None else 'miss').inc()
+        if row is None:
+            return None
+        chunks = json.loads(row[0])
+        return CachedChunks(boundaries=[tuple(boundary) for boundary in chunks['boundaries']], token_counts=chunks['token_counts'])
+
+    def put_chunks(self, key: str, parameters: dict, chunks: CachedChunks) -> None:
+        serialized_chunks = json.dumps({'boundaries': chunks.boundaries, 'token_counts': chunks.token_counts})
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO chunks (key, parameters, chunks, size, used_at) VALUES (?, ?, ?, ?, ?)',
+                (key, json.dumps(parameters, sort_keys=True), serialized_chunks, len(serialized_chunks), time.time()))
+            self._evict()
+
+    def _evict(self) -> None:
+        '''Delete the least recently used entries until the cache fits in max_bytes (lock held).'''
+        total_bytes = sum(
+            self._connection.execute(f'SELECT coalesce(sum(size), 0) FROM {table}').fetchone()[0] for table in ('extractions', 'chunks'))
+        if total_bytes <= self.max_bytes:
+            return
+
+        # evict down to 90% of max_bytes, so that evictions do not run on every write once the cache is full
+        excess = total_bytes - int(0.9 * self.max_bytes)
+        rows = self._connection.execute(
+            "SELECT 'extractions', key, '', size, used_at FROM extractions "
+            "UNION ALL SELECT 'chunks', key, parameters, size, used_at FROM chunks ORDER BY used_at")
+        evicted = []
+        for table, key, parameters, size, _ in rows:
+            evicted.append((table, key, parameters))
+            excess -= size
+            if excess <= 0:
+                break
+        self._connection.executemany(
+            'DELETE FROM extractions WHERE key = ?', [(key,) for table, key, _ in evicted if table == 'extractions'])
+        self._connection.executemany(
+            'DELETE FROM chunks WHERE key = ? AND parameters = ?',
+            [(key, parameters) for table, key, parameters in evicted if table == 'chunks'])
+        logger.info(f'Evicted {len(evicted)} entries from the extraction cache')
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+_extraction_cache: ExtractionCache | None = None
+_extraction_cache_lock = Lock()
+
+
+def get_extraction_cache() -> ExtractionCache | None:
+    '''Get the extraction cache (opening it on first call), None if disabled by an empty EXTRACTION_CACHE_PATH.'''
+    global _extraction_cache
+    if not EXTRACTION_CACHE_PATH:
+        return None
+    with _extraction_cache_lock:
+        if _extraction_cache is None:
+            _extraction_cache = ExtractionCache()
+            logger.info(f'Extraction cache: {EXTRACTION_CACHE_PATH}')
+        return _extraction_cache
+
+
+def close_extraction_cache() -> None:
+    global _extraction_cache
+    with _extraction_cache_lock:
+        if _extraction_cache is not None:
+            _extraction_cache.close()
+            _extraction_cache = None
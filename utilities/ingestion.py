@@ -0,0 +1,252 @@
+import copy
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from threading import Condition, Lock
+
+from configurations.constants import (
+    CHROMA_HOST,
+    CHROMA_PERSIST_DIRECTORY,
+    INGESTION_MAX_WORKERS,
+    INGESTION_WAIT_TIMEOUT_SECONDS,
+    IS_DEV_MODE,
+    IS_ORG_PROFILE_ENABLED,
+    IngestionStatus
+)
+from persistence.session_store import SessionConflictError, get_session_store
+from utilities.document_helpers import add_files_to_vector_store
+from utilities.instrumentation import current_step_id, span
+from utilities.org_profile import build_organization_profile
+from utilities.usage_ledger import current_usage_session
+from workflow.session_state import IngestionContext, SessionState
+
+logger = logging.getLogger(__name__)
+
+# Finished jobs are kept in memory for this long, for clients to read their status and events
+FINISHED_JOB_RETENTION_SECONDS = 3600
+# Interval at which the status of a job running on another replica is read from the session store, while waiting for it
+REMOTE_JOB_POLL_INTERVAL_SECONDS = 1.0
+
+
+class IngestionJob:
+    '''
+    Background job ingesting the files uploaded in a session (download, parse, chunk and embed), recording its
+    progress events in an IngestionContext of its own, which is persisted with the session state (see
+    save_ingestion_status) and handed to the session state of the requests once the job is finished
+    '''
+
+    def __init__(self, state: SessionState):
+        self.job_id = uuid.uuid4().hex
+        self.state = state
+        self.context = IngestionContext(
+            job_id=self.job_id,
+            status=IngestionStatus.RUNNING,
+            started_at=time.time(),
+            num_files=len(state.uploaded_files),
+            files=list(state.uploaded_files))
+        self.events: list[dict] = []
+        self.finished_at: float | None = None
+        self._condition = Condition()
+
+    def is_finished(self) -> bool:
+        return self.finished_at is not None
+
+    def emit(self, event: dict) -> None:
+        '''Record a progress event, update the ingestion context with it and wake up the readers of the events.'''
+        context = self.context
+        match event['event']:
+            case 'file_processed' | 'file_failed':
+                context.num_files_processed += 1
+            case 'chunked':
+                context.num_chunks = event['num_chunks']
+            case 'chunks_embedded':
+                context.num_chunks_embedded = event['num_chunks_embedded']
+
+        with self._condition:
+            self.events.append({'job_id': self.job_id, 'time': time.time(), **event})
+            self._condition.notify_all()
+
+    def wait_for_events(self, num_events_read: int, timeout: float) -> list[dict]:
+        '''
+        Wait for events beyond the first num_events_read ones, and return them
+
+            Parameters:
+                num_events_read (int): number of events already read
+                timeout (float): max seconds to wait for new events
+
+            Returns:
+                list[dict]: new events, empty if none arrived before timeout or if the job is finished
+        '''
+        with self._condition:
+            self._condition.wait_for(lambda: len(self.events) > num_events_read or self.is_finished(), timeout=timeout)
+            return self.events[num_events_read:]
+
+    def wait(self, timeout: float) -> bool:
+        '''Wait for the job to finish, returning whether it did before timeout.'''
+        with self._condition:
+            return self._condition.wait_for(self.is_finished, timeout=timeout)
+
+    def run(self) -> None:
+        # the embedding and digest requests of the job are accounted to its session, under a step of their own
+        current_step_id.set('ingestion')
+        current_usage_session.set(self.state)
+        self.emit({'event': 'started', 'num_files': self.context.num_files})
+        try:
+            with span('ingestion', num_files=self.context.num_files):
+                add_files_to_vector_store(self.state, on_progress=self.emit)
+            self.context.status = IngestionStatus.SUCCEEDED
+        except Exception as e:
+            logger.error(f'Ingestion job {self.job_id} failed for session_id={self.state.session_id}: {e}', exc_info=True)
+            self.context.status = IngestionStatus.FAILED
+            self.context.error = str(e)
+
+        save_ingestion_status(self.state, ingestion=self.context)
+        # handed over in one assignment, before waiters of the job are woken up
+        self.state.ingestion = copy.deepcopy(self.context)
+        with self._condition:
+            self.finished_at = time.time()
+            self.events.append({'job_id': self.job_id, 'time': self.finished_at, 'event': 'finished', 'status': self.context.status})
+            self._condition.notify_all()
+
+        if IS_ORG_PROFILE_ENABLED and not IS_DEV_MODE and self.context.status == IngestionStatus.SUCCEEDED:
+            self.build_org_profile()
+
+    def build_org_profile(self) -> None:
+        '''Build the organization profile of the ingested documents, once the job is finished so that retrieval does not wait for it.'''
+        try:
+            with span('org_profile', num_files=self.context.num_files):
+                org_profile = build_organization_profile(self.state, self.job_id)
+        except Exception as e:
+            logger.error(f'Failed to build the organization profile of session_id={self.state.session_id}: {e}', exc_info=True)
+            return
+
+        save_ingestion_status(self.state, org_profile=org_profile)
+        self.state.org_profile = org_profile
+        logger.info(f'Built the organization profile of {len(org_profile.digests)} documents for session_id={self.state.session_id}')
+
+
+_executor: ThreadPoolExecutor | None = None
+_jobs: dict[str, IngestionJob] = {}
+_jobs_lock = Lock()
+
+
+def save_ingestion_status(state: SessionState, **values) -> None:
+    '''
+    Persist the fields of a session state that ingestion owns (ingestion, org_profile) on a fresh copy of the stored
+    session state, rather than writing the one the requests of the session are changing (which is brought to the
+    revision written if it is still at the one before, so that the session's own ingestion does not make it stale)
+
+        Parameters:
+            state (SessionState): session state of the requests of the session
+            values: values of the fields, by name
+    '''
+    def update(stored_state: SessionState) -> None:
+        for name, value in values.items():
+            setattr(stored_state, name, copy.deepcopy(value))
+
+    session_id = state.session_id
+    try:
+        if get_session_store().update(session_id, update, cached=state) is None:
+            logger.warning(f'Failed to save the ingestion status of session_id={session_id}: no session state stored')
+    except SessionConflictError as e:
+        logger.error(f'Failed to save the ingestion status of session_id={session_id}: {e}')
+
+
+def start_ingestion(state: SessionState) -> IngestionJob:
+    '''
+    Start a background job ingesting the files uploaded in a session, recording it as running in the session state
+
+        Parameters:
+            state (SessionState): session state holding the files uploaded by the user
+
+        Returns:
+            IngestionJob: job started
+    '''
+    global _executor
+    job = IngestionJob(state)
+    state.ingestion = copy.deepcopy(job.context)
+    save_ingestion_status(state, ingestion=job.context)
+
+    with _jobs_lock:
+        now = time.time()
+        for job_id in [job_id for job_id, j in _jobs.items() if j.is_finished() and now - j.finished_at > FINISHED_JOB_RETENTION_SECONDS]:
+            del _jobs[job_id]
+        _jobs[job.job_id] = job
+
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=INGESTION_MAX_WORKERS, thread_name_prefix='ingestion')
+    # run in a copy of the current context so that the job's spans belong to the trace of the request that started it
+    _executor.submit(copy_context().run, job.run)
+
+    logger.info(f'Started ingestion job {job.job_id} of {len(state.uploaded_files)} files for session_id={state.session_id}')
+    return job
+
+
+def get_ingestion_job(job_id: str) -> IngestionJob | None:
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def needs_ingestion(state: SessionState) -> bool:
+    '''
+    Whether the files uploaded in a session must be ingested for its documents to be in the vector store: they are not
+    if a job of this process or of another replica is ingesting them, or if one has ingested them, in this process or in
+    a vector store shared by the replicas
+    '''
+    context = state.ingestion
+    if not state.uploaded_files or _is_running_elsewhere(context):
+        return False
+
+    job = get_ingestion_job(context.job_id) if context.job_id is not None else None
+    if job is not None and not job.is_finished():
+        return False
+    return not (
+        context.status == IngestionStatus.SUCCEEDED and
+        sorted(context.files) == sorted(state.uploaded_files) and
+        (job is not None or bool(CHROMA_HOST or CHROMA_PERSIST_DIRECTORY)))
+
+
+def _is_running_elsewhere(context: IngestionContext) -> bool:
+    return (
+        context.is_running() and
+        get_ingestion_job(context.job_id) is None and
+        context.started_at is not None and time.time() - context.started_at < INGESTION_WAIT_TIMEOUT_SECONDS)
+
+
+def wait_for_ingestion(state: SessionState) -> bool:
+    '''
+    Wait for the ingestion job of a session to finish if it is still running (in this process or on another replica),
+    before its documents are retrieved
+
+        Parameters:
+            state (SessionState): session state
+
+        Returns:
+            bool: whether the session's documents are ready to be retrieved (False if the job is still running after
+                INGESTION_WAIT_TIMEOUT_SECONDS)
+    '''
+    if not state.ingestion.is_running():
+        return True
+
+    with span('ingestion_wait'):
+        if (job := get_ingestion_job(state.ingestion.job_id)) is not None:
+            return job.wait(timeout=INGESTION_WAIT_TIMEOUT_SECONDS)
+
+        # the job runs on another replica, which persists its status once it is finished
+        context = state.ingestion
+        while _is_running_elsewhere(context):
+            time.sleep(REMOTE_JOB_POLL_INTERVAL_SECONDS)
+            if (stored_state := get_session_store().get(state.session_id)) is not None:
+                context = stored_state.ingestion
+        state.ingestion = context
+        return not context.is_running()
+
+
+def shutdown_ingestion() -> None:
+    '''Wait for the running jobs to finish, so that their status is persisted before the server stops.'''
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,309 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+from opentelemetry import trace
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+logger = logging.getLogger(__name__)
+
+# Fraction of requests traced (Sentry transactions and OpenTelemetry spans), requests sent with the
+# TRACE_REQUEST_HEADER header are always traced
+TRACES_SAMPLE_RATE = float(os.getenv('TRACES_SAMPLE_RATE', 0.05))
+TRACE_REQUEST_HEADER = 'x-publico-trace'
+FORCE_TRACE_ATTRIBUTE = 'publico.force_trace'
+
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Step of the workflow the current request (or worker thread) is handling, used to label metrics and spans
+current_step_id: ContextVar[str] = ContextVar('current_step_id', default='none')
+
+tracer = trace.get_tracer('publico')
+
+
+class UsageRecorder:
+    '''
+    Totals of the latency of each stage, the tokens of each kind and the times to first token of the LLM generations
+    recorded while it is the current usage recorder (eg. while answering one question of a batch run)
+    '''
+
+    def __init__(self):
+        self.stage_seconds: dict[str, float] = {}
+        self.tokens: dict[str, int] = {}
+        self.time_to_first_token_seconds: list[float] = []
+        self._lock = Lock()  # stages of one unit of work may run in several threads
+
+    def add_stage(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0) + seconds
+
+    def add_tokens(self, kind: str, num_tokens: int) -> None:
+        with self._lock:
+            self.tokens[kind] = self.tokens.get(kind, 0) + num_tokens
+
+    def add_time_to_first_token(self, seconds: float) -> None:
+        with self._lock:
+            self.time_to_first_token_seconds.append(seconds)
+
+
+# Usage recorder of the current unit of work, if any, which also receives what is recorded in the metrics
+current_usage_recorder: ContextVar[UsageRecorder | None] = ContextVar('current_usage_recorder', default=None)
+
+
+STAGE_LATENCY_SECONDS = Histogram(
+    'publico_stage_latency_seconds',
+    'Latency of a stage of the hot path (Firestore, file processing, embedding, retrieval, serialization, ...)',
+    ['stage', 'step', 'model'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60))
+
+LLM_TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    'publico_llm_time_to_first_token_seconds',
+    'Time from sending a request to the LLM until its first token is received',
+    ['step', 'model'],
+    buckets=(.1, .25, .5, .75, 1, 1.5, 2, 3, 5, 10, 30))
+
+LLM_TOTAL_SECONDS = Histogram(
+    'publico_llm_total_seconds',
+    'Time from sending a request to the LLM until its last token is received',
+    ['step', 'model'],
+    buckets=(.5, 1, 2.5, 5, 10, 15, 20, 30, 45, 60, 120))
+
+LLM_TOKENS_PER_SECOND = Histogram(
+    'publico_llm_tokens_per_second',
+    'Rate at which the LLM streams tokens once the first token is received',
+    ['step', 'model'],
+    buckets=(5, 10, 20, 30, 40, 50, 75, 100, 150, 200))
+
+LLM_TOKENS = Counter(
+    'publico_llm_tokens',
+    'Tokens of LLM requests, by kind: prompt tokens served from the provider\'s prompt cache (prompt_cached) or not '
+    '(prompt_uncached), and completion tokens (completion)',
+    ['step', 'model', 'kind'])
+
+USAGE_BUDGET_EXCEEDED = Counter(
+    'publico_usage_budget_exceeded',
+    'Requests degraded to cheaper models and fewer document chunks for being over the budget of their session or user (scope)',
+    ['scope', 'step'])
+
+MODEL_FALLBACKS = Counter(
+    'publico_model_fallbacks',
+    'LLM calls that failed with a model and were made again with the next candidate of their route',
+    ['route', 'model'])
+
+LLM_HEDGED_REQUESTS = Counter(
+    'publico_llm_hedged_requests',
+    'Streamed generations hedged with a duplicate request after waiting too long for their first token, by the request '
+    'whose tokens were kept (primary or hedge)',
+    ['step', 'model', 'winner'])
+
+LLM_HEDGE_SAVED_SECONDS = Histogram(
+    'publico_llm_hedge_saved_seconds',
+    'Time to first token saved by hedges that won: from the first token of the hedge to the first token of the request it replaced',
+    ['step', 'model'],
+    buckets=(.1, .25, .5, 1, 2, 5, 10, 30))
+
+LLM_TIMEOUTS = Counter(
+    'publico_llm_timeouts',
+    'Streamed generations abandoned for missing a deadline (first_token or total)',
+    ['step', 'model', 'deadline'])
+
+WORD_LIMIT_OVERRUNS = Counter(
+    'publico_word_limit_overruns',
+    'Answers over their word limit, by action: streams stopped and trimmed at the limit (stopped)',
+    ['step', 'action'])
+
+EMBEDDING_TOKENS_PER_SECOND = Histogram(
+    'publico_embedding_tokens_per_second',
+    'Rate at which a batch of texts is embedded, from the first request sent to the last response received',
+    ['model'],
+    buckets=(500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000))
+
+EMBEDDING_TOKENS = Counter(
+    'publico_embedding_tokens',
+    'Tokens of the texts embedded (uploaded files and questions)',
+    ['step', 'model'])
+
+EMBEDDING_RETRIES = Counter(
+    'publico_embedding_retries',
+    'Embedding requests retried, by reason (rate_limited or error)',
+    ['model', 'reason'])
+
+LLM_CACHE_LOOKUPS = Counter(
+    'publico_llm_cache_lookups',
+    'Lookups of temperature 0 LLM requests in the response cache, by result (hit or miss)',
+    ['result'])
+
+NEAR_DUPLICATE_CHUNKS = Counter(
+    'publico_near_duplicate_chunks',
+    'Chunks of uploaded files not embedded as near duplicates of another chunk of the session')
+
+EXTRACTION_CACHE_LOOKUPS = Counter(
+    'publico_extraction_cache_lookups',
+    'Lookups of the text extracted from uploaded files (text) and of its chunks (chunks) in the extraction cache, by result (hit or miss)',
+    ['kind', 'result'])
+
+AUTH_TOKEN_CACHE_LOOKUPS = Counter(
+    'publico_auth_token_cache_lookups',
+    'Lookups in the verified ID token cache, by result (hit or miss)',
+    ['result'])
+
+VECTOR_INDEX_BYTES = Gauge(
+    'publico_vector_index_bytes',
+    'Memory used by the embeddings of the in-memory vector indexes, by quantization',
+    ['quantization'])
+
+SESSION_WRITE_CONFLICTS = Counter(
+    'publico_session_write_conflicts',
+    'Session state writes that found a newer revision in the store, by outcome (merged or failed)',
+    ['outcome'])
+
+SESSION_DOCUMENT_BYTES = Histogram(
+    'publico_session_document_bytes',
+    'Size of the session states written to the session store, as JSON',
+    buckets=(1024, 4096, 16384, 65536, 131072, 262144, 524288, 1048576))
+
+SESSION_COMPACTIONS = Counter(
+    'publico_session_compactions',
+    'Session states over their size budget compacted by archiving old questions and edits, by outcome (compacted or failed)',
+    ['outcome'])
+
+
+@contextmanager
+def request_span(name: str, headers):
+    '''
+    Start the root span of a request, which decides whether the whole request is traced (sampled)
+
+        Parameters:
+            name (str): name of the span (eg. 'POST /chat/')
+            headers: headers of the request, a request sent with TRACE_REQUEST_HEADER is always traced
+    '''
+    with tracer.start_as_current_span(name, attributes={FORCE_TRACE_ATTRIBUTE: TRACE_REQUEST_HEADER in headers}):
+        yield
+
+
+@contextmanager
+def span(stage: str, model: str = '', **attributes):
+    '''
+    Record the latency of a stage of the hot path as an OpenTelemetry span and in a Prometheus histogram,
+    labelled by the current workflow step and model
+
+        Parameters:
+            stage (str): name of the stage (eg. 'firestore_fetch', 'retrieval')
+            model (str): name of the model used in the stage, if any (default: '')
+            attributes: additional attributes to set on the span
+    '''
+    step = current_step_id.get()
+    with tracer.start_as_current_span(stage, attributes={'step': step, 'model': model, **attributes}):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            STAGE_LATENCY_SECONDS.labels(stage=stage, step=step, model=model).observe(elapsed)
+            if (recorder := current_usage_recorder.get()) is not None:
+                recorder.add_stage(stage, elapsed)
+
+
+def record_llm_stream(model: str, time_to_first_token: float | None, total_time: float, num_tokens: int) -> None:
+    '''
+    Record latency metrics of a streamed LLM generation, labelled by the current workflow step and model
+
+        Parameters:
+            model (str): name of the model used for the generation
+            time_to_first_token (float | None): seconds until the first token, None if no token was generated
+            total_time (float): seconds until the last token
+            num_tokens (int): number of tokens generated
+    '''
+    step = current_step_id.get()
+    LLM_TOTAL_SECONDS.labels(step=step, model=model).observe(total_time)
+
+    if time_to_first_token is not None:
+        LLM_TIME_TO_FIRST_TOKEN_SECONDS.labels(step=step, model=model).observe(time_to_first_token)
+        if (recorder := current_usage_recorder.get()) is not None:
+            recorder.add_time_to_first_token(time_to_first_token)
+        if num_tokens > 1 and total_time > time_to_first_token:
+            LLM_TOKENS_PER_SECOND.labels(step=step, model=model).observe(
+                (num_tokens - 1) / (total_time - time_to_first_token))
+
+
+def record_llm_usage(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> None:
+    '''
+    Record the token usage of an LLM request, labelled by the current workflow step and model
+
+        Parameters:
+            model (str): name of the model used for the request
+            prompt_tokens (int): number of prompt tokens, including the cached ones
+            cached_tokens (int): number of prompt tokens served from the provider's prompt cache
+            completion_tokens (int): number of generated tokens
+    '''
+    step = current_step_id.get()
+    LLM_TOKENS.labels(step=step, model=model, kind='prompt_cached').inc(cached_tokens)
+    LLM_TOKENS.labels(step=step, model=model, kind='prompt_uncached').inc(prompt_tokens - cached_tokens)
+    LLM_TOKENS.labels(step=step, model=model, kind='completion').inc(completion_tokens)
+
+    if (recorder := current_usage_recorder.get()) is not None:
+        recorder.add_tokens('prompt_cached', cached_tokens)
+        recorder.add_tokens('prompt_uncached', prompt_tokens - cached_tokens)
+        recorder.add_tokens('completion', completion_tokens)
+
+
+def record_embedding_usage(model: str, num_tokens: int) -> None:
+    '''Record the tokens of texts embedded, labelled by the current workflow step and model.'''
+    EMBEDDING_TOKENS.labels(step=current_step_id.get(), model=model).inc(num_tokens)
+
+    if (recorder := current_usage_recorder.get()) is not None:
+        recorder.add_tokens('embedding', num_tokens)
+
+
+def get_metrics() -> bytes:
+    '''Get all metrics in the Prometheus text exposition format.'''
+    return generate_latest()
+
+
+def traces_sampler(sampling_context: dict) -> float:
+    '''Sentry traces sampler deciding per request whether it is traced, see TRACES_SAMPLE_RATE.'''
+    if (parent_sampled := sampling_context.get('parent_sampled')) is not None:
+        return float(parent_sampled)
+
+    scope = sampling_context.get('asgi_scope') or {}
+    if any(name.decode('latin-1').lower() == TRACE_REQUEST_HEADER for name, _ in scope.get('headers', [])):
+        return 1.0
+
+    return TRACES_SAMPLE_RATE
+
+
+def setup_tracing() -> None:
+    '''
+    Set up the OpenTelemetry tracer provider sampling TRACES_SAMPLE_RATE of the requests, and exporting spans
+    over OTLP if OTEL_EXPORTER_OTLP_ENDPOINT is set. Without it, spans are not recorded and only metrics are.
+    '''
+    if not os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT'):
+        return
+
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.sampling import ALWAYS_ON, ParentBased, Sampler, TraceIdRatioBased
+
+    class RequestSampler(Sampler):
+        '''Sample TRACES_SAMPLE_RATE of the requests, and every request sent with TRACE_REQUEST_HEADER.'''
+
+        ratio_sampler = TraceIdRatioBased(TRACES_SAMPLE_RATE)
+
+        def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None):
+            sampler = ALWAYS_ON if attributes and attributes.get(FORCE_TRACE_ATTRIBUTE) else self.ratio_sampler
+            return sampler.should_sample(parent_context, trace_id, name, kind, attributes, links, trace_state)
+
+        def get_description(self) -> str:
+            return f'RequestSampler{{{TRACES_SAMPLE_RATE}}}'
+
+    provider = TracerProvider(
+        resource=Resource.create({'service.name': os.getenv('OTEL_SERVICE_NAME', 'publico-backend')}),
+        sampler=ParentBased(RequestSampler()))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    logger.info(f'OpenTelemetry tracing enabled with a sample rate of {TRACES_SAMPLE_RATE}')
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from collections.abc import Callable, Sequence
+from threading import Lock
+from typing import Any
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import Generation
+
+from configurations.constants import LOCAL_DATA_DIRECTORY
+from utilities.instrumentation import LLM_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+# If enabled, responses of the LLM to temperature 0 requests are cached in a local SQLite database, for at most
+# LLM_CACHE_TTL_SECONDS and LLM_CACHE_MAX_BYTES (the least recently used responses are evicted first). It is disabled by
+# default, as it keeps serving the responses cached before a change of the prompts or models until they expire
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', 'False').lower() in ('true', 't', '1', 'yes')
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', os.path.join(LOCAL_DATA_DIRECTORY, 'llm_cache.db'))
+LLM_CACHE_TTL_SECONDS = float(os.getenv('LLM_CACHE_TTL_SECONDS', 24 * 3600))
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', 100 * 1024 * 1024))
+# Cached responses are streamed to the client word by word, all at once by default (pacing is left to the client, see
+# RENDER_DELAY_HINT_MS) or at this pace like the LLM would, holding the worker meanwhile
+LLM_CACHE_REPLAY_TOKENS_PER_SECOND = float(os.getenv('LLM_CACHE_REPLAY_TOKENS_PER_SECOND', 0))
+
+# Parameters of the serialized LLM that do not change its response, left out of the cache key
+_IGNORED_LLM_PARAMETERS = {'cache', 'callbacks', 'client', 'async_client', 'streaming', 'verbose', 'openai_api_key', 'openai_proxy', 'max_retries', 'request_timeout'}
+
+
+def get_cache_key(prompt: str, llm_string: str) -> str:
+    '''
+    Hash of the model, its sampling parameters, the parameters of the call (function schemas, stop) and the rendered
+    messages, which determine the response of the LLM at temperature 0
+
+        Parameters:
+            prompt (str): serialized messages sent to the LLM
+            llm_string (str): serialized LLM and parameters of the call, as built by LangChain
+
+        Returns:
+            str: cache key
+    '''
+    serialized_llm, _, call_parameters = llm_string.partition('---')
+    try:
+        llm_parameters = {
+            key: value for key, value in json.loads(serialized_llm)['kwargs'].items() if key not in _IGNORED_LLM_PARAMETERS}
+    except (ValueError, KeyError, TypeError):
+        llm_parameters = serialized_llm
+    return hashlib.sha256(json.dumps([llm_parameters, call_parameters, prompt], sort_keys=True).encode()).hexdigest()
+
+
+class DiskLLMCache(BaseCache):
+    '''
+    LangChain LLM cache in a local SQLite database, whose entries expire after ttl_seconds and are evicted from the
+    least recently used when the cached responses exceed max_bytes
+    '''
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl_seconds: float = LLM_CACHE_TTL_SECONDS, max_bytes: int = LLM_CACHE_MAX_BYTES):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, generations TEXT NOT NULL, size INTEGER NOT NULL, created_at REAL NOT NULL, used_at REAL NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)')
+
+    def lookup(self, prompt: str, llm_string: str) -> Sequence[Generation] | None:
+        key = get_cache_key(prompt, llm_string)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT generations FROM responses WHERE key = ? AND created_at > ?', (key, now - self.ttl_seconds)).fetchone()
+            if row is not None:
+                self._connection.execute('UPDATE responses SET used_at = ? WHERE key = ?', (now, key))
+
+        LLM_CACHE_LOOKUPS.labels(result='hit' if row is not None else 'miss').inc()
+        if row is None:
+            return None
+        try:
+            return [loads(generation) for generation in json.loads(row[0])]
+        except Exception as e:
+            logger.warning(f'Ignoring cached LLM response that could not be deserialized: {e}')
+            return None
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        generations = json.dumps([dumps(generation) for generation in return_val])
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses (key, generations, size, created_at, used_at) VALUES (?, ?, ?, ?, ?)',
+                (get_cache_key(prompt, llm_string), generations, len(generations), now, now))
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        '''Delete the expired responses, then the least recently used ones until the cache fits in max_bytes (lock held).'''
+        self._connection.execute('DELETE FROM responses WHERE created_at <= ?', (now - self.ttl_seconds,))
+        total_bytes = self._connection.execute('SELECT coalesce(sum(size), 0) FROM responses').fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+
+        # evict down to 90% of max_bytes, so that evictions do not run on every write once the cache is full
+        excess = total_bytes - int(0.9 * self.max_bytes)
+        keys = []
+        for key, size in self._connection.execute('SELECT key, size FROM responses ORDER BY used_at'):
+            keys.append(key)
+            excess -= size
+            if excess <= 0:
+                break
+        self._connection.executemany('DELETE FROM responses WHERE key = ?', [(key,) for key in keys])
+        logger.info(f'Evicted {len(keys)} responses from the LLM cache')
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._connection.execute('DELETE FROM responses')
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def replay_cached_response(text: str, put: Callable[[str], None], tokens_per_second: float = LLM_CACHE_REPLAY_TOKENS_PER_SECOND) -> None:
+    '''
+    Stream a cached response word by word (with the whitespace preceding each word) at tokens_per_second, like the LLM
+    streams its tokens
+
+        Parameters:
+            text (str): cached response
+            put (Callable[[str], None]): called with each token of the response
+            tokens_per_second (float): pace of the stream, 0 to put all the tokens at once (default: LLM_CACHE_REPLAY_TOKENS_PER_SECOND)
+    '''
+    for i, token in enumerate(re.findall(r'\s*\S+|\s+$', text)):
+        if i > 0 and tokens_per_second > 0:
+            time.sleep(1 / tokens_per_second)
+        put(token)
+
+
+_llm_cache: DiskLLMCache | None = None
+_llm_cache_lock = Lock()
+
+
+def get_llm_cache() -> DiskLLMCache | None:
+    '''Get the LLM response cache (opening it on first call), None unless enabled by LLM_CACHE_ENABLED.'''
+    global _llm_cache
+    if not LLM_CACHE_ENABLED or not LLM_CACHE_PATH:
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = DiskLLMCache()
+            logger.info(f'LLM response cache: {LLM_CACHE_PATH}')
+        return _llm_cache
+
+
+def close_llm_cache() -> None:
+    global _llm_cache
+    with _llm_cache_lock:
+        if _llm_cache is not None:
+            _llm_cache.close()
+            _llm_cache = None
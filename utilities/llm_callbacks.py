@@ -0,0 +1,58 @@
+from collections.abc import Callable
+from queue import Queue
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from utilities.llm_cache import replay_cached_response
+
+
+class QueueCallback(BaseCallbackHandler):
+    '''
+    Callback handler for streaming LLM generated tokens to a queue, used to create a generator. Responses served from
+    the LLM cache, for which no token is streamed, are replayed to the queue word by word.
+    '''
+
+    # errors raised by the queue (eg. GenerationCancelled) stop the generation rather than being logged
+    raise_error = True
+
+    def __init__(self, q: Queue):
+        self.q = q
+        self.num_tokens = 0
+        self.served_from_cache = False
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.num_tokens += 1
+        self.q.put(token)
+
+    def on_llm_end(self, response: LLMResult, **kwargs) -> None:
+        if self.num_tokens == 0 and response.generations and response.generations[0]:
+            self.served_from_cache = True
+            replay_cached_response(response.generations[0][0].text, self.on_llm_new_token)
+
+
+class FunctionArgumentsCallback(BaseCallbackHandler):
+    '''
+    Callback handler passing the arguments of a function call to on_arguments as the LLM streams them. The arguments of
+    responses served from the LLM cache, for which nothing is streamed, are passed at once.
+    '''
+
+    def __init__(self, on_arguments: Callable[[str], None]):
+        self.on_arguments = on_arguments
+        self.num_chunks = 0
+        self.served_from_cache = False
+
+    def on_llm_new_token(self, token: str, *, chunk=None, **kwargs) -> None:
+        function_call = chunk.message.additional_kwargs.get('function_call') if chunk is not None else None
+        if function_call and function_call.get('arguments'):
+            self.num_chunks += 1
+            self.on_arguments(function_call['arguments'])
+
+    def on_llm_end(self, response: LLMResult, **kwargs) -> None:
+        if self.num_chunks > 0 or not response.generations or not response.generations[0]:
+            return
+        message = getattr(response.generations[0][0], 'message', None)
+        function_call = message.additional_kwargs.get('function_call') if message is not None else None
+        if function_call and function_call.get('arguments'):
+            self.served_from_cache = True
+            self.on_arguments(function_call['arguments'])
@@ -1,36 +1,147 @@
+from __future__ import annotations
+
 from collections.abc import Iterator
-from typing import Callable, Literal
+from contextvars import copy_context
+from typing import TYPE_CHECKING, Callable, Literal
 from asyncio import Queue as AsyncQueue
 from queue import Queue, Empty
-from devtools import debug
 import logging
-from threading import Thread
+from threading import Event, Thread
+import math
 import re
+import time
+
+from configurations.constants import WORD_LIMIT_MAX_OVERRUN, WORD_LIMIT_TOKENS_PER_WORD
+from utilities.instrumentation import (
+    LLM_HEDGE_SAVED_SECONDS,
+    LLM_HEDGED_REQUESTS,
+    LLM_TIMEOUTS,
+    WORD_LIMIT_OVERRUNS,
+    current_step_id,
+    record_llm_stream,
+    span
+)
+from utilities.logging_utils import LogCategory, log_lazy
+
+# LangChain is heavy to import, so it is only imported once the first generation is streamed
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+    from langchain.prompts.chat import ChatPromptTemplate
+
+    from utilities.llm_callbacks import QueueCallback
+
+
+# Item put on the events of a request once its generation is complete
+_JOB_DONE = object()
+
+
+class GenerationCancelled(Exception):
+    '''Raised in the callback of a request to stop streaming its generation, once another request won the race or the generation was abandoned.'''
 
-from langchain_openai import ChatOpenAI
-from langchain.chains.llm import LLMChain
-from langchain.chains.question_answering import load_qa_chain
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.docstore.document import Document
-from langchain.prompts.chat import ChatPromptTemplate
 
-from configurations.constants import GPT_MODEL
+class _CancelledGenerationFilter(logging.Filter):
+    '''Leave out the warnings of LangChain about the GenerationCancelled raised on purpose by the callbacks of cancelled requests.'''
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return GenerationCancelled.__name__ not in record.getMessage()
+
+
+logging.getLogger('langchain_core.callbacks.manager').addFilter(_CancelledGenerationFilter())
+
+
+class _StreamingRequest:
+    '''
+    Request streaming a generation of the LLM, whose tokens (then _JOB_DONE, or the error it failed with) are put on the
+    events shared by the requests racing for the same generation (a request and its hedge) along with the request
+    '''
+
+    def __init__(self, model: str, events: Queue, is_hedge: bool, on_first_token: Callable[[_StreamingRequest], None]):
+        self.model = model
+        self.events = events
+        self.is_hedge = is_hedge
+        self.on_first_token = on_first_token
+        self.callback: QueueCallback | None = None
+        self.started_at = time.perf_counter()
+        self.first_token_at: float | None = None
+        self.finished = False
+        self.lost_to: _StreamingRequest | None = None  # request whose tokens were kept instead
+        self._cancelled = Event()
+
+    def put(self, item) -> None:
+        if isinstance(item, str) and self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            self.on_first_token(self)
+
+        if not self._cancelled.is_set():
+            self.events.put((self, item))
+        elif isinstance(item, str):
+            raise GenerationCancelled(f'Generation of {self.model} cancelled')
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+
+def _get_end_of_last_sentence(words: list[re.Match], max_words: int) -> int | None:
+    '''Get where the last sentence ending in the last third of the first max_words words ends, None if there is none.'''
+    for word in reversed(words[math.ceil(max_words * 2 / 3):max_words]):
+        if word.group()[-1] in '.!?':
+            return word.end()
+    return None
+
+
+def trim_to_word_limit(text: str, max_words: int) -> str:
+    '''
+    Cut a text to its first max_words words, at the end of its last complete sentence if there is one in the last third,
+    keeping its whitespace (eg. the line breaks between paragraphs)
+    '''
+    words = list(re.finditer(r'\S+', text))
+    if len(words) <= max_words:
+        return text
+    return text[:_get_end_of_last_sentence(words, max_words) or words[max_words - 1].end()]
+
+
+class WordLimitedText:
+    '''
+    Text of an answer with a word limit, streamed token by token so that none of what trim_to_word_limit cuts of it is
+    ever streamed: its words in the last third of the limit are held back until their sentence is complete, and the text
+    is trimmed to the limit (and complete) as soon as it has more words
+    '''
 
+    def __init__(self, max_words: int):
+        self.max_words = max_words
+        self.text = ''
+        self.is_over_limit = False
+        self._num_chars_streamed = 0
 
-logging.basicConfig(level=logging.INFO)
+    def add(self, token: str) -> str:
+        '''Add a token to the text, returning the text to stream.'''
+        self.text += token
+        words = list(re.finditer(r'\S+', self.text))
+        if len(words) > self.max_words:
+            self.is_over_limit = True
+            self.text = self.text[:max(len(trim_to_word_limit(self.text, self.max_words)), self._num_chars_streamed)]
+            return self.flush()
 
+        # whitespace is held back until a word follows it, as the text may be cut before it
+        end = len(self.text.rstrip())
+        if len(words) <= math.ceil(self.max_words * 2 / 3):
+            return self.flush(end)
 
-class QueueCallback(BaseCallbackHandler):
-    '''Callback handler for streaming LLM generated tokens to a queue, used to create a generator.'''
+        # the last word may not be complete yet (eg. '1.' of '1.5')
+        complete_words = words if self.text[-1].isspace() else words[:-1]
+        return self.flush(_get_end_of_last_sentence(complete_words, self.max_words) or end)
 
-    def __init__(self, q: Queue):
-        self.q = q
+    def flush(self, end: int | None = None) -> str:
+        '''Get the text not streamed yet, up to end (or all of it).'''
+        end = len(self.text) if end is None else max(end, self._num_chars_streamed)
+        text = self.text[self._num_chars_streamed:end]
+        self._num_chars_streamed = end
+        return text
 
-    def on_llm_new_token(self, token: str, **kwargs) -> None:
-        self.q.put(token)
 
-    def on_llm_end(self, *args, **kwargs) -> None:
-        return self.q.empty()
+def get_max_tokens_for_words(max_words: int) -> int:
+    '''Get the max_tokens of the generation of an answer with a word limit, see WORD_LIMIT_MAX_OVERRUN.'''
+    return math.ceil(max_words * WORD_LIMIT_MAX_OVERRUN * WORD_LIMIT_TOKENS_PER_WORD)
 
 
 def stream_from_llm_generation(
@@ -38,10 +149,12 @@ def stream_from_llm_generation(
     queue: AsyncQueue,
     on_llm_end: Callable[[str, str], None] | None = None,
     chain_type: Literal['llm_chain', 'qa_chain'] = 'llm_chain',
-    model: str = GPT_MODEL,
+    model: str | None = None,
+    route: str = 'default',
     temperature: float = 0,
     verbose: bool = False,
     docs: list[Document] | None = None,
+    max_words: int | None = None,
     **input_variables
 ) -> Iterator[tuple[str, str, str]]:
     '''
@@ -52,10 +165,14 @@ def stream_from_llm_generation(
         queue: the queue to stream the tokens to
         on_llm_end: a function to call when the LLM has finished generating tokens
         chain_type: the type of chain to use, either 'llm_chain' or 'qa_chain'
-        model: the model to use for the LLM (default is GPT_MODEL, which is set to 'gpt-3.5-turbo' if not specified)
+        model: the model to use for the LLM (defaults to None, the model being chosen by the model router)
+        route: the route of the model router to choose the model from, falling back to its next models if the
+            generation fails before any token is streamed (default is 'default')
         temperature: the temperature to use for the LLM (default is 0)
         verbose: whether to print out the LLM's output (defaults to False)
         docs: the documents to use for the QA chain, only used if chain_type is 'qa_chain' (defaults to None)
+        max_words: the word limit of the answer generated, if any, which budgets its max_tokens and stops its stream at
+            the limit, the answer being trimmed to it as it is streamed (see WordLimitedText) (defaults to None)
         input_variables: the input variables included in the prompt
     '''
 
@@ -63,81 +180,194 @@ def stream_from_llm_generation(
         print(f'chain_type: {chain_type} not recognized\n')
         return
 
-    print('\n-------------------------------------------------------------')
-    print('---------------------- Input variables ----------------------')
-    debug(**input_variables)
-    print('-------------------------------------------------------------\n')
-
-    q = Queue()
-    job_done = object()
-
-    llm = ChatOpenAI(
-        model=model,
-        temperature=temperature,
-        streaming=True, 
-        callbacks=[QueueCallback(q)]
-    )
-
-    def task():
-        chain_constructor = LLMChain if chain_type == 'llm_chain' else load_qa_chain
-        chain = chain_constructor(
-            llm=llm,
-            prompt= prompt,
-            verbose=verbose)
-
-        if chain_type == 'qa_chain':
-            if docs is not None:
-                logging.info(f'length of documents provided: {sum([len(doc.page_content) for doc in docs])}')
-            else:
-                raise ValueError('No documents were provided, this should never happen!')
-
-        # add the documents to the kwargs if we're using a qa_chain and run the chain
-        kwargs = input_variables if chain_type == 'llm_chain' else {'input_documents': docs, **input_variables}
-        chain.invoke(input=kwargs)
-
-        # put the job_done object in the queue to signal that we're done
-        q.put(job_done)
-
-    # Create a thread and start the function
-    Thread(target=task).start()
-
-    answer = ''
-    answer_formatted = '*'
-    num_tokens = 0
-
-    # Get each new token from the queue and yield for our generator
-    while True:
-        try:
-            # get the next token from the queue
-            if (next_token := q.get(block=True, timeout=1)) is not job_done:
-                num_tokens += 1
-                answer += next_token
-                answer_formatted += (
-                    # to display italics correctly remove any whitespaces before
-                    # the \n\n and add an asterix before and after \n\n
-                    re.sub(r'\s*\n\n', '*\n\n*', next_token)
-                        if '\n\n' in next_token
-                        else
-                    next_token
-                )
-                # add markdown to next_token as well
-
-                queue.put_nowait(next_token)
-            else:
-                print_end_of_stream(answer, num_tokens)
-                answer_formatted += '*'
-                if on_llm_end is not None:
-                    on_llm_end(answer)
+    from langchain_openai import ChatOpenAI
+    from langchain.chains.llm import LLMChain
+    from langchain.chains.question_answering import load_qa_chain
+
+    from utilities.llm_cache import get_llm_cache
+    from utilities.llm_callbacks import QueueCallback
+    from utilities.model_router import estimate_prompt_tokens, get_model_router
+    from utilities.openai_client import get_chat_completions
+
+    router = get_model_router()
+    num_tokens_streamed = 0
+
+    def on_first_token(request: _StreamingRequest) -> None:
+        if request.callback.served_from_cache:
+            return
+        router.record_time_to_first_token(request.model, request.first_token_at - request.started_at)
+        # the first token of a request that lost to its hedge tells how long the user would have waited for it
+        if request.lost_to is not None and request.lost_to.is_hedge:
+            LLM_HEDGE_SAVED_SECONDS.labels(step=current_step_id.get(), model=request.model).observe(
+                request.first_token_at - request.lost_to.first_token_at)
+
+    def start_request(model: str, events: Queue, is_hedge: bool = False) -> _StreamingRequest:
+        log_lazy(LogCategory.PROMPTS, logging.DEBUG, f'Input variables of {chain_type} for {model}', lambda: input_variables)
+
+        request = _StreamingRequest(model, events, is_hedge, on_first_token)
+        request.callback = QueueCallback(request)
+
+        llm = ChatOpenAI(
+            model=model,
+            temperature=temperature,
+            streaming=True, 
+            callbacks=[request.callback],
+            client=get_chat_completions(),
+            max_tokens=get_max_tokens_for_words(max_words) if max_words is not None else None,
+            # only deterministic generations are cached (False disables LangChain's global cache)
+            cache=(get_llm_cache() or False) if temperature == 0 else False
+        )
+
+        def task():
+            chain_constructor = LLMChain if chain_type == 'llm_chain' else load_qa_chain
+            chain = chain_constructor(
+                llm=llm,
+                prompt= prompt,
+                verbose=verbose)
+
+            if chain_type == 'qa_chain':
+                if docs is not None:
+                    log_lazy(LogCategory.PROMPTS, logging.DEBUG, 'Documents provided to qa_chain', lambda: {
+                        'num_documents': len(docs),
+                        'num_characters': sum(len(doc.page_content) for doc in docs)})
+                else:
+                    raise ValueError('No documents were provided, this should never happen!')
+
+            # add the documents to the kwargs if we're using a qa_chain and run the chain
+            kwargs = input_variables if chain_type == 'llm_chain' else {'input_documents': docs, **input_variables}
+            try:
+                chain.invoke(input=kwargs)
+            except Exception as e:
+                # hand the error over to the consumer of the tokens, which would otherwise wait for _JOB_DONE until its deadline
+                request.put(e)
                 return
-        except Empty:
-            logging.info('Queue is empty after 1 second of waiting')
-            continue
+
+            # put the _JOB_DONE object to signal that we're done
+            request.put(_JOB_DONE)
+
+        # in a copy of the current context, for the token usage of the generation to be recorded under the current step
+        Thread(target=copy_context().run, args=(task,)).start()
+        return request
+
+    def generate(model: str) -> str:
+        nonlocal num_tokens_streamed
+        model_route = router.get_route(route)
+        step = current_step_id.get()
+
+        # requests racing for the generation: the first one, and its hedge if it is slow to stream its first token
+        events = Queue()
+        start_time = time.perf_counter()
+        requests = [start_request(model, events)]
+        hedge_delay = router.get_hedge_delay(route, model)
+        winner = None
+
+        answer = ''
+        answer_formatted = '*'
+        num_tokens = 0
+        time_to_first_token = None
+        limited_text = WordLimitedText(max_words) if max_words is not None else None
+
+        def end_of_stream() -> str:
+            if not winner.callback.served_from_cache:
+                record_llm_stream(winner.model, time_to_first_token, time.perf_counter() - start_time, num_tokens)
+            print_end_of_stream(answer, num_tokens)
+            return answer
+
+        # Get each new token from the events and put it on the queue
+        with span('llm_generation', model=model, chain_type=chain_type):
+            try:
+                while True:
+                    can_hedge = winner is None and hedge_delay is not None and len(requests) == 1
+                    if winner is None:
+                        deadline = min(hedge_delay, model_route.ttft_timeout_seconds) if can_hedge else model_route.ttft_timeout_seconds
+                    else:
+                        deadline = model_route.total_timeout_seconds
+
+                    try:
+                        request, item = events.get(timeout=max(deadline - (time.perf_counter() - start_time), 0))
+                    except Empty:
+                        if can_hedge and hedge_delay < model_route.ttft_timeout_seconds:
+                            hedge_model = router.get_hedge_model(route, model)
+                            logging.debug(f'No first token from {model} after {hedge_delay:.2f}s, hedging with {hedge_model}')
+                            requests.append(start_request(hedge_model, events, is_hedge=True))
+                            continue
+
+                        missed = 'first_token' if winner is None else 'total'
+                        LLM_TIMEOUTS.labels(step=step, model=model, deadline=missed).inc()
+                        raise TimeoutError(f'Generation of {model} missed its {missed} deadline of {deadline:.1f}s')
+
+                    if winner is not None and request is not winner:
+                        continue
+
+                    if isinstance(item, Exception):
+                        request.finished = True
+                        if winner is None and not all(r.finished for r in requests):
+                            logging.warning(f'Request to {request.model} failed ({item}), waiting for the other request')
+                            continue
+                        raise item
+
+                    if winner is None:
+                        winner = request
+                        if len(requests) > 1:
+                            for loser in requests:
+                                if loser is not winner:
+                                    loser.lost_to = winner
+                                    loser.cancel()
+                            LLM_HEDGED_REQUESTS.labels(step=step, model=model, winner='hedge' if winner.is_hedge else 'primary').inc()
+
+                    if item is not _JOB_DONE:
+                        if time_to_first_token is None:
+                            time_to_first_token = time.perf_counter() - start_time
+                        num_tokens += 1
+
+                        # an answer with a word limit is streamed as it is trimmed to it, so that the user is shown the
+                        # answer kept, and its generation is stopped at the limit rather than paid for beyond it
+                        if limited_text is not None:
+                            item = limited_text.add(item)
+                        if item:
+                            num_tokens_streamed += 1
+                            answer += item
+                            answer_formatted += (
+                                # to display italics correctly remove any whitespaces before
+                                # the \n\n and add an asterix before and after \n\n
+                                re.sub(r'\s*\n\n', '*\n\n*', item)
+                                    if '\n\n' in item
+                                    else
+                                item
+                            )
+                            # add markdown to next_token as well
+
+                            queue.put_nowait(item)
+
+                        if limited_text is not None and limited_text.is_over_limit:
+                            logging.info(f'Stopped the generation of {winner.model} at its word limit of {max_words} words')
+                            WORD_LIMIT_OVERRUNS.labels(step=step, action='stopped').inc()
+                            return end_of_stream()
+                    else:
+                        if limited_text is not None and (item := limited_text.flush()):
+                            answer += item
+                            queue.put_nowait(item)
+                        answer_formatted += '*'
+                        return end_of_stream()
+            finally:
+                # stop the requests still streaming (losers of the race, or all of them once the generation is abandoned)
+                for request in requests:
+                    request.cancel()
+
+    if model is not None:
+        answer = generate(model)
+    else:
+        # a generation that fails is only made again with another model if none of its tokens was streamed to the user
+        prompt_tokens = estimate_prompt_tokens(
+            [str(value) for value in input_variables.values()] + [doc.page_content for doc in docs or []])
+        answer = router.call_with_fallback(route, generate, prompt_tokens, can_fall_back=lambda: num_tokens_streamed == 0)
+
+    if on_llm_end is not None:
+        on_llm_end(answer)
+
 
 def print_end_of_stream(answer: str, num_tokens: int):
-    logging.info('----------------------- End of stream -----------------------')
-    logging.info(
-        f'Number of tokens generated: {num_tokens}\n' +
-        f'Number of words generated: {len(answer.split())}\n' +
-        f'Final answer from LLM: {answer}'
-    )
-    logging.info('-------------------------------------------------------------\n')
+    log_lazy(LogCategory.ANSWERS, logging.DEBUG, 'End of stream', lambda: {
+        'num_tokens': num_tokens,
+        'num_words': len(answer.split()),
+        'answer': answer})
@@ -0,0 +1,127 @@
+import atexit
+import json
+import logging
+import os
+import random
+from collections.abc import Callable
+from enum import StrEnum
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Any
+
+from configurations.constants import IS_DEV_MODE
+
+# Max number of characters of a log message and of each of the fields of a structured record
+LOG_MAX_RECORD_CHARS = int(os.getenv('LOG_MAX_RECORD_CHARS', 2000))
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # 'text' or 'json'
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+
+class LogCategory(StrEnum):
+    '''Categories of verbose logs, each with its own level (LOG_LEVEL_<CATEGORY>) and sample rate (LOG_SAMPLE_<CATEGORY>).'''
+    PROMPTS = 'prompts'  # input variables of the prompts sent to the LLM
+    ANSWERS = 'answers'  # full answers generated by the LLM or edited by the user
+    CHUNKS = 'chunks'  # documents created from files and chunks created from documents
+    RETRIEVAL = 'retrieval'  # similarity scores and token counts of retrieved chunks
+    LLM_USAGE = 'llm_usage'  # token usage and cost of LLM calls
+
+
+# Verbose categories are off by default in production and on in dev mode
+_DEFAULT_CATEGORY_LEVEL = 'DEBUG' if IS_DEV_MODE else 'WARNING'
+
+_CATEGORY_SAMPLE_RATES: dict[LogCategory, float] = {
+    category: float(os.getenv(f'LOG_SAMPLE_{category.name}', 1.0)) for category in LogCategory
+}
+
+_listener: QueueListener | None = None
+
+
+def _truncate(value: Any) -> Any:
+    if isinstance(value, str) and len(value) > LOG_MAX_RECORD_CHARS:
+        return f'{value[:LOG_MAX_RECORD_CHARS]}... [{len(value) - LOG_MAX_RECORD_CHARS} more characters]'
+    if isinstance(value, (list, tuple)):
+        return [_truncate(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _truncate(v) for k, v in value.items()}
+    return value
+
+
+class SizeCappedFormatter(logging.Formatter):
+    '''Formatter capping the size of messages and of the fields of structured records, as text or as JSON lines.'''
+
+    def __init__(self, as_json: bool = False):
+        super().__init__('%(levelname)s - %(message)s')
+        self.as_json = as_json
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = _truncate(record.getMessage())
+        fields = _truncate(getattr(record, 'fields', None) or {})
+
+        if self.as_json:
+            entry = {'level': record.levelname, 'logger': record.name, 'message': message, **fields}
+            if record.exc_info:
+                entry['exception'] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+
+        if fields:
+            message += ''.join(f'\n  {name}: {value}' for name, value in fields.items())
+        record = logging.makeLogRecord(record.__dict__ | {'msg': message, 'args': None})
+        return super().format(record)
+
+
+def configure_logging() -> None:
+    '''
+    Configure logging so that records are formatted and written by a background thread: handlers on the hot path
+    only put records on a queue. Category loggers get their levels from LOG_LEVEL_<CATEGORY>.
+    '''
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(SizeCappedFormatter(as_json=LOG_FORMAT == 'json'))
+
+    log_queue = SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+    for category in LogCategory:
+        get_category_logger(category).setLevel(os.getenv(f'LOG_LEVEL_{category.name}', _DEFAULT_CATEGORY_LEVEL).upper())
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    '''Flush the queued records and stop the background logging thread.'''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_category_logger(category: LogCategory) -> logging.Logger:
+    return logging.getLogger(f'publico.{category}')
+
+
+def log_lazy(category: LogCategory, level: int, message: str, build_fields: Callable[[], dict[str, Any]] | None = None) -> None:
+    '''
+    Log a structured record in a category, building its (expensive) fields only if the category is enabled
+    for level and the record is sampled (LOG_SAMPLE_<CATEGORY>)
+
+        Parameters:
+            category (LogCategory): category of the record
+            level (int): level of the record (eg. logging.DEBUG)
+            message (str): message of the record
+            build_fields (Callable[[], dict[str, Any]] | None): function building the fields of the record (default: None)
+    '''
+    logger = get_category_logger(category)
+    if not logger.isEnabledFor(level):
+        return
+
+    if (sample_rate := _CATEGORY_SAMPLE_RATES[category]) < 1.0 and random.random() >= sample_rate:
+        return
+
+    logger.log(level, message, extra={'fields': build_fields() if build_fields is not None else {}})
@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import time
+from collections import deque
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Lock
+from typing import TypeVar
+
+import numpy as np
+
+from configurations.constants import GPT_MODEL
+from utilities.instrumentation import MODEL_FALLBACKS, current_step_id
+from utilities.usage_ledger import get_price_per_million_tokens, is_over_budget
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Routes of the LLM calls (eg. 'original_answer', 'comprehensiveness_check'), overriding DEFAULT_MODEL_ROUTES: JSON (or a
+# path to a JSON file) mapping a route, or a route at a workflow step ('<step>:<route>', eg. 'enter_word_limit:original_answer'),
+# to its candidate models in order of preference and their latency SLO, eg. {"original_answer": {"models": ["gpt-4o",
+# "gpt-3.5-turbo"], "ttft_slo_seconds": 2}}
+MODEL_ROUTES = os.getenv('MODEL_ROUTES', '')
+# Weight of the latest request in the moving averages of the time to first token and error rate of each model, and
+# interval at which a model skipped for being slow or failing is tried again to update them
+HEALTH_EWMA_WEIGHT = float(os.getenv('MODEL_HEALTH_EWMA_WEIGHT', 0.2))
+HEALTH_PROBE_INTERVAL_SECONDS = float(os.getenv('MODEL_HEALTH_PROBE_INTERVAL_SECONDS', 30))
+# Streamed generations still waiting for their first token after the hedge_percentile of the recent times to first
+# token of their model (once HEDGE_MIN_SAMPLES of the last HEDGE_WINDOW are known, and after at least
+# HEDGE_MIN_DELAY_SECONDS) are hedged: a duplicate request is sent, and the first one to stream a token is kept
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', 20))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv('HEDGE_MIN_DELAY_SECONDS', 0.5))
+
+# Context window of the models (prompt and completion tokens), prompts too large for a model are not sent to it
+MODEL_CONTEXT_TOKENS = {
+    'gpt-3.5-turbo': 16_385,
+    'gpt-4': 8_192,
+    'gpt-4-turbo-preview': 128_000,
+    'gpt-4-turbo': 128_000,
+    'gpt-4o': 128_000,
+    'gpt-4o-mini': 128_000,
+}
+
+
+@dataclass
+class ModelRoute:
+    models: list[str]  # candidates, in order of preference
+    ttft_slo_seconds: float | None = None  # models whose recent time to first token is above it are skipped
+    max_error_rate: float = 0.3  # models whose recent error rate is above it are skipped
+    max_completion_tokens: int = 1024  # left in the context window for the completion
+    ttft_timeout_seconds: float = 30  # streamed generations without a first token by then are abandoned
+    total_timeout_seconds: float = 180  # streamed generations not complete by then are abandoned
+    hedge_percentile: float | None = 95  # of the recent times to first token after which a request is hedged, None to never hedge
+    hedge_to_fallback: bool = False  # whether hedged requests are sent to the next candidate rather than the same model
+
+
+DEFAULT_MODEL_ROUTES: dict[str, ModelRoute] = {
+    'default': ModelRoute(models=list(dict.fromkeys([GPT_MODEL, 'gpt-3.5-turbo']))),
+    'implicit_question_answer': ModelRoute(models=['gpt-3.5-turbo']),
+    'comprehensiveness_check': ModelRoute(models=['gpt-4-turbo-preview', 'gpt-3.5-turbo']),
+    'document_digest': ModelRoute(models=['gpt-3.5-turbo']),
+}
+
+
+@dataclass
+class ModelHealth:
+    time_to_first_token_seconds: float | None = None  # moving average, None until a first token is received
+    error_rate: float = 0.0  # moving average
+    recent_ttfts: deque[float] = field(default_factory=lambda: deque(maxlen=HEDGE_WINDOW))
+    last_attempt_at: float = field(default_factory=time.monotonic)
+
+
+def load_model_routes(config: str = MODEL_ROUTES) -> dict[str, ModelRoute]:
+    '''Get DEFAULT_MODEL_ROUTES overridden by the routes of a JSON config (or a path to a JSON file), see MODEL_ROUTES.'''
+    routes = dict(DEFAULT_MODEL_ROUTES)
+    if config.strip():
+        text = config if config.lstrip().startswith('{') else Path(config).read_text()
+        routes.update({name: ModelRoute(**route) for name, route in json.loads(text).items()})
+    return routes
+
+
+def estimate_prompt_tokens(texts: list[str]) -> int:
+    '''Estimate the number of tokens of a prompt made of texts (the chat models share the cl100k_base encoding).'''
+    import tiktoken
+    encoding = tiktoken.get_encoding('cl100k_base')
+    return sum(len(encoding.encode(text)) for text in texts)
+
+
+class ModelRouter:
+    '''
+    Chooses the model of each LLM call from the candidates of its route: the first one whose context window fits the
+    prompt and which is neither slow (recent time to first token above the SLO of the route) nor failing (recent error
+    rate above the max of the route), falling back to the next candidates when a call fails
+    '''
+
+    def __init__(self, routes: dict[str, ModelRoute]):
+        self.routes = routes
+        self._health: dict[str, ModelHealth] = {}
+        self._lock = Lock()
+
+    def get_route(self, route: str) -> ModelRoute:
+        '''Get the route of the calls of a route at the current workflow step.'''
+        return self.routes.get(f'{current_step_id.get()}:{route}') or self.routes.get(route) or self.routes['default']
+
+    def is_healthy(self, model: str, route: ModelRoute) -> bool:
+        health = self._health.get(model)
+        if health is None or time.monotonic() - health.last_attempt_at > HEALTH_PROBE_INTERVAL_SECONDS:
+            return True
+        is_slow = (route.ttft_slo_seconds is not None and health.time_to_first_token_seconds is not None
+                   and health.time_to_first_token_seconds > route.ttft_slo_seconds)
+        return not is_slow and health.error_rate <= route.max_error_rate
+
+    def get_candidates(self, route: str, prompt_tokens: int = 0) -> list[str]:
+        '''
+        Get the models to try for a call, in order: the healthy candidates of its route whose context window fits the
+        prompt, then the slow or failing ones (tried as a last resort). The candidates of a session over its usage budget
+        are tried from the cheapest one.
+
+            Parameters:
+                route (str): route of the call
+                prompt_tokens (int): estimated number of tokens of the prompt (default: 0, not checked)
+
+            Returns:
+                list[str]: models to try
+        '''
+        model_route = self.get_route(route)
+        fitting = [
+            model for model in model_route.models
+            if prompt_tokens + model_route.max_completion_tokens <= MODEL_CONTEXT_TOKENS.get(model, float('inf'))]
+        if not fitting:
+            logger.warning(f'No model of route {route} fits a prompt of {prompt_tokens} tokens, trying the largest one')
+            fitting = [max(model_route.models, key=lambda model: MODEL_CONTEXT_TOKENS.get(model, 0))]
+        if is_over_budget.get():
+            fitting.sort(key=get_price_per_million_tokens)
+
+        with self._lock:
+            healthy = [model for model in fitting if self.is_healthy(model, model_route)]
+        return healthy + [model for model in fitting if model not in healthy]
+
+    def _update(self, model: str, update: Callable[[ModelHealth], None]) -> None:
+        with self._lock:
+            health = self._health.setdefault(model, ModelHealth())
+            update(health)
+            health.last_attempt_at = time.monotonic()
+
+    def record_success(self, model: str) -> None:
+        def update(health: ModelHealth):
+            health.error_rate *= 1 - HEALTH_EWMA_WEIGHT
+        self._update(model, update)
+
+    def record_failure(self, model: str) -> None:
+        def update(health: ModelHealth):
+            health.error_rate = health.error_rate * (1 - HEALTH_EWMA_WEIGHT) + HEALTH_EWMA_WEIGHT
+        self._update(model, update)
+
+    def record_time_to_first_token(self, model: str, seconds: float) -> None:
+        def update(health: ModelHealth):
+            health.time_to_first_token_seconds = (
+                seconds if health.time_to_first_token_seconds is None
+                else health.time_to_first_token_seconds * (1 - HEALTH_EWMA_WEIGHT) + seconds * HEALTH_EWMA_WEIGHT)
+            health.recent_ttfts.append(seconds)
+        self._update(model, update)
+
+    def get_hedge_delay(self, route: str, model: str) -> float | None:
+        '''Get the time after which a streamed generation of a route still waiting for its first token is hedged, None to not hedge it.'''
+        percentile = self.get_route(route).hedge_percentile
+        with self._lock:
+            health = self._health.get(model)
+            if percentile is None or health is None or len(health.recent_ttfts) < HEDGE_MIN_SAMPLES:
+                return None
+            return max(HEDGE_MIN_DELAY_SECONDS, float(np.percentile(health.recent_ttfts, percentile)))
+
+    def get_hedge_model(self, route: str, model: str) -> str:
+        '''Get the model the hedged request of a generation is sent to: the same one, or the next candidate of its route.'''
+        if not self.get_route(route).hedge_to_fallback:
+            return model
+        candidates = self.get_candidates(route)
+        following = candidates[candidates.index(model) + 1:] if model in candidates else []
+        return following[0] if following else model
+
+    def call_with_fallback(self, route: str, call: Callable[[str], T], prompt_tokens: int = 0, can_fall_back: Callable[[], bool] = lambda: True) -> T:
+        '''
+        Call the LLM with the models of a route until a call succeeds
+
+            Parameters:
+                route (str): route of the call
+                call (Callable[[str], T]): call of the LLM with a model
+                prompt_tokens (int): estimated number of tokens of the prompt (default: 0, not checked)
+                can_fall_back (Callable[[], bool]): whether a failed call can be made again with another model (eg.
+                    not once part of the response was streamed to the user)
+
+            Returns:
+                T: result of the first call that succeeded
+        '''
+        candidates = self.get_candidates(route, prompt_tokens)
+        for i, model in enumerate(candidates):
+            try:
+                result = call(model)
+            except Exception as e:
+                self.record_failure(model)
+                if i == len(candidates) - 1 or not can_fall_back():
+                    raise
+                logger.warning(f'Call of route {route} to {model} failed ({e}), falling back to {candidates[i + 1]}')
+                MODEL_FALLBACKS.labels(route=route, model=model).inc()
+                continue
+
+            self.record_success(model)
+            return result
+
+
+_router: ModelRouter | None = None
+_router_lock = Lock()
+
+
+def get_model_router() -> ModelRouter:
+    '''Get the model router of the process, loading its routes on first call.'''
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter(load_model_routes())
+        return _router
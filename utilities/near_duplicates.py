@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import re
+import zlib
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+
+# Chunks are compared by their sets of shingles (sequences of SHINGLE_WORDS words), whose Jaccard similarity is estimated
+# by MinHash signatures of NUM_PERMUTATIONS hash functions, and near-duplicate candidates are found by LSH over bands of
+# the signatures (whose number is chosen for the threshold) rather than by comparing every pair of chunks
+SHINGLE_WORDS = 5
+NUM_PERMUTATIONS = 128
+
+# hash functions (a * x + b) % _PRIME of the 32-bit hashes x of the shingles, which fit in 64 bits
+_PRIME = np.uint64((1 << 32) + 15)
+_rng = np.random.default_rng(0)
+_A = _rng.integers(1, 1 << 32, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_B = _rng.integers(0, 1 << 32, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+def get_shingles(text: str, shingle_words: int = SHINGLE_WORDS) -> set[str]:
+    '''Get the shingles of a text (case and punctuation ignored), or the whole text if it is shorter than a shingle.'''
+    words = re.sub(r'[^\w\s]', ' ', text.casefold()).split()
+    if len(words) <= shingle_words:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + shingle_words]) for i in range(len(words) - shingle_words + 1)}
+
+
+def get_minhash_signature(text: str, shingle_words: int = SHINGLE_WORDS) -> np.ndarray:
+    '''
+    Get the MinHash signature of a text: the minimum of each hash function over its shingles, the share of equal values
+    in the signatures of two texts being an estimate of the Jaccard similarity of their shingles
+
+        Parameters:
+            text (str): text
+            shingle_words (int): number of words of each shingle (default: SHINGLE_WORDS)
+
+        Returns:
+            np.ndarray: signature of NUM_PERMUTATIONS values
+    '''
+    hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in get_shingles(text, shingle_words)), dtype=np.uint64)
+    return ((_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME).min(axis=1)
+
+
+def get_lsh_bands(threshold: float, num_permutations: int = NUM_PERMUTATIONS) -> tuple[int, int]:
+    '''
+    Get the number of bands and of rows per band splitting the signatures, for pairs of texts whose similarity is around
+    threshold to share a band (and become candidates) with a probability of about 1/2, ie. (1 / bands) ** (1 / rows) ~ threshold
+    '''
+    divisors = [rows for rows in range(1, num_permutations + 1) if num_permutations % rows == 0]
+    rows = min(divisors, key=lambda rows: abs((rows / num_permutations) ** (1 / rows) - threshold))
+    return num_permutations // rows, rows
+
+
+@dataclass
+class _Representative:
+    document: Document
+    signature: np.ndarray
+    duplicates: list[str] = field(default_factory=list)
+
+
+def remove_near_duplicates(documents: list[Document], threshold: float) -> tuple[list[Document], int]:
+    '''
+    Remove the chunks that are near duplicates of a previous chunk (eg. the same passage in several versions of an
+    application), keeping the first one, whose metadata records where its duplicates came from ('duplicates': comma
+    separated source#n of each duplicate, n being the position of the chunk in its source, and 'num_duplicates')
+
+        Parameters:
+            documents (list[Document]): chunks, in order, with their 'source' in their metadata
+            threshold (float): estimated Jaccard similarity of the shingles of two chunks above which they are duplicates
+
+        Returns:
+            tuple[list[Document], int]: chunks without their near duplicates, and number of chunks removed
+    '''
+    num_bands, rows = get_lsh_bands(threshold)
+    buckets: list[dict[bytes, list[_Representative]]] = [{} for _ in range(num_bands)]
+    representatives: list[_Representative] = []
+    num_chunks_by_source: dict[str, int] = {}
+
+    for document in documents:
+        source = document.metadata.get('source')
+        num_chunks_by_source[source] = num_chunks_by_source.get(source, 0) + 1
+        signature = get_minhash_signature(document.page_content)
+        bands = [signature[band * rows:(band + 1) * rows].tobytes() for band in range(num_bands)]
+
+        # candidates share at least one band, and are duplicates if their estimated similarity reaches the threshold
+        candidates = {id(r): r for band, key in enumerate(bands) for r in buckets[band].get(key, [])}
+        if (original := next(
+                (r for r in candidates.values() if np.mean(r.signature == signature) >= threshold), None)) is not None:
+            original.duplicates.append(f'{source}#{num_chunks_by_source[source]}')
+            continue
+
+        representative = _Representative(document, signature)
+        representatives.append(representative)
+        for band, key in enumerate(bands):
+            buckets[band].setdefault(key, []).append(representative)
+
+    for representative in representatives:
+        if representative.duplicates:
+            representative.document.metadata['duplicates'] = ','.join(representative.duplicates)
+            representative.document.metadata['num_duplicates'] = len(representative.duplicates)
+
+    return [r.document for r in representatives], len(documents) - len(representatives)
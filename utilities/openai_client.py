@@ -0,0 +1,90 @@
+import logging
+from threading import Lock
+from types import SimpleNamespace
+from typing import Any
+
+from utilities.instrumentation import record_llm_usage
+from utilities.logging_utils import LogCategory, log_lazy
+from utilities.usage_ledger import record_usage
+
+
+def _record_usage(model: str, usage: Any) -> None:
+    if usage is None:
+        return
+
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = (getattr(details, 'cached_tokens', None) or 0) if details is not None else 0
+    record_llm_usage(model, usage.prompt_tokens, cached_tokens, usage.completion_tokens)
+    record_usage(model, prompt_tokens=usage.prompt_tokens, cached_tokens=cached_tokens, completion_tokens=usage.completion_tokens)
+    log_lazy(LogCategory.LLM_USAGE, logging.DEBUG, f'Token usage of {model}', lambda: {
+        'prompt_tokens': usage.prompt_tokens,
+        'cached_tokens': cached_tokens,
+        'completion_tokens': usage.completion_tokens})
+
+
+class _UsageRecordingStream:
+    '''
+    Stream of completion chunks, recording the usage sent in the last chunk, or an estimate of it if the stream is closed
+    before (eg. a generation stopped for going over its word limit, or cancelled after losing to its hedge), as the
+    tokens generated until then are billed all the same
+    '''
+
+    def __init__(self, stream, model: str, messages: list[dict]):
+        self._stream = stream
+        self._model = model
+        self._messages = messages
+        self._num_chunks = 0
+        self._has_recorded_usage = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stream.close()
+        if not self._has_recorded_usage and self._num_chunks > 0:
+            from utilities.model_router import estimate_prompt_tokens
+            prompt_tokens = estimate_prompt_tokens([str(message.get('content') or '') for message in self._messages])
+            _record_usage(self._model, SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=self._num_chunks))
+
+    def __iter__(self):
+        for chunk in self._stream:
+            if chunk.usage is not None:
+                _record_usage(self._model, chunk.usage)
+                self._has_recorded_usage = True
+            elif chunk.choices:
+                self._num_chunks += 1
+            yield chunk
+
+
+class UsageRecordingCompletions:
+    '''
+    Chat completions resource of the OpenAI client, given to ChatOpenAI as its client, recording the token usage of every
+    completion (including the prompt tokens served from the provider's prompt cache) per workflow step. The usage of
+    streamed completions is requested with stream_options, as LangChain does not request it.
+    '''
+
+    def __init__(self, completions):
+        self._completions = completions
+
+    def create(self, **params):
+        if params.get('stream'):
+            params['stream_options'] = {'include_usage': True}
+            return _UsageRecordingStream(self._completions.create(**params), params.get('model', ''), params.get('messages', []))
+
+        response = self._completions.create(**params)
+        _record_usage(params.get('model', ''), response.usage)
+        return response
+
+
+_chat_completions: UsageRecordingCompletions | None = None
+_chat_completions_lock = Lock()
+
+
+def get_chat_completions() -> UsageRecordingCompletions:
+    '''Get the chat completions client shared by all the chat models (and their connection pool), creating it on first call.'''
+    global _chat_completions
+    with _chat_completions_lock:
+        if _chat_completions is None:
+            import openai
+            _chat_completions = UsageRecordingCompletions(openai.OpenAI().chat.completions)
+        return _chat_completions
@@ -23,3 +23,20 @@ def function_for_comprehensiveness_check(missing_information: str, implicit_ques
     print(f"Missing information: {missing_information}")
     for i, question in enumerate(implicit_questions):
         print(f"Question {i + 1}: {question.question}")
+
+
+def function_for_document_digest(mission: str, programs: str, metrics: str, finances: str):
+    '''
+    Record a digest of a document shared by a nonprofit organization, to answer the common questions of grant applications.
+
+    Args:
+        mission: Mission, vision and background of the organization, as stated in the document (empty if not mentioned).
+        programs: Programs and projects of the organization, with who they serve and where (empty if not mentioned).
+        metrics: Achievements, outcomes and impact measurements, with their figures (empty if not mentioned).
+        finances: Budget, revenue, funders and financial needs, with their figures (empty if not mentioned).
+    '''
+
+    print(f"Mission: {mission}")
+    print(f"Programs: {programs}")
+    print(f"Metrics: {metrics}")
+    print(f"Finances: {finances}")
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import TYPE_CHECKING
+
+from configurations.constants import GRANT_APPLICATION_QUESTIONS_EXAMPLES, IS_DEV_MODE, IS_ORG_PROFILE_ENABLED, ORG_PROFILE_NUM_CHUNKS
+from utilities.document_helpers import get_most_relevant_docs_in_vector_store_for_answering_question, get_vector_store
+from utilities.instrumentation import span
+from workflow.session_state import ChunkReference, DocumentDigest, OrganizationProfile, PreRetrievedContext, SessionState
+
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+
+logger = logging.getLogger(__name__)
+
+# Max tokens of each document given to the model writing its digest (the rest is left out)
+DIGEST_MAX_DOCUMENT_TOKENS = 12_000
+DIGEST_MAX_CONCURRENCY = 4
+
+ORG_PROFILE_SOURCE = 'organization_profile'
+
+
+def normalize_question(question: str) -> str:
+    '''Normalize the case, punctuation and spacing of a question, to match it with the common questions.'''
+    return ' '.join(re.sub(r'[^\w\s]', ' ', question.casefold()).split())
+
+
+def get_session_texts_by_source(session_id: str) -> dict[str, str]:
+    '''Get the text of each document of a session, from its chunks in the vector store (overlaps included).'''
+    result = get_vector_store().get(where={'session_id': session_id})
+    chunks_by_source: dict[str, list[tuple[int, str]]] = {}
+    for metadata, text in zip(result['metadatas'], result['documents']):
+        chunks_by_source.setdefault(metadata['source'], []).append((metadata.get('index', 0), text))
+    return {source: '\n'.join(text for _, text in sorted(chunks)) for source, chunks in sorted(chunks_by_source.items())}
+
+
+def write_document_digest(source: str, text: str) -> DocumentDigest:
+    '''
+    Write the digest of a document (mission, programs, metrics and finances) with OpenAI functions
+
+        Parameters:
+            source (str): name of the document
+            text (str): text of the document, of which the first DIGEST_MAX_DOCUMENT_TOKENS tokens are read
+
+        Returns:
+            DocumentDigest: digest of the document
+    '''
+    import tiktoken
+    from langchain.chains.openai_functions import create_openai_fn_runnable
+    from langchain_openai import ChatOpenAI
+
+    from configurations.prompts import get_prompt_template_for_document_digest
+    from utilities.llm_cache import get_llm_cache
+    from utilities.model_router import get_model_router
+    from utilities.openai_client import get_chat_completions
+    from utilities.openai_functions_utils import function_for_document_digest
+
+    encoding = tiktoken.get_encoding('cl100k_base')
+    if len(tokens := encoding.encode(text)) > DIGEST_MAX_DOCUMENT_TOKENS:
+        text = encoding.decode(tokens[:DIGEST_MAX_DOCUMENT_TOKENS])
+
+    def digest(model: str) -> dict:
+        chat_openai = ChatOpenAI(model=model, temperature=0, client=get_chat_completions(), cache=get_llm_cache() or False)
+        chain = create_openai_fn_runnable([function_for_document_digest], chat_openai, get_prompt_template_for_document_digest())
+        with span('llm_function_call', model=model):
+            return chain.invoke(dict(source=source, content=text))
+
+    response = get_model_router().call_with_fallback('document_digest', digest, prompt_tokens=min(len(tokens), DIGEST_MAX_DOCUMENT_TOKENS))
+
+    return DocumentDigest(
+        source=source,
+        mission=response.get('mission') or None,
+        programs=response.get('programs') or None,
+        metrics=response.get('metrics') or None,
+        finances=response.get('finances') or None)
+
+
+def build_organization_profile(state: SessionState, job_id: str) -> OrganizationProfile:
+    '''
+    Build the organization profile of the documents of a session: the digest of each document, and the chunks most
+    relevant to each of the GRANT_APPLICATION_QUESTIONS_EXAMPLES
+
+        Parameters:
+            state (SessionState): session state, whose documents are in the vector store
+            job_id (str): ingestion job of the documents
+
+        Returns:
+            OrganizationProfile: profile of the organization
+    '''
+    texts_by_source = get_session_texts_by_source(state.session_id)
+    with ThreadPoolExecutor(max_workers=DIGEST_MAX_CONCURRENCY, thread_name_prefix='digest') as executor:
+        digests = list(executor.map(
+            lambda source: copy_context().run(write_document_digest, source, texts_by_source[source]), texts_by_source))
+
+    contexts = []
+    for question in GRANT_APPLICATION_QUESTIONS_EXAMPLES:
+        documents = get_most_relevant_docs_in_vector_store_for_answering_question(
+            session_id=state.session_id, question=question, n_results=ORG_PROFILE_NUM_CHUNKS)
+        contexts.append(PreRetrievedContext(
+            question=question,
+            chunks=[ChunkReference(source=doc.metadata['source'], index=doc.metadata['index']) for doc in documents]))
+
+    return OrganizationProfile(job_id=job_id, digests=digests, contexts=contexts)
+
+
+def format_organization_profile(profile: OrganizationProfile) -> str:
+    '''Write the digests of an organization profile as a document for the prompt.'''
+    sections = []
+    for digest in profile.digests:
+        lines = [f'Digest of {digest.source}:']
+        for label, value in [('Mission', digest.mission), ('Programs', digest.programs), ('Metrics', digest.metrics), ('Finances', digest.finances)]:
+            if value:
+                lines.append(f'{label}: {value}')
+        sections.append('\n'.join(lines))
+    return '\n\n'.join(sections)
+
+
+def get_pre_retrieved_documents(state: SessionState, question: str) -> list[Document] | None:
+    '''
+    Get the documents to answer a common grant application question from the organization profile: its digests followed
+    by the chunks retrieved for the question when the profile was built, which are read from the vector store without
+    embedding the question
+
+        Parameters:
+            state (SessionState): session state
+            question (str): grant application question
+
+        Returns:
+            list[Document] | None: documents to answer the question, None if it is not a common question or if the
+                profile of the current documents is not built
+    '''
+    profile = state.org_profile
+    if not IS_ORG_PROFILE_ENABLED or IS_DEV_MODE or profile.job_id is None or profile.job_id != state.ingestion.job_id:
+        return None
+
+    normalized_question = normalize_question(question)
+    if (context := next((c for c in profile.contexts if normalize_question(c.question) == normalized_question), None)) is None:
+        return None
+
+    from langchain.docstore.document import Document
+
+    chunk_references = {(chunk.source, chunk.index) for chunk in context.chunks}
+    with span('pre_retrieved_context', k=len(chunk_references)):
+        result = get_vector_store().get(where={'session_id': state.session_id})
+    chunks = sorted(
+        (Document(page_content=text, metadata=metadata)
+         for metadata, text in zip(result['metadatas'], result['documents'])
+         if (metadata.get('source'), metadata.get('index')) in chunk_references),
+        key=lambda doc: (doc.metadata['source'], doc.metadata['index']))
+    if len(chunks) < len(chunk_references):
+        logger.warning(f'Chunks of the organization profile of session_id={state.session_id} are missing, retrieving from the documents')
+        return None
+
+    logger.info(f'Answering a common question of session_id={state.session_id} from its organization profile')
+    return [Document(page_content=format_organization_profile(profile), metadata={'source': ORG_PROFILE_SOURCE, 'index': 0}), *chunks]
@@ -0,0 +1,253 @@
+import json
+from collections.abc import Callable
+from enum import Enum, auto
+from typing import Any
+
+# Location of a value in a JSON document: the keys and indexes leading to it from the root (empty for the root)
+JSONPath = tuple[str | int, ...]
+
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+_WHITESPACE = ' \t\n\r'
+
+
+class _State(Enum):
+    VALUE = auto()        # expecting a value (or the end of an empty array)
+    KEY = auto()          # expecting the key of an object member (or the end of the object)
+    COLON = auto()        # expecting the colon following a key
+    STRING = auto()       # in a string
+    LITERAL = auto()      # in a number, true, false or null
+    AFTER_VALUE = auto()  # expecting a comma or the end of the enclosing container
+    END = auto()          # the document is complete
+
+
+class StreamingJSONParser:
+    '''
+    Incremental parser of a JSON document received in chunks, eg. the arguments of a function call streamed by the LLM.
+    Each chunk is parsed once, as soon as it is fed: the text of the strings is reported as it is decoded, and every
+    value (string, number, object, array...) is reported as soon as it is complete, along with its path in the document.
+    '''
+
+    def __init__(
+        self,
+        on_string_delta: Callable[[JSONPath, str], None] | None = None,
+        on_value: Callable[[JSONPath, Any], None] | None = None
+    ):
+        '''
+            Parameters:
+                on_string_delta (Callable[[JSONPath, str], None] | None): called with the path of a string value and the
+                    text decoded from each chunk (keys of objects are not reported)
+                on_value (Callable[[JSONPath, Any], None] | None): called with the path and value of every complete value,
+                    the root value last
+        '''
+        self.on_string_delta = on_string_delta
+        self.on_value = on_value
+        self.value: Any = None
+
+        self._state = _State.VALUE
+        self._containers: list[dict | list] = []
+        self._path: list[str | int] = []
+        self._position = 0
+        self._error: ValueError | None = None
+
+        self._string_is_key = False
+        self._string: list[str] = []
+        self._string_delta: list[str] = []
+        self._escape: str | None = None  # characters of the escape sequence being read, after the backslash
+        self._high_surrogate: str | None = None
+        self._literal: list[str] = []
+
+    @property
+    def done(self) -> bool:
+        '''Whether the root value is complete.'''
+        return self._state == _State.END
+
+    def feed(self, chunk: str) -> None:
+        '''
+        Parse the next chunk of the document
+
+            Parameters:
+                chunk (str): next characters of the document
+
+            Raises:
+                ValueError: if the document is not valid JSON, then on every following call
+        '''
+        if self._error is not None:
+            raise self._error
+
+        try:
+            for char in chunk:
+                self._feed_char(char)
+                self._position += 1
+        except ValueError as e:
+            self._error = e
+            raise
+        finally:
+            self._flush_string_delta()
+
+    def close(self) -> Any:
+        '''
+        Complete the document once all of its chunks have been fed
+
+            Returns:
+                Any: the root value
+
+            Raises:
+                ValueError: if the document is incomplete or not valid JSON
+        '''
+        if self._error is not None:
+            raise self._error
+        if self._state == _State.LITERAL:
+            self._complete_literal()
+        if self._state != _State.END:
+            self._error = ValueError(f'Incomplete JSON document after {self._position} characters')
+            raise self._error
+        return self.value
+
+    def _feed_char(self, char: str) -> None:
+        if self._state == _State.STRING:
+            self._feed_string_char(char)
+            return
+
+        if self._state == _State.LITERAL:
+            if char not in _WHITESPACE and char not in ',]}':
+                self._literal.append(char)
+                return
+            self._complete_literal()
+
+        if char in _WHITESPACE:
+            return
+
+        match self._state:
+            case _State.VALUE:
+                if char == ']' and self._containers and isinstance(self._containers[-1], list) and not self._containers[-1]:
+                    self._path.pop()
+                    self._close_container()
+                elif char == '{':
+                    self._containers.append({})
+                    self._state = _State.KEY
+                elif char == '[':
+                    self._containers.append([])
+                    self._path.append(0)
+                    self._state = _State.VALUE
+                elif char == '"':
+                    self._start_string(is_key=False)
+                elif char in '-0123456789tfn':
+                    self._literal = [char]
+                    self._state = _State.LITERAL
+                else:
+                    self._raise(char)
+
+            case _State.KEY:
+                if char == '"':
+                    self._start_string(is_key=True)
+                elif char == '}':
+                    self._close_container()
+                else:
+                    self._raise(char)
+
+            case _State.COLON:
+                if char != ':':
+                    self._raise(char)
+                self._state = _State.VALUE
+
+            case _State.AFTER_VALUE:
+                container = self._containers[-1]
+                if char == ',':
+                    if isinstance(container, dict):
+                        self._path.pop()
+                        self._state = _State.KEY
+                    else:
+                        self._path[-1] += 1
+                        self._state = _State.VALUE
+                elif char == ('}' if isinstance(container, dict) else ']'):
+                    self._path.pop()
+                    self._close_container()
+                else:
+                    self._raise(char)
+
+            case _State.END:
+                self._raise(char)
+
+    def _feed_string_char(self, char: str) -> None:
+        if self._escape is not None:
+            self._escape += char
+            if self._escape[0] == 'u':
+                if len(self._escape) < 5:
+                    return
+                try:
+                    decoded = chr(int(self._escape[1:], 16))
+                except ValueError:
+                    self._raise(char)
+            elif self._escape in _ESCAPES:
+                decoded = _ESCAPES[self._escape]
+            else:
+                self._raise(char)
+            self._escape = None
+            self._append_to_string(decoded)
+        elif char == '\\':
+            self._escape = ''
+        elif char == '"':
+            self._complete_string()
+        else:
+            self._append_to_string(char)
+
+    def _append_to_string(self, text: str) -> None:
+        # characters outside of the basic multilingual plane are escaped as a pair of surrogates
+        if self._high_surrogate is not None:
+            text = (self._high_surrogate + text).encode('utf-16', 'surrogatepass').decode('utf-16', 'replace')
+            self._high_surrogate = None
+        elif '\ud800' <= text <= '\udbff':
+            self._high_surrogate = text
+            return
+
+        self._string.append(text)
+        if not self._string_is_key:
+            self._string_delta.append(text)
+
+    def _flush_string_delta(self) -> None:
+        if self._string_delta and self.on_string_delta is not None:
+            self.on_string_delta(tuple(self._path), ''.join(self._string_delta))
+        self._string_delta = []
+
+    def _start_string(self, is_key: bool) -> None:
+        self._string_is_key = is_key
+        self._string = []
+        self._state = _State.STRING
+
+    def _complete_string(self) -> None:
+        string = ''.join(self._string)
+        if self._string_is_key:
+            self._path.append(string)
+            self._state = _State.COLON
+        else:
+            self._flush_string_delta()
+            self._complete_value(string)
+
+    def _complete_literal(self) -> None:
+        literal = ''.join(self._literal)
+        try:
+            value = json.loads(literal)
+        except ValueError:
+            self._raise(literal)
+        self._complete_value(value)
+
+    def _close_container(self) -> None:
+        self._complete_value(self._containers.pop())
+
+    def _complete_value(self, value: Any) -> None:
+        if self._containers:
+            container = self._containers[-1]
+            if isinstance(container, dict):
+                container[self._path[-1]] = value
+            else:
+                container.append(value)
+            self._state = _State.AFTER_VALUE
+        else:
+            self.value = value
+            self._state = _State.END
+
+        if self.on_value is not None:
+            self.on_value(tuple(self._path), value)
+
+    def _raise(self, text: str) -> None:
+        raise ValueError(f'Unexpected {text!r} at character {self._position} of JSON document')
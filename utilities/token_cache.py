@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import re
+import time
+from dataclasses import dataclass
+from threading import Event, Lock, Thread
+
+from utilities.instrumentation import AUTH_TOKEN_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+# Public keys used by Google to sign Firebase ID tokens
+FIREBASE_PUBLIC_KEYS_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+FIREBASE_ISSUER_PREFIX = 'https://securetoken.google.com/'
+
+DEFAULT_KEYS_MAX_AGE_SECONDS = 3600
+KEYS_REFRESH_RETRY_SECONDS = 60
+CLOCK_SKEW_SECONDS = 10
+
+
+class InvalidTokenError(Exception):
+    pass
+
+
+class _PublicKeysResponse:
+    '''Response served from memory with the Google public keys, implementing google.auth.transport.Response.'''
+
+    def __init__(self, keys: bytes):
+        self.status = 200
+        self.headers = {}
+        self.data = keys
+
+
+class GooglePublicKeys:
+    '''
+    Google public keys for Firebase ID tokens, held in memory and refreshed in a background thread
+    before they expire so that verifying a token never waits on the network.
+
+    An instance is a google.auth transport request, so it can be passed to google.oauth2.id_token
+    which then reads the keys from memory instead of fetching them.
+    '''
+
+    def __init__(self, url: str = FIREBASE_PUBLIC_KEYS_URL):
+        self.url = url
+        self._keys: bytes | None = None
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread: Thread | None = None
+
+    def __call__(self, url: str, method: str = 'GET', **kwargs) -> _PublicKeysResponse:
+        if url != self.url:
+            raise ValueError(f'Unexpected request to {url}, only {self.url} is served from memory')
+
+        if self._keys is None:
+            # keys have not been fetched by the background thread yet, so fetch them now
+            self.refresh()
+
+        return _PublicKeysResponse(self._keys)
+
+    def refresh(self) -> float:
+        '''
+        Fetch the public keys and return how long they can be cached for
+
+            Returns:
+                float: max-age in seconds of the fetched keys, as stated by the Cache-Control header
+        '''
+        from google.auth.transport.requests import Request
+
+        with self._lock:
+            response = Request()(self.url, method='GET')
+            if response.status != 200:
+                raise InvalidTokenError(f'Could not fetch Google public keys (status {response.status})')
+
+            json.loads(response.data)  # make sure the keys can be parsed before replacing the current ones
+            self._keys = response.data
+
+        cache_control = response.headers.get('cache-control', '')
+        max_age = re.search(r'max-age=(\d+)', cache_control)
+        return float(max_age.group(1)) if max_age else DEFAULT_KEYS_MAX_AGE_SECONDS
+
+    def start_background_refresh(self) -> None:
+        '''Start a daemon thread refreshing the keys at 90% of their max-age.'''
+        if self._thread is not None:
+            return
+
+        def refresh_forever():
+            while not self._stop.is_set():
+                try:
+                    wait = 0.9 * self.refresh()
+                    logger.debug(f'Refreshed Google public keys, next refresh in {wait:.0f}s')
+                except Exception as e:
+                    wait = KEYS_REFRESH_RETRY_SECONDS
+                    logger.warning(f'Failed to refresh Google public keys, retrying in {wait}s: {e}')
+                self._stop.wait(wait)
+
+        self._thread = Thread(target=refresh_forever, name='google-public-keys-refresh', daemon=True)
+        self._thread.start()
+
+    def stop_background_refresh(self) -> None:
+        self._stop.set()
+
+
+@dataclass
+class _VerifiedToken:
+    user_id: str
+    expires_at: float
+
+
+class VerifiedTokenCache:
+    '''
+    Cache of verified Firebase ID tokens, keyed by a hash of the token and valid until the token's expiry,
+    so that authenticating a token that was already seen is a dict lookup.
+    '''
+
+    def __init__(self, project_id: str, public_keys: GooglePublicKeys | None = None, max_size: int = 10_000):
+        self.project_id = project_id
+        self.public_keys = public_keys or GooglePublicKeys()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._tokens: dict[str, _VerifiedToken] = {}
+        self._lock = Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get_user_id(self, token: str) -> str:
+        '''
+        Get the user ID of a Firebase ID token, verifying the token only if it is not cached yet
+
+            Parameters:
+                token (str): Firebase ID token
+
+            Returns:
+                str: user ID (uid) the token was issued for
+
+            Raises:
+                InvalidTokenError: if the token is invalid or expired
+        '''
+        token_hash = hashlib.sha256(token.encode()).hexdigest()
+
+        if (verified := self._tokens.get(token_hash)) is not None:
+            if verified.expires_at > time.time():
+                self.hits += 1
+                AUTH_TOKEN_CACHE_LOOKUPS.labels(result='hit').inc()
+                return verified.user_id
+            self._tokens.pop(token_hash, None)
+
+        self.misses += 1
+        AUTH_TOKEN_CACHE_LOOKUPS.labels(result='miss').inc()
+        claims = self._verify(token)
+        self._store(token_hash, _VerifiedToken(user_id=claims['sub'], expires_at=float(claims['exp'])))
+        return claims['sub']
+
+    def _verify(self, token: str) -> dict:
+        '''Verify signature, audience, issuer and expiry of token the same way firebase_admin.auth.verify_id_token does.'''
+        from google.oauth2 import id_token
+
+        try:
+            claims = id_token.verify_token(
+                token,
+                request=self.public_keys,
+                audience=self.project_id,
+                certs_url=self.public_keys.url,
+                clock_skew_in_seconds=CLOCK_SKEW_SECONDS)
+        except Exception as e:
+            raise InvalidTokenError(str(e)) from e
+
+        if claims.get('iss') != f'{FIREBASE_ISSUER_PREFIX}{self.project_id}':
+            raise InvalidTokenError(f'Token has incorrect issuer: {claims.get("iss")}')
+        if not isinstance(subject := claims.get('sub'), str) or not subject or len(subject) > 128:
+            raise InvalidTokenError('Token has an invalid subject')
+
+        return claims
+
+    def _store(self, token_hash: str, verified: _VerifiedToken) -> None:
+        with self._lock:
+            if len(self._tokens) >= self.max_size:
+                now = time.time()
+                self._tokens = {h: v for h, v in self._tokens.items() if v.expires_at > now}
+
+                # still full of valid tokens, so evict the oldest ones
+                while len(self._tokens) >= self.max_size:
+                    self._tokens.pop(next(iter(self._tokens)))
+
+            self._tokens[token_hash] = verified
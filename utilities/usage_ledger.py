@@ -0,0 +1,285 @@
+import datetime
+import logging
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from threading import Event, Lock, Thread
+
+from persistence.serialization import deserialize_to_dataclass
+from utilities.instrumentation import USAGE_BUDGET_EXCEEDED, current_step_id
+from workflow.session_state import SessionState, UsageEntry
+
+logger = logging.getLogger(__name__)
+
+# Budgets of the cost of the LLM and embedding requests, in USD (0 for none): of each session, and of each user per day
+# (UTC). Requests of a session over either budget are degraded rather than refused: they use the cheapest candidate
+# model of their route, and BUDGET_NUM_OF_DOC_CHUNKS document chunks at most
+USAGE_BUDGET_USD_PER_SESSION = float(os.getenv('USAGE_BUDGET_USD_PER_SESSION', 0))
+USAGE_BUDGET_USD_PER_USER_PER_DAY = float(os.getenv('USAGE_BUDGET_USD_PER_USER_PER_DAY', 0))
+BUDGET_NUM_OF_DOC_CHUNKS = int(os.getenv('BUDGET_NUM_OF_DOC_CHUNKS', 2))
+# Interval at which the usage of each user is added to their daily usage document in the session store
+USER_USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv('USER_USAGE_FLUSH_INTERVAL_SECONDS', 10))
+USER_USAGE_WRITE_MAX_ATTEMPTS = 5
+
+
+@dataclass
+class ModelPrice:
+    prompt: float  # USD per million tokens, of the prompt (or the texts embedded)
+    cached_prompt: float | None = None  # of the prompt tokens served from the provider's prompt cache, None if not cached
+    completion: float = 0
+
+
+MODEL_PRICES = {
+    'gpt-3.5-turbo': ModelPrice(prompt=0.5, completion=1.5),
+    'gpt-4': ModelPrice(prompt=30, completion=60),
+    'gpt-4-turbo-preview': ModelPrice(prompt=10, completion=30),
+    'gpt-4-turbo': ModelPrice(prompt=10, completion=30),
+    'gpt-4o': ModelPrice(prompt=2.5, cached_prompt=1.25, completion=10),
+    'gpt-4o-mini': ModelPrice(prompt=0.15, cached_prompt=0.075, completion=0.6),
+    'text-embedding-3-small': ModelPrice(prompt=0.02),
+    'text-embedding-3-large': ModelPrice(prompt=0.13),
+    'text-embedding-ada-002': ModelPrice(prompt=0.1),
+}
+
+# Session the usage of the current request (or worker thread) is accounted to, if any
+current_usage_session: ContextVar[SessionState | None] = ContextVar('current_usage_session', default=None)
+# Whether the session of the current request is over its budget or its user's, see USAGE_BUDGET_USD_PER_SESSION
+is_over_budget: ContextVar[bool] = ContextVar('is_over_budget', default=False)
+
+
+@dataclass
+class UsageTotals:
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+    embedding_tokens: int = 0
+    cost_usd: float = 0
+
+    def add(self, entry: UsageEntry) -> None:
+        self.prompt_tokens += entry.prompt_tokens
+        self.cached_tokens += entry.cached_tokens
+        self.completion_tokens += entry.completion_tokens
+        self.embedding_tokens += entry.embedding_tokens
+        self.cost_usd += get_cost_usd(entry)
+
+    def merge(self, totals: 'UsageTotals') -> None:
+        self.prompt_tokens += totals.prompt_tokens
+        self.cached_tokens += totals.cached_tokens
+        self.completion_tokens += totals.completion_tokens
+        self.embedding_tokens += totals.embedding_tokens
+        self.cost_usd += totals.cost_usd
+
+
+def get_cost_usd(entry: UsageEntry) -> float:
+    '''Get the cost of a request, 0 if the price of its model is unknown.'''
+    if (price := MODEL_PRICES.get(entry.model)) is None:
+        return 0
+    cached_price = price.cached_prompt if price.cached_prompt is not None else price.prompt
+    return (
+        (entry.prompt_tokens - entry.cached_tokens + entry.embedding_tokens) * price.prompt
+        + entry.cached_tokens * cached_price
+        + entry.completion_tokens * price.completion) / 1_000_000
+
+
+def get_totals_by_step(entries: list[UsageEntry]) -> dict[str, UsageTotals]:
+    '''Get the totals of the usage entries of each workflow step.'''
+    totals: dict[str, UsageTotals] = {}
+    for entry in entries:
+        totals.setdefault(entry.step, UsageTotals()).add(entry)
+    return totals
+
+
+def get_today() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+
+class UserUsageAccountant:
+    '''
+    Daily usage of each user per workflow step, kept in a document of the session store per user and day (written with
+    the same revision checks as session states, as the sessions of a user may be served by several replicas). The usage
+    recorded in the process is added to it in the background every USER_USAGE_FLUSH_INTERVAL_SECONDS rather than on
+    every request, so that accounting adds no store round trip to the hot path.
+    '''
+
+    def __init__(self):
+        self._pending: dict[tuple[str, str], dict[str, UsageTotals]] = {}  # (user, day) -> step -> usage not stored yet
+        self._stored_costs: dict[tuple[str, str], tuple[float, float]] = {}  # (user, day) -> stored cost and when it was read
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread: Thread | None = None
+
+    @staticmethod
+    def get_document_id(user_id: str, day: str) -> str:
+        return f'user_usage:{user_id}:{day}'
+
+    def add(self, user_id: str, entry: UsageEntry) -> None:
+        with self._lock:
+            steps = self._pending.setdefault((user_id, get_today()), {})
+            steps.setdefault(entry.step, UsageTotals()).add(entry)
+            if self._thread is None:
+                self._thread = Thread(target=self._flush_periodically, name='user_usage_flush', daemon=True)
+                self._thread.start()
+
+    def get_cost_usd(self, user_id: str, day: str | None = None) -> float:
+        '''Get the cost of the usage of a user on a day (default: today), the stored one being read at most once per flush interval.'''
+        key = (user_id, day or get_today())
+        with self._lock:
+            stored = self._stored_costs.get(key)
+            pending = sum(totals.cost_usd for totals in self._pending.get(key, {}).values())
+        if stored is None or time.monotonic() - stored[1] > USER_USAGE_FLUSH_INTERVAL_SECONDS:
+            stored = (self._load_cost_usd(*key), time.monotonic())
+            with self._lock:
+                self._stored_costs[key] = stored
+        return stored[0] + pending
+
+    def get_totals_by_step(self, user_id: str, day: str | None = None) -> dict[str, UsageTotals]:
+        '''Get the totals of the usage of a user on a day (default: today) of each workflow step, stored or not yet.'''
+        from persistence.session_store import get_session_store
+
+        key = (user_id, day or get_today())
+        data = get_session_store().load(self.get_document_id(*key)) or {}
+        totals = {step: deserialize_to_dataclass(UsageTotals, step_totals) for step, step_totals in data.get('steps', {}).items()}
+        with self._lock:
+            for step, step_totals in self._pending.get(key, {}).items():
+                totals.setdefault(step, UsageTotals()).merge(step_totals)
+        return totals
+
+    def _load_cost_usd(self, user_id: str, day: str) -> float:
+        from persistence.session_store import get_session_store
+
+        try:
+            data = get_session_store().load(self.get_document_id(user_id, day))
+        except Exception as e:
+            logger.warning(f'Failed to read the usage of user_id={user_id} on {day}: {e}')
+            return 0
+        return data.get('cost_usd', 0) if data is not None else 0
+
+    def flush(self) -> None:
+        '''Add the usage recorded since the last flush to the usage documents, keeping what failed to be written for the next one.'''
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        for (user_id, day), steps in pending.items():
+            try:
+                self._add_to_document(user_id, day, steps)
+            except Exception as e:
+                logger.warning(f'Failed to write the usage of user_id={user_id} on {day}, retrying at the next flush: {e}')
+                with self._lock:
+                    for step, totals in steps.items():
+                        self._pending.setdefault((user_id, day), {}).setdefault(step, UsageTotals()).merge(totals)
+
+    def _add_to_document(self, user_id: str, day: str, steps: dict[str, UsageTotals]) -> None:
+        from persistence.session_store import SessionConflictError, get_session_store
+
+        store = get_session_store()
+        document_id = self.get_document_id(user_id, day)
+        for attempt in range(USER_USAGE_WRITE_MAX_ATTEMPTS):
+            data = store.load(document_id) or {'user_id': user_id, 'day': day, 'steps': {}, 'cost_usd': 0, 'revision': 0}
+            revision = data.get('revision', 0)
+            for step, totals in steps.items():
+                stored = deserialize_to_dataclass(UsageTotals, data['steps'].get(step, {}))
+                stored.merge(totals)
+                data['steps'][step] = asdict(stored)
+            data['cost_usd'] = sum(step_totals['cost_usd'] for step_totals in data['steps'].values())
+            data['revision'] = revision + 1
+            try:
+                store.save(document_id, data, expected_revision=revision)
+            except SessionConflictError:
+                if attempt == USER_USAGE_WRITE_MAX_ATTEMPTS - 1:
+                    raise
+                continue
+
+            with self._lock:
+                self._stored_costs[(user_id, day)] = (data['cost_usd'], time.monotonic())
+            return
+
+    def _flush_periodically(self) -> None:
+        while not self._stop.wait(USER_USAGE_FLUSH_INTERVAL_SECONDS):
+            self.flush()
+
+    def close(self) -> None:
+        self._stop.set()
+        self.flush()
+
+
+_accountant: UserUsageAccountant | None = None
+_accountant_lock = Lock()
+
+
+def get_user_usage_accountant() -> UserUsageAccountant:
+    global _accountant
+    with _accountant_lock:
+        if _accountant is None:
+            _accountant = UserUsageAccountant()
+        return _accountant
+
+
+def close_user_usage_accountant() -> None:
+    '''Write the usage not stored yet, eg. on shutdown.'''
+    if _accountant is not None:
+        _accountant.close()
+
+
+def record_usage(model: str, prompt_tokens: int = 0, cached_tokens: int = 0, completion_tokens: int = 0, embedding_tokens: int = 0) -> None:
+    '''
+    Add the usage of an LLM or embedding request to the ledger of the current usage session, if any, and to the daily
+    usage of its user
+
+        Parameters:
+            model (str): name of the model used for the request
+            prompt_tokens (int): number of prompt tokens, including the cached ones
+            cached_tokens (int): number of prompt tokens served from the provider's prompt cache
+            completion_tokens (int): number of generated tokens
+            embedding_tokens (int): number of tokens embedded
+    '''
+    if (state := current_usage_session.get()) is None:
+        return
+
+    entry = UsageEntry(
+        step=current_step_id.get(),
+        model=model,
+        time=time.time(),
+        prompt_tokens=prompt_tokens,
+        cached_tokens=cached_tokens,
+        completion_tokens=completion_tokens,
+        embedding_tokens=embedding_tokens)
+    state.usage.entries.append(entry)
+    get_user_usage_accountant().add(state.user_id, entry)
+
+
+def check_budget(state: SessionState) -> bool:
+    '''
+    Make a session the current usage session, and set whether its requests are degraded for it or its user being over
+    budget (see USAGE_BUDGET_USD_PER_SESSION and USAGE_BUDGET_USD_PER_USER_PER_DAY)
+
+        Parameters:
+            state (SessionState): session state of the current request
+
+        Returns:
+            bool: whether the session is over budget
+    '''
+    current_usage_session.set(state)
+
+    scope = None
+    if USAGE_BUDGET_USD_PER_SESSION > 0 and sum(get_cost_usd(entry) for entry in list(state.usage.entries)) >= USAGE_BUDGET_USD_PER_SESSION:
+        scope = 'session'
+    elif USAGE_BUDGET_USD_PER_USER_PER_DAY > 0 and get_user_usage_accountant().get_cost_usd(state.user_id) >= USAGE_BUDGET_USD_PER_USER_PER_DAY:
+        scope = 'user'
+
+    is_over_budget.set(scope is not None)
+    if scope is not None:
+        logger.info(f'Usage of the {scope} of session_id={state.session_id} is over budget, using cheaper models and fewer document chunks')
+        USAGE_BUDGET_EXCEEDED.labels(scope=scope, step=current_step_id.get()).inc()
+    return scope is not None
+
+
+def get_num_of_doc_chunks(num_of_doc_chunks: int) -> int:
+    '''Get the number of document chunks to retrieve for a prompt, reduced to BUDGET_NUM_OF_DOC_CHUNKS when over budget.'''
+    return min(num_of_doc_chunks, BUDGET_NUM_OF_DOC_CHUNKS) if is_over_budget.get() else num_of_doc_chunks
+
+
+def get_price_per_million_tokens(model: str) -> float:
+    '''Get the price of a model to order candidates by, prompt and completion tokens weighed alike (unknown models last).'''
+    price = MODEL_PRICES.get(model)
+    return price.prompt + price.completion if price is not None else float('inf')
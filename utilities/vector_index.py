@@ -0,0 +1,390 @@
+from __future__ import annotations
+
+import logging
+import math
+import uuid
+from collections import OrderedDict, defaultdict
+from collections.abc import Iterable
+from dataclasses import dataclass
+from threading import Lock
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from configurations.constants import (
+    VECTOR_INDEX_MAX_CACHED_SESSIONS,
+    VECTOR_INDEX_RESCORE_FACTOR,
+    Quantization
+)
+from utilities.instrumentation import VECTOR_INDEX_BYTES, span
+
+if TYPE_CHECKING:
+    from chromadb import Collection
+    from langchain_community.vectorstores.chroma import Chroma
+
+logger = logging.getLogger(__name__)
+
+# Rows of codes scored at a time, to bound the memory of the temporary arrays of a search
+SEARCH_BLOCK_SIZE = 4096
+
+# Number of bits set in each byte value, to compute Hamming distances between binary codes
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+_M1, _M2, _M4, _H01 = (np.uint64(m) for m in (0x5555555555555555, 0x3333333333333333, 0x0f0f0f0f0f0f0f0f, 0x0101010101010101))
+
+
+def shorten_embeddings(embeddings: np.ndarray, dimensions: int) -> np.ndarray:
+    '''
+    Shorten text-embedding-3 embeddings to their first dimensions and normalize them again, which gives the embeddings
+    the API returns when requested with these dimensions
+
+        Parameters:
+            embeddings (np.ndarray): embeddings, one per row
+            dimensions (int): number of dimensions to keep
+
+        Returns:
+            np.ndarray: shortened unit-norm embeddings
+    '''
+    shortened = np.asarray(embeddings, dtype=np.float32)[:, :dimensions]
+    return shortened / np.maximum(np.linalg.norm(shortened, axis=1, keepdims=True), 1e-12)
+
+
+def quantize(embeddings: np.ndarray, quantization: Quantization) -> tuple[np.ndarray, np.ndarray | None]:
+    '''
+    Quantize embeddings
+
+        Parameters:
+            embeddings (np.ndarray): unit-norm embeddings, one per row
+            quantization (Quantization): float32 (kept as is), int8 (values scaled by 127 / max absolute value of the
+                embedding) or binary (sign bits, packed 8 per byte)
+
+        Returns:
+            tuple[np.ndarray, np.ndarray | None]: codes, and the scale of each embedding for int8 codes
+    '''
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    match quantization:
+        case Quantization.FLOAT32:
+            return embeddings, None
+        case Quantization.INT8:
+            scales = np.maximum(np.abs(embeddings).max(axis=1), 1e-12) / 127
+            return np.round(embeddings / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        case Quantization.BINARY:
+            return np.packbits(embeddings > 0, axis=1), None
+
+
+def _hamming_distances(codes: np.ndarray, query_codes: np.ndarray) -> np.ndarray:
+    '''Hamming distances between binary codes (one per row) and the query's.'''
+    bits = np.bitwise_xor(codes, query_codes)
+    if bits.shape[1] % 8:
+        return _POPCOUNT[bits].sum(axis=1, dtype=np.int32)
+
+    # count the bits set 64 at a time (SWAR popcount), much faster than looking up each byte
+    words = np.ascontiguousarray(bits).view(np.uint64)
+    words = words - ((words >> np.uint64(1)) & _M1)
+    words = (words & _M2) + ((words >> np.uint64(2)) & _M2)
+    words = (words + (words >> np.uint64(4))) & _M4
+    return ((words * _H01) >> np.uint64(56)).sum(axis=1, dtype=np.int32)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    '''Positions of the k highest scores, highest first.'''
+    positions = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    return positions[np.argsort(-scores[positions], kind='stable')]
+
+
+class QuantizedIndex:
+    '''
+    Brute-force index of unit-norm embeddings of d dimensions, stored as float32 (4 * d bytes each), int8 with a scale
+    (d + 4 bytes) or binary (d / 8 bytes) codes. Int8 and binary codes are searched against the query quantized the same
+    way (as integer dot products and Hamming distances), and the top candidates can then be re-scored against the float
+    query, which recovers most of the ranking quality lost to the quantization of the query.
+    '''
+
+    def __init__(self, quantization: Quantization, dimensions: int, codes: np.ndarray, scales: np.ndarray | None = None):
+        self.quantization = quantization
+        self.dimensions = dimensions
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def from_embeddings(cls, embeddings: np.ndarray, quantization: Quantization) -> QuantizedIndex:
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        return cls(quantization, embeddings.shape[1], *quantize(embeddings, quantization))
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def concatenate(self, other: QuantizedIndex) -> QuantizedIndex:
+        return QuantizedIndex(
+            self.quantization,
+            self.dimensions,
+            np.concatenate([self.codes, other.codes]),
+            np.concatenate([self.scales, other.scales]) if self.scales is not None else None)
+
+    def subset(self, keep: np.ndarray) -> QuantizedIndex:
+        return QuantizedIndex(self.quantization, self.dimensions, self.codes[keep], self.scales[keep] if self.scales is not None else None)
+
+    def search(self, query: np.ndarray, k: int, rescore_factor: int = 0) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Find the embeddings most similar to the query
+
+            Parameters:
+                query (np.ndarray): unit-norm query embedding
+                k (int): number of embeddings to return
+                rescore_factor (int): re-score the top k * rescore_factor candidates of int8 and binary codes with the
+                    float query, 0 to rank by quantized scores only (default: 0)
+
+            Returns:
+                tuple[np.ndarray, np.ndarray]: positions of the k most similar embeddings, most similar first, and their
+                    estimated cosine similarities
+        '''
+        k = min(k, len(self))
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        query = np.asarray(query, dtype=np.float32)
+        if self.quantization == Quantization.FLOAT32:
+            scores = self._scores(lambda codes: codes @ query)
+            positions = _top_k(scores, k)
+            return positions, scores[positions]
+
+        scores = self._quantized_scores(query)
+        if rescore_factor <= 0:
+            positions = _top_k(scores, k)
+            return positions, scores[positions]
+
+        candidates = _top_k(scores, min(len(self), k * rescore_factor))
+        rescored = self._float_scores(query, candidates)
+        order = _top_k(rescored, k)
+        return candidates[order], rescored[order]
+
+    def _scores(self, score_block) -> np.ndarray:
+        return np.concatenate([
+            score_block(self.codes[start:start + SEARCH_BLOCK_SIZE]) for start in range(0, len(self), SEARCH_BLOCK_SIZE)])
+
+    def _quantized_scores(self, query: np.ndarray) -> np.ndarray:
+        query_codes, query_scales = quantize(query[None, :], self.quantization)
+        if self.quantization == Quantization.INT8:
+            # products of int8 values summed over a few thousand dimensions are exact in float32, which uses BLAS
+            query_codes = query_codes[0].astype(np.float32)
+            dot_products = self._scores(lambda codes: codes.astype(np.float32) @ query_codes)
+            return dot_products * self.scales * query_scales[0]
+
+        hamming_distances = self._scores(lambda codes: _hamming_distances(codes, query_codes))
+        return 1 - 2 * hamming_distances.astype(np.float32) / self.dimensions
+
+    def _float_scores(self, query: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        codes = self.codes[positions]
+        if self.quantization == Quantization.INT8:
+            return (codes.astype(np.float32) @ query) * self.scales[positions]
+
+        signs = np.unpackbits(codes, axis=1, count=self.dimensions).astype(np.float32) * 2 - 1
+        return (signs @ query) / math.sqrt(self.dimensions)
+
+
+@dataclass
+class _SessionIndex:
+    '''Chunks of the documents of a session, and the index of their embeddings (in the same order).'''
+    ids: list[str]
+    documents: list[Document]
+    index: QuantizedIndex
+
+
+class QuantizedVectorStore(VectorStore):
+    '''
+    Vector store searching the embeddings of each session in an in-memory QuantizedIndex.
+
+    If a Chroma store shared by the replicas is given (with its collection, which the embeddings are written to), the
+    embeddings are also written to it at full precision, and the index of a session is loaded from it when the session
+    is not in memory, or was re-ingested by another replica. Only the indexes of the max_cached_sessions sessions
+    searched most recently are then kept in memory.
+    '''
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        quantization: Quantization,
+        rescore_factor: int = VECTOR_INDEX_RESCORE_FACTOR,
+        chroma: Chroma | None = None,
+        chroma_collection: Collection | None = None,
+        max_cached_sessions: int = VECTOR_INDEX_MAX_CACHED_SESSIONS
+    ):
+        self._embedding = embedding
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+        self.chroma = chroma
+        self.chroma_collection = chroma_collection
+        self.max_cached_sessions = max_cached_sessions
+        self._sessions: OrderedDict[str | None, _SessionIndex] = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def add_embeddings(self, texts: list[str], embeddings: list[list[float]], metadatas: list[dict], ids: list[str] | None = None) -> list[str]:
+        '''
+        Add texts with their embeddings
+
+            Parameters:
+                texts (list[str]): texts to add
+                embeddings (list[list[float]]): unit-norm embeddings of the texts
+                metadatas (list[dict]): metadata of the texts, whose 'session_id' selects the index they are added to
+                ids (list[str] | None): IDs of the texts, random if None (default: None)
+
+            Returns:
+                list[str]: IDs of the texts
+        '''
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        if not texts:
+            return ids
+        if self.chroma is not None:
+            self.chroma_collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=texts)
+
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        rows_by_session: dict[str | None, list[int]] = defaultdict(list)
+        for row, metadata in enumerate(metadatas):
+            rows_by_session[metadata.get('session_id')].append(row)
+
+        with self._lock:
+            for session_id, rows in rows_by_session.items():
+                cached = self._sessions.get(session_id)
+                # with Chroma, the index of a session that is not in memory is loaded from it at its next search
+                if cached is None and self.chroma is not None:
+                    continue
+
+                added = _SessionIndex(
+                    ids=[ids[row] for row in rows],
+                    documents=[Document(page_content=texts[row], metadata=metadatas[row]) for row in rows],
+                    index=QuantizedIndex.from_embeddings(vectors[rows], self.quantization))
+                if cached is not None:
+                    added = _SessionIndex(cached.ids + added.ids, cached.documents + added.documents, cached.index.concatenate(added.index))
+                self._cache(session_id, added)
+
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: list[dict] | None = None, ids: list[str] | None = None, **kwargs: Any) -> list[str]:
+        texts = list(texts)
+        return self.add_embeddings(texts, self._embedding.embed_documents(texts), metadatas or [{} for _ in texts], ids)
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: list[dict] | None = None,
+        quantization: Quantization = Quantization.INT8,
+        **kwargs: Any
+    ) -> QuantizedVectorStore:
+        store = cls(embedding, quantization, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
+
+    def get(self, where: dict | None = None, **kwargs: Any) -> dict[str, list]:
+        '''Get the IDs, metadata and texts of the chunks whose metadata have the values of where, like Chroma.get().'''
+        if self.chroma is not None:
+            return self.chroma.get(where=where, **kwargs)
+
+        where = where or {}
+        result = {'ids': [], 'metadatas': [], 'documents': []}
+        with self._lock:
+            for session in self._sessions.values():
+                for id, document in zip(session.ids, session.documents):
+                    if all(document.metadata.get(key) == value for key, value in where.items()):
+                        result['ids'].append(id)
+                        result['metadatas'].append(document.metadata)
+                        result['documents'].append(document.page_content)
+        return result
+
+    def delete(self, ids: list[str] | None = None, **kwargs: Any) -> None:
+        if self.chroma is not None:
+            self.chroma.delete(ids=ids)
+
+        ids_to_delete = set(ids or [])
+        with self._lock:
+            for session_id, session in list(self._sessions.items()):
+                keep = np.array([id not in ids_to_delete for id in session.ids], dtype=bool)
+                if keep.all():
+                    continue
+                if not keep.any():
+                    del self._sessions[session_id]
+                    continue
+                self._sessions[session_id] = _SessionIndex(
+                    ids=[id for id, kept in zip(session.ids, keep) if kept],
+                    documents=[document for document, kept in zip(session.documents, keep) if kept],
+                    index=session.index.subset(keep))
+            self._update_memory_metric()
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: dict | None = None, **kwargs: Any) -> list[tuple[Document, float]]:
+        '''
+        Search the chunks of a session most similar to the query
+
+            Parameters:
+                query (str): text to search for
+                k (int): number of chunks to return (default: 4)
+                filter (dict | None): {'session_id': ...}, the session whose chunks are searched (default: None)
+
+            Returns:
+                list[tuple[Document, float]]: chunks most similar to the query, with their cosine distance to it
+        '''
+        filter = filter or {}
+        if set(filter) - {'session_id'}:
+            raise ValueError(f'QuantizedVectorStore only filters by session_id, not by {sorted(set(filter) - {"session_id"})}')
+
+        session = self._get_session_index(filter.get('session_id'))
+        if session is None:
+            return []
+
+        query_embedding = np.asarray(self._embedding.embed_query(query), dtype=np.float32)
+        with span('vector_index_search', quantization=self.quantization, num_chunks=len(session.index)):
+            positions, scores = session.index.search(query_embedding, k, self.rescore_factor)
+        return [(session.documents[position], 1 - float(score)) for position, score in zip(positions, scores)]
+
+    def similarity_search(self, query: str, k: int = 4, filter: dict | None = None, **kwargs: Any) -> list[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k, filter, **kwargs)]
+
+    def _get_session_index(self, session_id: str | None) -> _SessionIndex | None:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+        if self.chroma is None:
+            return session
+
+        # reload the index if the session's chunks in Chroma changed (eg. its documents were re-ingested by another replica)
+        stored_ids = self.chroma.get(where={'session_id': session_id}, include=[])['ids']
+        if session is not None and set(session.ids) == set(stored_ids):
+            return session
+        if not stored_ids:
+            with self._lock:
+                self._sessions.pop(session_id, None)
+                self._update_memory_metric()
+            return None
+
+        with span('vector_index_load', quantization=self.quantization, num_chunks=len(stored_ids)):
+            stored = self.chroma.get(where={'session_id': session_id}, include=['embeddings', 'metadatas', 'documents'])
+            session = _SessionIndex(
+                ids=stored['ids'],
+                documents=[Document(page_content=text, metadata=metadata) for text, metadata in zip(stored['documents'], stored['metadatas'])],
+                index=QuantizedIndex.from_embeddings(np.asarray(stored['embeddings'], dtype=np.float32), self.quantization))
+        with self._lock:
+            self._cache(session_id, session)
+        logger.info(f'Loaded the {self.quantization} vector index of {len(session.ids)} chunks of session_id={session_id} from Chroma')
+        return session
+
+    def _cache(self, session_id: str | None, session: _SessionIndex) -> None:
+        '''Keep the index of a session in memory, evicting those of the least recently searched sessions if loaded from Chroma (lock held).'''
+        self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+        while self.chroma is not None and len(self._sessions) > self.max_cached_sessions:
+            self._sessions.popitem(last=False)
+        self._update_memory_metric()
+
+    def _update_memory_metric(self) -> None:
+        VECTOR_INDEX_BYTES.labels(quantization=self.quantization).set(sum(session.index.nbytes for session in self._sessions.values()))
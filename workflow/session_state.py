@@ -2,17 +2,20 @@
 from dataclasses import dataclass, field
 import datetime
 
-from langchain.docstore.document import Document
 from pydantic import UUID4
 
 from configurations.constants import (
     DEFAULT_NUM_OF_DOC_CHUNKS,
+    EDIT_COALESCE_SECONDS,
     DEFAULT_NUM_OF_TOKENS, 
     IS_DEV_MODE, 
     SYSTEM_PROMPT_FOR_ANSWERING_ORIGINAL_QUESTION,
     SYSTEM_PROMPT_FOR_ANSWERING_IMPLICIT_QUESTION,
+    Component,
+    IngestionStatus,
     StepID
 )
+from workflow.text_changes import TextChange, apply_text_changes, get_text_changes
 
 
 @dataclass
@@ -40,11 +43,21 @@ class Improvement:
 class PolishContext:
     improvements: list[Improvement] = field(default_factory=list)
 
+def get_utc_time(time: datetime.datetime | str) -> datetime.datetime:
+    '''Get a time of the session state as an aware UTC datetime, from an ISO string or a naive datetime (stored as UTC).'''
+    time = datetime.datetime.fromisoformat(time) if isinstance(time, str) else time
+    return time.replace(tzinfo=datetime.timezone.utc) if time.tzinfo is None else time.astimezone(datetime.timezone.utc)
+
+
 @dataclass
 class EditedAnswer:
     time: datetime.datetime
-    previous_answer: str
-    new_answer: str
+    # changes turning the answer after the edit into the answer before it, the answer after the last edit being the
+    # current answer of the question (both answers were stored in full, new_answer and previous_answer, before)
+    changes_to_previous_answer: list[TextChange] = field(default_factory=list)
+    is_first_edit: bool = False  # of an answer that was not edited before, which has no previous answer
+    new_answer: str | None = None
+    previous_answer: str | None = None  # None for the first edit, and not stored as None values are not serialized
 
 @dataclass
 class GrantApplicationQuestionContext:
@@ -55,6 +68,7 @@ class GrantApplicationQuestionContext:
     polish: PolishContext = field(default_factory=PolishContext)
     edited_answers: list[EditedAnswer] = field(default_factory=list)
     current_answer: str | None = None # TODO: point this to the last answer in current workflow
+    is_archived: bool = False  # whether all but its question, word limit and current answer are archived (see persistence/compaction.py)
 
     def get_original_answer(self) -> str | None:
         return self.answer
@@ -62,6 +76,17 @@ class GrantApplicationQuestionContext:
     def get_revised_answer(self) -> str | None:
         return self.comprehensiveness.revised_application_answer
 
+    def get_edited_answers(self) -> list[str]:
+        '''Get the answers of the question after each of its edits, from the first edit to the last one.'''
+        answers = []
+        answer = self.current_answer
+        for edit in reversed(self.edited_answers):
+            if edit.new_answer is not None:
+                answer = edit.new_answer
+            answers.append(answer)
+            answer = edit.previous_answer if edit.new_answer is not None else apply_text_changes(answer, edit.changes_to_previous_answer)
+        return answers[::-1]
+
     def get_last_improved_answer(self,) -> str | None:
         if self.polish.improvements:
             return self.polish.improvements[-1].improved_answer
@@ -78,6 +103,66 @@ class TestConfigContext:
     system_prompt: str = None
 
 
+@dataclass
+class IngestionContext:
+    job_id: str | None = None
+    status: IngestionStatus = IngestionStatus.NOT_STARTED
+    started_at: float | None = None  # timestamp, to tell a job that is still running from one whose replica went away
+    num_files: int = 0
+    files: list[str] = field(default_factory=list)  # uploaded files the job ingests, to tell whether they changed since
+    num_files_processed: int = 0
+    num_chunks: int = 0
+    num_chunks_embedded: int = 0
+    error: str | None = None
+
+    def is_running(self) -> bool:
+        return self.status == IngestionStatus.RUNNING
+
+
+@dataclass
+class DocumentDigest:
+    source: str
+    mission: str | None = None
+    programs: str | None = None
+    metrics: str | None = None
+    finances: str | None = None
+
+
+@dataclass
+class ChunkReference:
+    source: str
+    index: int
+
+
+@dataclass
+class PreRetrievedContext:
+    question: str
+    chunks: list[ChunkReference] = field(default_factory=list)
+
+
+@dataclass
+class OrganizationProfile:
+    job_id: str | None = None  # ingestion job of the documents it was built from, None until it is built
+    digests: list[DocumentDigest] = field(default_factory=list)
+    contexts: list[PreRetrievedContext] = field(default_factory=list)  # of the common grant application questions
+
+
+@dataclass
+class UsageEntry:
+    step: str  # workflow step of the request
+    model: str
+    time: float  # timestamp
+    prompt_tokens: int = 0  # including the cached ones
+    cached_tokens: int = 0  # prompt tokens served from the provider's prompt cache
+    completion_tokens: int = 0
+    embedding_tokens: int = 0
+
+
+@dataclass
+class UsageLedger:
+    entries: list[UsageEntry] = field(default_factory=list)  # one per LLM or embedding request (old ones folded per step and model on compaction)
+
+
 @dataclass
 class SessionState:
     session_id: str
@@ -85,7 +170,11 @@ class SessionState:
     uploaded_files: list[str] = field(default_factory=list)
     questions: list[GrantApplicationQuestionContext] = field(default_factory=list)
     current_step_id: StepID = StepID.START
-    last_user_input = None
+    last_user_input: Component | None = None  # persisted, as /after_chat may be served by another replica than /chat/
+    revision: int = 0  # incremented on every write to the session store
+    ingestion: IngestionContext = field(default_factory=IngestionContext)  # ingestion job of the uploaded files
+    org_profile: OrganizationProfile = field(default_factory=OrganizationProfile)  # digest of the uploaded files
+    usage: UsageLedger = field(default_factory=UsageLedger)  # token usage of the LLM and embedding requests of the session
     test_config: TestConfigContext = field(default_factory=TestConfigContext) if IS_DEV_MODE else None
 
 
@@ -198,10 +287,22 @@ class SessionState:
 
     def edit_last_question(self, question_index: int, answer: str):
         question = self.questions[question_index]
+        now = datetime.datetime.now(datetime.timezone.utc)
+        previous_answer = question.current_answer
+        is_first_edit = previous_answer is None
+
+        # if enabled, an edit soon after the previous one replaces it, as the changes from the answer before the previous one
+        last_edit = question.edited_answers[-1] if question.edited_answers else None
+        if EDIT_COALESCE_SECONDS > 0 and last_edit is not None and last_edit.new_answer is None and (
+                now - get_utc_time(last_edit.time)).total_seconds() < EDIT_COALESCE_SECONDS:
+            question.edited_answers.pop()
+            is_first_edit = last_edit.is_first_edit
+            previous_answer = None if is_first_edit else apply_text_changes(previous_answer, last_edit.changes_to_previous_answer)
+
         question.edited_answers.append(EditedAnswer(
-            time=datetime.datetime.now(),
-            previous_answer=question.current_answer,
-            new_answer=answer
+            time=now,
+            changes_to_previous_answer=get_text_changes(answer, previous_answer) if not is_first_edit else [],
+            is_first_edit=is_first_edit
         ))
 
         question.current_answer = answer
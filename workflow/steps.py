@@ -227,7 +227,7 @@ STEPS: dict[StepID, ChatbotStep] = {
     ),
     StepID.END: ChatbotStep(
         initial_chatbot_message=("Thanks for participating! 👏"),
-        components={}
+        components=set()
     )
 }
 
@@ -0,0 +1,42 @@
+import re
+from dataclasses import dataclass
+from difflib import SequenceMatcher
+
+
+@dataclass
+class TextChange:
+    start: int  # offsets of the characters replaced in the text the change applies to
+    end: int
+    text: str = ''  # replacing them
+
+
+def get_text_changes(text: str, target: str) -> list[TextChange]:
+    '''
+    Get the changes turning a text into a target text, word by word (words and the whitespace between them), which
+    are much smaller than the target for the edits of an answer
+
+        Parameters:
+            text (str): text the changes apply to
+            target (str): text the changes turn it into
+
+        Returns:
+            list[TextChange]: changes, in order
+    '''
+    tokens = re.findall(r'\S+|\s+', text)
+    target_tokens = re.findall(r'\S+|\s+', target)
+
+    offsets = [0]
+    for token in tokens:
+        offsets.append(offsets[-1] + len(token))
+
+    return [
+        TextChange(start=offsets[i1], end=offsets[i2], text=''.join(target_tokens[j1:j2]))
+        for tag, i1, i2, j1, j2 in SequenceMatcher(None, tokens, target_tokens, autojunk=False).get_opcodes()
+        if tag != 'equal']
+
+
+def apply_text_changes(text: str, changes: list[TextChange]) -> str:
+    '''Apply the changes of get_text_changes to the text they were computed from.'''
+    for change in sorted(changes, key=lambda change: change.start, reverse=True):
+        text = text[:change.start] + change.text + text[change.end:]
+    return text